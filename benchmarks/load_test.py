@@ -0,0 +1,409 @@
+"""
+How many analysts can one server process support? Drive many sessions at once and see.
+
+    python benchmarks/load_test.py [--sessions 20] [--concurrency 10] [--rows 100000] [--output load.json]
+
+ui.py is served in this process exactly as `panel serve` would (upload and report routes included).
+Each simulated analyst then does what the browser would:
+
+    open_session  GET /ui - the session is created and ui.py run for it
+    upload        PUT the CSV to the upload endpoint in chunks then tell the session it is complete,
+                  and wait until the data has been read
+    apply_labels  select the labels YAML (the same as using the file input) and wait for it to be applied
+    configure     open the Stats Tests tab, click ANOVA, then select height by sport and every sport,
+                  and wait for the live group summary
+    run_anova     click "Get ANOVA Results" and wait for the report to be published in the Results tab
+
+There is no browser (nothing renders and no websocket is connected) so the steps inside the session
+are done by changing its widgets on the server's event loop - the same thing a browser event does.
+Timings include any wait for the event loop so they are what an analyst would see while everyone else is busy.
+
+Each analyst gets their own synthetic CSV (see synthetic_data.py) unless --shared-dataset is given -
+sharing means the parsed data and results are mostly reused so it is the best case rather than the worst.
+Reported: p50/p95/p99 latency per step, process RSS over time, and (with SOFASTATS_DEBUG_PATCH_BYTES set)
+the patch bytes each session would have sent. Only one server process is measured -
+with SOFASTATS_NUM_PROCS each process gets its own share of the sessions.
+"""
+import argparse
+import asyncio
+from collections.abc import Callable, Coroutine
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+import datetime
+import json
+import os
+from pathlib import Path
+import re
+import resource
+import secrets
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Any
+from urllib.parse import urljoin
+from urllib.request import ProxyHandler, Request, build_opener
+import warnings
+
+sys.path.insert(0, str(Path(__file__).parent))  ## so it runs from anywhere without being installed
+
+import synthetic_data
+
+UI_FPATH = Path(__file__).parent.parent / 'src' / 'sofastats_app' / 'ui' / 'ui.py'
+STEPS = ('open_session', 'upload', 'apply_labels', 'configure', 'run_anova')
+UPLOAD_CHUNK_BYTES = 8 * 1024 ** 2
+POLL_SECS = 0.01
+TOKEN_PATTERN = re.compile(r'"token"\s*:\s*"([^"]+)"')
+
+url_opener = build_opener(ProxyHandler({}))  ## localhost - never via any proxy set in the environment
+warnings.filterwarnings('ignore', message='To use the Modal')  ## no browser so modals are never rendered
+
+
+@dataclass
+class SessionResult:
+    session_n: int
+    secs_by_step: dict[str, float] = field(default_factory=dict)
+    error: str | None = None
+    patch_bytes: int | None = None
+
+
+@dataclass(frozen=True)
+class RssSample:
+    secs: float
+    rss_bytes: int
+    n_sessions: int
+
+
+def get_rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:  ## not Linux - the peak is the best available
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def get_percentile(vals: list[float], pct: float) -> float:
+    if len(vals) == 1:
+        return vals[0]
+    return statistics.quantiles(vals, n=100, method='inclusive')[round(pct) - 1]
+
+
+class LoadTestServer:
+    """
+    ui.py served on a random port in a background thread
+    """
+
+    def __init__(self):
+        self.server = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def _serve(self):
+        from panel.io.server import get_server
+        from sofastats_app.ui import reports, upload
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.server = get_server({'ui': str(UI_FPATH)}, port=0, start=False, show=False,
+            static_dirs={'images': str(UI_FPATH.parent / 'images')},
+            extra_patterns=upload.ROUTES + reports.ROUTES,
+            unused_session_lifetime_milliseconds=24 * 60 * 60 * 1000)  ## no websocket ever connects
+        self.server.start()
+        self._ready.set()
+        self.server.io_loop.start()
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self.server.io_loop.add_callback(self.server.io_loop.stop)
+        self._thread.join(timeout=10)
+
+    @property
+    def url(self) -> str:
+        return f"http://localhost:{self.server.port}"
+
+    @property
+    def n_sessions(self) -> int:
+        return len(self.server.get_sessions('/ui'))
+
+    def run_in_session(self, session_id: str, fn: Callable[[], Coroutine]) -> Any:
+        """
+        Run fn() on the server's event loop as part of the session (as a browser event would be) and wait for it
+        """
+        from panel.io.state import set_curdoc
+        doc = self.server.get_session('/ui', session_id).document
+        async def run():
+            with set_curdoc(doc):
+                return await fn()
+        return asyncio.run_coroutine_threadsafe(run(), self.server.io_loop.asyncio_loop).result()
+
+
+async def wait_until(is_done: Callable[[], bool], *, timeout_secs: float, what: str):
+    deadline = time.perf_counter() + timeout_secs
+    while not is_done():
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"Gave up waiting for {what} after {timeout_secs:,}s")
+        await asyncio.sleep(POLL_SECS)
+
+def find(viewable_type: type, *, name: str | None = None):
+    """
+    Find a widget (or layout etc.) in the current session's template
+    """
+    import panel as pn
+    template = pn.state.template
+    for area in (template.sidebar, template.main):
+        for obj in area:
+            for found in obj.select(viewable_type):
+                if name is None or found.name == name:
+                    return found
+    raise LookupError(f"No {viewable_type.__name__} {name or ''} in session")
+
+def get_output_html() -> str:
+    """
+    What the Results tab shows - an iframe once the report has been published (in a worker thread - see ui.show_output)
+    """
+    import panel as pn
+    template = pn.state.template
+    for obj in template.main:
+        for html_pane in obj.select(pn.pane.HTML):
+            if '<iframe' in str(html_pane.object):
+                return html_pane.object
+    return ''
+
+def find_option(options: list[str], col: str) -> str:
+    from sofastats_app.ui.utils import get_unlabelled
+    return next(option for option in options if get_unlabelled(option) == col)
+
+
+class SimulatedAnalyst:
+
+    def __init__(self, server: LoadTestServer, session_n: int, csv_fpath: Path, yaml_bytes: bytes,
+            *, timeout_secs: float):
+        self.server = server
+        self.csv_fpath = csv_fpath
+        self.yaml_bytes = yaml_bytes
+        self.timeout_secs = timeout_secs
+        self.session_id = None
+        self.result = SessionResult(session_n=session_n)
+
+    def _time(self, step: str, fn: Callable[[], Any]):
+        start = time.perf_counter()
+        fn()
+        self.result.secs_by_step[step] = time.perf_counter() - start
+
+    def _in_session(self, fn: Callable[[], Coroutine]) -> Any:
+        return self.server.run_in_session(self.session_id, fn)
+
+    def open_session(self):
+        from bokeh.util.token import get_session_id
+        with url_opener.open(f"{self.server.url}/ui", timeout=self.timeout_secs) as response:
+            html = response.read().decode('utf-8')
+        self.session_id = get_session_id(TOKEN_PATTERN.search(html).group(1))
+
+    def upload(self):
+        from sofastats_app.ui.upload import ChunkedFileUpload
+        from sofastats_app.ui.workspace import get_workspace
+        async def get_upload_url():
+            return find(ChunkedFileUpload).upload_url
+        upload_url = urljoin(f"{self.server.url}/ui", self._in_session(get_upload_url))  ## relative to the page
+        upload_id = secrets.token_urlsafe(12)
+        csv_bytes = self.csv_fpath.read_bytes()
+        for offset in range(0, len(csv_bytes), UPLOAD_CHUNK_BYTES):
+            request = Request(f"{upload_url}/{upload_id}", method='PUT',
+                data=csv_bytes[offset: offset + UPLOAD_CHUNK_BYTES],
+                headers={'Upload-Offset': str(offset), 'Upload-Length': str(len(csv_bytes))})
+            with url_opener.open(request, timeout=self.timeout_secs):
+                pass
+        async def complete_upload():
+            workspace = get_workspace()
+            uploader = find(ChunkedFileUpload)
+            uploader.param.update(upload_id=upload_id, filename=self.csv_fpath.name)
+            uploader.n_completed += 1
+            await wait_until(lambda: workspace.got_data_param.value, timeout_secs=self.timeout_secs,
+                what="the CSV to be read")
+        self._in_session(complete_upload)
+
+    def apply_labels(self):
+        import panel as pn
+        from sofastats_app.ui.workspace import get_workspace
+        async def select_labels():
+            workspace = get_workspace()
+            find(pn.widgets.FileInput).value = self.yaml_bytes
+            await wait_until(lambda: bool(workspace.data_labels_param.value), timeout_secs=self.timeout_secs,
+                what="labels to be applied")
+        self._in_session(select_labels)
+
+    def configure(self):
+        import panel as pn
+        async def configure_anova():
+            tabs = find(pn.layout.Tabs)
+            tabs.active = 1  ## Stats Tests
+            find(pn.widgets.Button, name='ANOVA').clicks += 1
+            select_grouping_variable = find(pn.widgets.Select, name='Grouping Variable')
+            select_grouping_variable.value = find_option(select_grouping_variable.options, 'sport')
+            measure = find(pn.widgets.Select, name='Measure')
+            measure.value = find_option(measure.options, 'height')
+            group_value_selector = find(pn.widgets.CheckButtonGroup, name='Group Values')
+            group_value_selector.value = list(group_value_selector.options)
+            await wait_until(lambda: 'F =' in self._get_group_summary(), timeout_secs=self.timeout_secs,
+                what="the group summary")
+        self._in_session(configure_anova)
+
+    @staticmethod
+    def _get_group_summary() -> str:
+        """
+        Must be called inside the session
+        """
+        import panel as pn
+        for markdown in find(pn.layout.Tabs).select(pn.pane.Markdown):
+            if 'F =' in str(markdown.object):
+                return markdown.object
+        return ''
+
+    def run_anova(self):
+        import panel as pn
+        from sofastats_app.ui.workspace import get_workspace
+        async def run():
+            workspace = get_workspace()
+            find(pn.widgets.Button, name='Get ANOVA Results').clicks += 1
+            await wait_until(lambda: bool(workspace.html_param.value), timeout_secs=self.timeout_secs,
+                what="the ANOVA report")
+            await wait_until(lambda: bool(get_output_html()), timeout_secs=self.timeout_secs,
+                what="the published ANOVA report")
+        self._in_session(run)
+
+    def get_patch_bytes(self) -> int | None:
+        from sofastats_app.ui.workspace import get_workspace
+        async def get_n_bytes():
+            patch_monitor = get_workspace().patch_monitor
+            return patch_monitor.n_bytes_total if patch_monitor else None
+        return self._in_session(get_n_bytes)
+
+    def replay(self) -> SessionResult:
+        try:
+            for step in STEPS:
+                self._time(step, getattr(self, step))
+            self.result.patch_bytes = self.get_patch_bytes()
+        except Exception as e:
+            self.result.error = f"{type(e).__name__}: {e}"
+        return self.result
+
+
+def sample_rss(server: LoadTestServer, samples: list[RssSample], stop: threading.Event, *, start: float,
+        sample_secs: float):
+    while not stop.is_set():
+        samples.append(RssSample(secs=time.perf_counter() - start, rss_bytes=get_rss_bytes(),
+            n_sessions=server.n_sessions))
+        stop.wait(sample_secs)
+
+def get_step_summary(session_results: list[SessionResult]) -> dict[str, dict[str, float]]:
+    step_summary = {}
+    for step in STEPS:
+        secs = [result.secs_by_step[step] for result in session_results if step in result.secs_by_step]
+        if not secs:
+            continue
+        step_summary[step] = {
+            'n': len(secs),
+            'p50': get_percentile(secs, 50),
+            'p95': get_percentile(secs, 95),
+            'p99': get_percentile(secs, 99),
+            'max': max(secs),
+        }
+    return step_summary
+
+def print_report(step_summary: dict[str, dict[str, float]], session_results: list[SessionResult],
+        rss_samples: list[RssSample], *, wall_secs: float, concurrency: int):
+    n_failed = sum(1 for result in session_results if result.error)
+    print(f"\n{len(session_results):,} sessions ({n_failed:,} failed), up to {concurrency:,} at once, "
+        f"in {wall_secs:.1f}s\n")
+    print(f"{'step':<14}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for step, summary in step_summary.items():
+        print(f"{step:<14}{summary['n']:>6,}{summary['p50']:>9.3f}s{summary['p95']:>9.3f}s"
+            f"{summary['p99']:>9.3f}s{summary['max']:>9.3f}s")
+    errors = sorted({result.error for result in session_results if result.error})
+    for error in errors:
+        print(f"  FAILED: {error}")
+    if rss_samples:
+        rss_mib = [sample.rss_bytes / 1024 ** 2 for sample in rss_samples]
+        print(f"\nRSS: start {rss_mib[0]:,.0f} MiB; peak {max(rss_mib):,.0f} MiB; end {rss_mib[-1]:,.0f} MiB")
+        n_rows = 10
+        step = max(1, len(rss_samples) // n_rows)
+        for sample in rss_samples[::step]:
+            print(f"  {sample.secs:7.1f}s  {sample.rss_bytes / 1024 ** 2:8,.0f} MiB  {sample.n_sessions:4,} sessions")
+    patch_bytes = [result.patch_bytes for result in session_results if result.patch_bytes is not None]
+    if patch_bytes:
+        print(f"\nPatch bytes per session: p50 {get_percentile(patch_bytes, 50):,.0f}; max {max(patch_bytes):,}")
+
+def main(args: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test one server process with simulated analysts")
+    parser.add_argument('--sessions', type=int, default=20, help="analysts to simulate (default: 20)")
+    parser.add_argument('--concurrency', type=int, default=10, help="analysts active at once (default: 10)")
+    parser.add_argument('--rows', type=int, default=100_000, help="rows in each CSV (default: 100,000)")
+    parser.add_argument('--cols', type=int, default=10, help="columns in each CSV - at least 4 (default: 10)")
+    parser.add_argument('--shared-dataset', action='store_true', help="every analyst uploads the same CSV")
+    parser.add_argument('--data-folder', type=Path, default=Path(tempfile.gettempdir()) / 'sofastats_benchmark_data',
+        help="where synthetic CSVs are kept (reused by later runs)")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds to wait for any one step")
+    parser.add_argument('--sample-secs', type=float, default=0.5, help="how often to sample RSS")
+    parser.add_argument('--output', type=Path, help="also save the results as JSON")
+    parsed_args = parser.parse_args(args)
+    if parsed_args.cols < len(synthetic_data.BASE_COLS):
+        parser.error(f"--cols must be at least {len(synthetic_data.BASE_COLS)}")
+    ## keep everything this run does away from any real server's folders
+    run_dpath = Path(tempfile.mkdtemp(prefix='sofastats_load_test_'))
+    for env_var, folder_name in (('SOFASTATS_DATASET_CACHE_FOLDER', 'dataset_cache'),
+            ('SOFASTATS_UPLOAD_REGISTRY_FOLDER', 'upload_registry'), ('SOFASTATS_REPORT_STORE_FOLDER', 'report_store'),
+            ('SOFASTATS_RESULTS_HISTORY_FOLDER', 'results_history')):
+        os.environ[env_var] = str(run_dpath / folder_name)
+    n_datasets = 1 if parsed_args.shared_dataset else parsed_args.sessions
+    csv_fpaths = []
+    for seed in range(n_datasets):
+        csv_fpath = parsed_args.data_folder / f"load_{parsed_args.rows}_{parsed_args.cols}_{seed}.csv"
+        if not csv_fpath.exists():
+            print(f"Generating {csv_fpath.name} ...", flush=True)
+            synthetic_data.write_csv(csv_fpath, parsed_args.rows, parsed_args.cols, seed=seed)
+        csv_fpaths.append(csv_fpath)
+    yaml_bytes = synthetic_data.write_data_labels(
+        parsed_args.data_folder / f"synthetic_{parsed_args.cols}.yaml", parsed_args.cols).read_bytes()
+    server = LoadTestServer()
+    server.start()
+    print(f"Serving ui.py at {server.url}/ui", flush=True)
+    rss_samples = []
+    stop_sampling = threading.Event()
+    start = time.perf_counter()
+    sampler = threading.Thread(target=sample_rss, args=(server, rss_samples, stop_sampling),
+        kwargs={'start': start, 'sample_secs': parsed_args.sample_secs}, daemon=True)
+    sampler.start()
+    analysts = [SimulatedAnalyst(server, session_n, csv_fpaths[session_n % n_datasets], yaml_bytes,
+        timeout_secs=parsed_args.timeout) for session_n in range(parsed_args.sessions)]
+    session_results = []
+    with ThreadPoolExecutor(max_workers=parsed_args.concurrency) as executor:
+        futures = [executor.submit(analyst.replay) for analyst in analysts]
+        for future in as_completed(futures):
+            session_result = future.result()
+            status = f"FAILED ({session_result.error})" if session_result.error else (
+                f"{sum(session_result.secs_by_step.values()):.2f}s")
+            print(f"Session {session_result.session_n + 1:,} {status}", flush=True)
+            session_results.append(session_result)
+    wall_secs = time.perf_counter() - start
+    stop_sampling.set()
+    sampler.join()
+    server.stop()
+    step_summary = get_step_summary(session_results)
+    print_report(step_summary, session_results, rss_samples, wall_secs=wall_secs,
+        concurrency=parsed_args.concurrency)
+    if parsed_args.output:
+        parsed_args.output.write_text(json.dumps({
+            'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'settings': {key: str(val) if isinstance(val, Path) else val for key, val in vars(parsed_args).items()},
+            'wall_secs': wall_secs,
+            'steps': step_summary,
+            'sessions': [asdict(result) for result in sorted(session_results, key=lambda result: result.session_n)],
+            'rss': [asdict(sample) for sample in rss_samples],
+        }, indent=2), encoding='utf-8')
+        print(f"\nResults saved to {parsed_args.output}")
+    return 1 if any(result.error for result in session_results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
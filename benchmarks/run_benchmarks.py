@@ -0,0 +1,281 @@
+"""
+Time and measure peak memory for each step from uploaded CSV to ANOVA report, on synthetic data of many sizes.
+
+    python benchmarks/run_benchmarks.py [--preset quick|full] [--rows 1000 1000000] [--cols 10 5000]
+        [--output results.json] [--compare baseline.json]
+
+Steps timed for every dataset size (see synthetic_data.py for what the data looks like):
+
+    load_csv          Data.display_csv - parse, compact, profile, and preview a new CSV
+    load_csv_cached   Data.display_csv again - read back from the dataset cache (needs pyarrow)
+    apply_labels      Data.set_data_labels then Data.apply_data_labels - parse the YAML and relabel the preview
+    anova_options     ANOVAForm option builders (measures, grouping variables, and the values of sport)
+    anova_data_source get_data_source - the data ingested into SQLite for sofastats_lib
+    anova_html        AnovaDesign.to_html_design() for height by sport
+
+Peak memory is the tracemalloc peak during the step (Python and numpy/pandas allocations) and max RSS is
+for the whole process so far. tracemalloc slows some steps down but it does so the same way every run
+so results are comparable with each other - just not with timings taken without it.
+
+Results are saved as JSON. Pass an earlier results file with --compare to flag any step that has become
+slower or hungrier (beyond --tolerance) - the exit code is then 1 so it can fail a release check.
+Datasets above --max-cells are skipped (10^7 rows by 5,000 columns would be a 200GB CSV).
+"""
+import argparse
+import asyncio
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+import datetime
+import importlib
+from importlib.metadata import PackageNotFoundError, version
+import json
+import os
+from pathlib import Path
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).parent))  ## so it runs from anywhere without being installed
+
+import synthetic_data
+
+PRESETS = {
+    'quick': {'rows': [1_000, 10_000, 100_000], 'cols': [10, 100]},
+    'full': {'rows': [1_000, 10_000, 100_000, 1_000_000, 10_000_000], 'cols': [10, 100, 1_000, 5_000]},
+}
+DEFAULT_MAX_CELLS = 200_000_000
+MIN_SECS_TO_COMPARE = 0.05  ## anything quicker is mostly noise
+MIN_PEAK_BYTES_TO_COMPARE = 1024 ** 2
+
+
+@dataclass(frozen=True)
+class StepResult:
+    n_rows: int
+    n_cols: int
+    step: str
+    secs: float
+    peak_bytes: int
+    max_rss_bytes: int
+    details: dict[str, Any]
+
+
+def get_max_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024  ## Linux reports KiB
+
+def measure(step: str, fn: Callable[[], Any], *, n_rows: int, n_cols: int,
+        get_details: Callable[[Any], dict[str, Any]] | None = None) -> tuple[StepResult, Any]:
+    tracemalloc.reset_peak()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    output = fn()
+    secs = time.perf_counter() - start
+    peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes
+    step_result = StepResult(n_rows=n_rows, n_cols=n_cols, step=step, secs=secs, peak_bytes=peak_bytes,
+        max_rss_bytes=get_max_rss_bytes(), details=get_details(output) if get_details else {})
+    print(f"{n_rows:>12,} rows {n_cols:>6,} cols  {step:<18} {secs:9.3f}s  peak {peak_bytes / 1024 ** 2:10.1f} MiB",
+        flush=True)
+    return step_result, output
+
+def import_modules():
+    """
+    Import everything up front so the first dataset's timings aren't mostly imports (e.g. matplotlib)
+    """
+    for module_name in ('sofastats.output.stats.anova', 'sofastats_app.ui.data', 'sofastats_app.ui.data_source',
+            'sofastats_app.ui.stats.anova_form'):
+        importlib.import_module(module_name)
+
+def copy_as_upload(csv_fpath: Path) -> Path:
+    """
+    Data.display_csv deletes an uploaded CSV once it has read it - so it only ever gets a copy of the synthetic CSV
+    (in the session's spool folder as if uploaded) and the original is kept for later steps and runs
+    """
+    from sofastats_app.ui.upload import COMPLETE_SUFFIX
+    from sofastats_app.ui.workspace import get_workspace
+    upload_fpath = get_workspace().spool_dpath / f"benchmark{COMPLETE_SUFFIX}"
+    shutil.copyfile(csv_fpath, upload_fpath)
+    return upload_fpath
+
+def load_csv(csv_fpath: Path):
+    from sofastats_app.ui.data import Data
+    async def consume():
+        async for _data_col in Data.display_csv(str(csv_fpath)):
+            pass
+    asyncio.run(consume())
+
+def apply_labels(yaml_bytes: bytes):
+    from sofastats_app.ui.data import Data
+    from sofastats_app.ui.workspace import get_workspace
+    data_labels_param = get_workspace().data_labels_param
+    old_labels = data_labels_param.value
+    Data.set_data_labels(yaml_bytes)
+    asyncio.run(Data.apply_data_labels(SimpleNamespace(old=old_labels, new=data_labels_param.value)))
+
+def get_anova_options() -> dict[str, int]:
+    from sofastats_app.ui.stats.anova_form import ANOVAForm
+    return {
+        'n_measure_options': len(ANOVAForm.get_measure_options()),
+        'n_grouping_options': len(ANOVAForm.get_grouping_options()),
+        'n_sport_values': len(ANOVAForm.get_value_options('sport')),
+    }
+
+def get_anova_data_source():
+    from sofastats_app.ui.conf import SharedKey
+    from sofastats_app.ui.data_source import get_data_source
+    from sofastats_app.ui.workspace import get_workspace
+    workspace = get_workspace()
+    return get_data_source(workspace.shared[SharedKey.DF_CSV], workspace.shared[SharedKey.DATASET_HASH],
+        user=workspace.session_id)
+
+def get_anova_html(data_source) -> str:
+    from sofastats.output.stats import anova
+    from sofastats_app.ui.workspace import get_workspace
+    anova_design = anova.AnovaDesign(
+        measure_field_name='height',
+        grouping_field_name='sport',
+        group_values=list(synthetic_data.SPORT_LABELS),
+        **data_source.to_design_kwargs(),
+        data_label_mappings=get_workspace().data_labels_param.value,
+        show_in_web_browser=False,
+    )
+    return anova_design.to_html_design().html_item_str
+
+def run_dataset(n_rows: int, n_cols: int, data_dpath: Path) -> list[StepResult]:
+    from sofastats_app.ui.conf import SharedKey
+    from sofastats_app.ui.dataset_cache import dataset_cache
+    from sofastats_app.ui.workspace import get_workspace
+    csv_fpath = data_dpath / f"synthetic_{n_rows}_{n_cols}.csv"
+    if not csv_fpath.exists():
+        print(f"Generating {csv_fpath.name} ...", flush=True)
+        synthetic_data.write_csv(csv_fpath, n_rows, n_cols)
+    csv_bytes = csv_fpath.stat().st_size
+    yaml_bytes = synthetic_data.write_data_labels(data_dpath / f"synthetic_{n_cols}.yaml", n_cols).read_bytes()
+    workspace = get_workspace()
+    workspace.release_data()  ## fresh start for every dataset
+    workspace.data_labels_param.value = {}
+    kwargs = {'n_rows': n_rows, 'n_cols': n_cols}
+    step_results = []
+    def get_load_details(_output) -> dict[str, Any]:
+        return {
+            'csv_bytes': csv_bytes,
+            'out_of_core': workspace.shared.get(SharedKey.SQL_DATASET) is not None,
+            'data_bytes': workspace.update_memory_usage(),
+        }
+    upload_fpath = copy_as_upload(csv_fpath)  ## copied before measuring so the copy isn't timed
+    step_result, _ = measure('load_csv', lambda: load_csv(upload_fpath), get_details=get_load_details, **kwargs)
+    step_results.append(step_result)
+    if dataset_cache.enabled and not step_result.details['out_of_core']:
+        upload_fpath = copy_as_upload(csv_fpath)
+        step_result, _ = measure('load_csv_cached', lambda: load_csv(upload_fpath), get_details=get_load_details,
+            **kwargs)
+        step_results.append(step_result)
+    step_result, _ = measure('apply_labels', lambda: apply_labels(yaml_bytes), **kwargs)
+    step_results.append(step_result)
+    step_result, _ = measure('anova_options', get_anova_options, get_details=lambda details: details, **kwargs)
+    step_results.append(step_result)
+    step_result, data_source = measure('anova_data_source', get_anova_data_source, **kwargs)
+    step_results.append(step_result)
+    step_result, _ = measure('anova_html', lambda: get_anova_html(data_source),
+        get_details=lambda html: {'html_chars': len(html)}, **kwargs)
+    step_results.append(step_result)
+    workspace.release_data()
+    return step_results
+
+def get_environment() -> dict[str, Any]:
+    versions = {}
+    for package_name in ('sofastats', 'sofastats_lib', 'panel', 'pandas', 'numpy', 'pyarrow'):
+        try:
+            versions[package_name] = version(package_name)
+        except PackageNotFoundError:
+            versions[package_name] = None
+    return {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'n_cpus': os.cpu_count(),
+        'versions': versions,
+    }
+
+def compare(step_results: list[StepResult], baseline_fpath: Path, *, tolerance: float) -> list[str]:
+    """
+    Returns:
+        a description of each regression (steps missing from either run are ignored)
+    """
+    baseline = json.loads(baseline_fpath.read_text(encoding='utf-8'))
+    baseline_results = {(result['n_rows'], result['n_cols'], result['step']): result
+        for result in baseline['results']}
+    regressions = []
+    print(f"\nCompared with {baseline_fpath} ({baseline['environment']['created_at']}):")
+    for step_result in step_results:
+        baseline_result = baseline_results.get((step_result.n_rows, step_result.n_cols, step_result.step))
+        if not baseline_result:
+            continue
+        label = f"{step_result.n_rows:,} rows x {step_result.n_cols:,} cols {step_result.step}"
+        secs_ratio = step_result.secs / baseline_result['secs'] if baseline_result['secs'] else 1
+        peak_ratio = step_result.peak_bytes / baseline_result['peak_bytes'] if baseline_result['peak_bytes'] else 1
+        print(f"  {label:<50} time x{secs_ratio:5.2f}  peak memory x{peak_ratio:5.2f}")
+        if secs_ratio > tolerance and step_result.secs >= MIN_SECS_TO_COMPARE:
+            regressions.append(f"{label} took {step_result.secs:.3f}s (was {baseline_result['secs']:.3f}s)")
+        if peak_ratio > tolerance and step_result.peak_bytes >= MIN_PEAK_BYTES_TO_COMPARE:
+            regressions.append(f"{label} peaked at {step_result.peak_bytes:,} bytes "
+                f"(was {baseline_result['peak_bytes']:,} bytes)")
+    return regressions
+
+def main(args: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the upload-to-report pipeline on synthetic data")
+    parser.add_argument('--preset', choices=PRESETS, default='quick')
+    parser.add_argument('--rows', type=int, nargs='+', help="row counts (overrides the preset)")
+    parser.add_argument('--cols', type=int, nargs='+', help="column counts - at least 4 (overrides the preset)")
+    parser.add_argument('--max-cells', type=int, default=DEFAULT_MAX_CELLS,
+        help=f"skip datasets with more rows x columns than this (default: {DEFAULT_MAX_CELLS:,})")
+    parser.add_argument('--data-folder', type=Path, default=Path(tempfile.gettempdir()) / 'sofastats_benchmark_data',
+        help="where synthetic CSVs are kept (reused by later runs)")
+    parser.add_argument('--output', type=Path,
+        help="results JSON (default: benchmark_results_<date and time>.json in the current folder)")
+    parser.add_argument('--compare', type=Path, help="earlier results JSON to check for regressions against")
+    parser.add_argument('--tolerance', type=float, default=1.25,
+        help="how many times slower or hungrier a step can get before it counts as a regression (default: 1.25)")
+    parsed_args = parser.parse_args(args)
+    rows = parsed_args.rows or PRESETS[parsed_args.preset]['rows']
+    cols = parsed_args.cols or PRESETS[parsed_args.preset]['cols']
+    if min(cols) < len(synthetic_data.BASE_COLS):
+        parser.error(f"--cols must be at least {len(synthetic_data.BASE_COLS)}")
+    ## keep everything this run does away from any real server's folders
+    run_dpath = Path(tempfile.mkdtemp(prefix='sofastats_benchmark_'))
+    os.environ['SOFASTATS_DATASET_CACHE_FOLDER'] = str(run_dpath / 'dataset_cache')
+    os.environ['SOFASTATS_UPLOAD_REGISTRY_FOLDER'] = str(run_dpath / 'upload_registry')
+    import_modules()
+    tracemalloc.start()
+    step_results = []
+    for n_rows in rows:
+        for n_cols in cols:
+            if n_rows * n_cols > parsed_args.max_cells:
+                print(f"Skipping {n_rows:,} rows x {n_cols:,} cols (more than {parsed_args.max_cells:,} cells)")
+                continue
+            step_results.extend(run_dataset(n_rows, n_cols, parsed_args.data_folder))
+    tracemalloc.stop()
+    output_fpath = parsed_args.output or Path(
+        f"benchmark_results_{datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')}.json")
+    output_fpath.write_text(json.dumps({
+        'environment': get_environment(),
+        'results': [asdict(step_result) for step_result in step_results],
+    }, indent=2), encoding='utf-8')
+    print(f"\nResults saved to {output_fpath}")
+    if parsed_args.compare:
+        regressions = compare(step_results, parsed_args.compare, tolerance=parsed_args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Synthetic datasets shaped like example_scripts/sports.csv with labels like store/var_labels.yaml - but any size.
+
+The first four columns are always those of sports.csv (name, country, sport, height) so anything that works
+on the example data (e.g. an ANOVA of height by sport) works on every synthetic dataset.
+Extra columns cycle through the kinds found in real extracts:
+
+    measure_N  float (some missing)
+    count_N    small int
+    group_N    int code 1-8 with value labels
+    browser_N  text category
+
+Values are random but seeded so the same size always gives the same file.
+"""
+from collections.abc import Iterator
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from ruamel.yaml import YAML
+
+STORE_LABELS_FPATH = Path(__file__).parent.parent / 'store' / 'var_labels.yaml'
+BASE_COLS = ('name', 'country', 'sport', 'height')
+EXTRA_COL_KINDS = ('measure', 'count', 'group', 'browser')
+FIRST_NAMES = ('Katherine', 'Mitchell', 'Aroha', 'Liam', 'Mei', 'Tane', 'Olivia', 'Ravi', 'Sofia', 'Hemi')
+LAST_NAMES = ('Gould', 'Morrison', 'Ngata', 'Smith', 'Chen', 'Patel', 'Walker', 'Brown', 'Wilson', 'Taylor')
+SPORT_LABELS = {1: 'Archery', 2: 'Badminton', 3: 'Basketball'}
+GROUP_LABELS = {1: 'Very Low', 2: 'Low', 3: 'Below Average', 4: 'Average',
+    5: 'Above Average', 6: 'High', 7: 'Very High', 8: 'Extreme'}
+BROWSERS = ('Chrome', 'Firefox', 'Safari', 'Edge', 'Opera')
+WRITE_CHUNK_ROWS = 250_000
+
+yaml = YAML(typ='safe')
+
+
+def get_col_names(n_cols: int) -> list[str]:
+    """
+    Args:
+        n_cols: at least 4 (the sports.csv columns)
+    """
+    col_names = list(BASE_COLS)
+    for i in range(n_cols - len(BASE_COLS)):
+        col_names.append(f"{EXTRA_COL_KINDS[i % len(EXTRA_COL_KINDS)]}_{i // len(EXTRA_COL_KINDS) + 1}")
+    return col_names
+
+def make_chunk(rng: np.random.Generator, n_rows: int, col_names: list[str]) -> pd.DataFrame:
+    names = np.char.add(np.char.add(rng.choice(FIRST_NAMES, n_rows), ' '), rng.choice(LAST_NAMES, n_rows))
+    sport = rng.integers(1, 4, n_rows)
+    cols = {
+        'name': names,
+        'country': rng.integers(1, 5, n_rows),
+        'sport': sport,
+        'height': np.round(rng.normal(1.6 + 0.1 * sport, 0.1, n_rows), 2),  ## differs by sport so the ANOVA finds something
+    }
+    for col_name in col_names[len(BASE_COLS):]:
+        kind = col_name.rsplit('_', 1)[0]
+        if kind == 'measure':
+            vals = np.round(rng.normal(50, 15, n_rows), 3)
+            vals[rng.random(n_rows) < 0.02] = np.nan
+        elif kind == 'count':
+            vals = rng.poisson(3, n_rows)
+        elif kind == 'group':
+            vals = rng.integers(1, 9, n_rows)
+        else:
+            vals = rng.choice(BROWSERS, n_rows)
+        cols[col_name] = vals
+    return pd.DataFrame(cols, columns=col_names)
+
+def iter_chunks(n_rows: int, n_cols: int, *, seed: int = 0) -> Iterator[pd.DataFrame]:
+    rng = np.random.default_rng(seed)
+    col_names = get_col_names(n_cols)
+    n_rows_left = n_rows
+    while n_rows_left > 0:
+        chunk_rows = min(WRITE_CHUNK_ROWS, n_rows_left)
+        yield make_chunk(rng, chunk_rows, col_names)
+        n_rows_left -= chunk_rows
+
+def write_csv(fpath: Path, n_rows: int, n_cols: int, *, seed: int = 0) -> Path:
+    """
+    Written a chunk at a time so even the largest datasets never have to fit in memory
+    """
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    with open(fpath, 'w', newline='', encoding='utf-8') as csv_file:
+        for i, df_chunk in enumerate(iter_chunks(n_rows, n_cols, seed=seed)):
+            df_chunk.to_csv(csv_file, index=False, header=(i == 0))
+    return fpath
+
+def get_data_labels(n_cols: int) -> dict:
+    """
+    Same structure as store/var_labels.yaml (country labels are taken from it)
+    """
+    store_labels = yaml.load(STORE_LABELS_FPATH) or {}
+    data_labels = {
+        'country': store_labels.get('country', {'variable_label': 'Country'}),
+        'sport': {'variable_label': 'Sport', 'value_labels': dict(SPORT_LABELS)},
+        'height': {'variable_label': 'Height (m)'},
+    }
+    for col_name in get_col_names(n_cols)[len(BASE_COLS):]:
+        kind, n = col_name.rsplit('_', 1)
+        col_labels = {'variable_label': f"{kind.title()} {n}"}
+        if kind == 'group':
+            col_labels['value_labels'] = dict(GROUP_LABELS)
+        elif kind == 'browser':
+            col_labels['value_labels'] = {'Chrome': 'Google Chrome'}  ## as in store/var_labels.yaml
+        data_labels[col_name] = col_labels
+    return data_labels
+
+def write_data_labels(fpath: Path, n_cols: int) -> Path:
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    with open(fpath, 'w', encoding='utf-8') as yaml_file:
+        yaml.dump(get_data_labels(n_cols), yaml_file)
+    return fpath
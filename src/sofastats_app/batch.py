@@ -0,0 +1,184 @@
+"""
+Run saved analysis designs without the GUI e.g. to regenerate reports overnight.
+
+    sofastats-batch designs.yaml [--workers 8] [--output-folder reports]
+
+The designs file (YAML, or JSON which is also valid YAML) looks like:
+
+    defaults:  ## optional - applied to every design unless the design says otherwise
+      csv_file_path: sports.csv
+      data_labels_yaml_file_path: sports_labels.yaml
+    designs:
+      - test: ANOVA
+        measure_field_name: height
+        grouping_field_name: sport
+        group_values: [1, 2, 3]
+      - test: ANOVA
+        output_title: Height by country
+        measure_field_name: height
+        grouping_field_name: country
+        group_values: [1, 2, 3, 4]
+
+Apart from test, the keys are the arguments of the design class e.g. AnovaDesign.
+Relative paths are relative to the designs file.
+
+Designs run in parallel in a pool of processes (one per CPU core by default).
+Each process reads a CSV into its own SQLite database the first time one of its designs needs it
+and reuses it for any other designs on the same data.
+Reports are written to DEFAULT_OUTPUT_FOLDER unless another folder is given.
+With --bundle-assets the CSS and scripts common to every report are written once to a shared assets folder
+instead of into each report (see ui/report_bundle.py) and --gzip writes .html.gz files.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import re
+import sqlite3 as sqlite
+import sys
+import time
+from typing import Any
+
+import pandas as pd
+from ruamel.yaml import YAML
+
+from sofastats.conf.main import DEFAULT_OUTPUT_FOLDER
+from sofastats.output.stats import anova
+
+from sofastats_app.ui.conf import OUTPUT_BUNDLE_ASSETS, OUTPUT_GZIP
+from sofastats_app.ui.report_bundle import write_report
+
+DESIGN_CLASSES = {
+    'ANOVA': anova.AnovaDesign,
+}
+PATH_KEYS = ('csv_file_path', 'data_labels_yaml_file_path')
+
+yaml = YAML(typ='safe')
+
+
+@dataclass(frozen=True)
+class DesignResult:
+    name: str
+    output_fpath: Path | None
+    secs: float
+    error: str | None = None
+
+
+_worker_tables: dict[str, tuple[sqlite.Connection, str]] = {}  ## per worker process: CSV path -> (connection, table name)
+
+def _get_worker_data_source(csv_fpath: str, csv_separator: str) -> dict[str, Any]:
+    """
+    Read each CSV once per worker process rather than once per design
+    """
+    if csv_fpath not in _worker_tables:
+        con = sqlite.connect(':memory:')
+        table_name = f"batch_{len(_worker_tables)}"
+        pd.read_csv(csv_fpath, sep=csv_separator).to_sql(table_name, con, index=False)
+        _worker_tables[csv_fpath] = (con, table_name)
+    con, table_name = _worker_tables[csv_fpath]
+    return {'cur': con.cursor(), 'database_engine_name': 'sqlite', 'source_table_name': table_name}
+
+def run_design(name: str, test: str, design_kwargs: dict[str, Any], output_fpath: Path, *,
+        bundle_assets=False, gzip_output=False) -> DesignResult:
+    start = time.perf_counter()
+    try:
+        design_kwargs = dict(design_kwargs)
+        csv_fpath = design_kwargs.pop('csv_file_path', None)
+        csv_separator = design_kwargs.pop('csv_separator', ',')
+        if csv_fpath:
+            design_kwargs.update(_get_worker_data_source(csv_fpath, csv_separator))
+        output_title = design_kwargs.pop('output_title', None) or name
+        design = DESIGN_CLASSES[test](**design_kwargs, output_file_path=output_fpath, show_in_web_browser=False)
+        html = design.to_html_design().to_standalone_html(output_title)
+        output_fpath = write_report(html, output_fpath, bundle_assets=bundle_assets, gzip_output=gzip_output)
+    except Exception as e:
+        error = (str(e).strip().splitlines() or [type(e).__name__])[0]  ## SQL errors append the whole query
+        return DesignResult(name=name, output_fpath=None, secs=time.perf_counter() - start, error=error)
+    return DesignResult(name=name, output_fpath=output_fpath, secs=time.perf_counter() - start)
+
+def get_design_name(test: str, design_kwargs: dict[str, Any]) -> str:
+    if design_kwargs.get('output_title'):
+        return design_kwargs['output_title']
+    measure = design_kwargs.get('measure_field_name')
+    grouping = design_kwargs.get('grouping_field_name')
+    return f"{test} of {measure} by {grouping}" if measure and grouping else test
+
+def load_designs(designs_fpath: Path) -> list[tuple[str, dict[str, Any]]]:
+    """
+    Returns:
+        (test, design kwargs) for each design with defaults applied and relative paths made absolute
+    """
+    content = yaml.load(designs_fpath) or {}
+    if isinstance(content, list):
+        content = {'designs': content}
+    defaults = content.get('defaults') or {}
+    designs = []
+    for i, design in enumerate(content.get('designs') or [], 1):
+        design_kwargs = defaults | design
+        test = design_kwargs.pop('test', None)
+        if test not in DESIGN_CLASSES:
+            raise ValueError(f"Design {i} has test '{test}' - expected one of {', '.join(DESIGN_CLASSES)}")
+        for path_key in PATH_KEYS:
+            if design_kwargs.get(path_key):
+                design_kwargs[path_key] = str((designs_fpath.parent / design_kwargs[path_key]).resolve())
+        designs.append((test, design_kwargs))
+    return designs
+
+def get_output_fpath(output_dpath: Path, design_n: int, name: str) -> Path:
+    safe_name = re.sub(r'[^\w\- ]+', '_', name).strip() or 'report'
+    return output_dpath / f"{design_n:03} {safe_name}.html"
+
+def run_designs(designs: list[tuple[str, dict[str, Any]]], *, output_dpath: Path,
+        n_workers: int | None = None, bundle_assets=False, gzip_output=False) -> list[DesignResult]:
+    output_dpath.mkdir(parents=True, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = []
+        for design_n, (test, design_kwargs) in enumerate(designs, 1):
+            name = get_design_name(test, design_kwargs)
+            futures.append(executor.submit(run_design, name, test, design_kwargs,
+                get_output_fpath(output_dpath, design_n, name),
+                bundle_assets=bundle_assets, gzip_output=gzip_output))
+        for future in as_completed(futures):
+            result = future.result()
+            status = f"FAILED ({result.error})" if result.error else f"-> {result.output_fpath}"
+            print(f"{result.secs:7.2f}s  {result.name} {status}", flush=True)
+            results.append(result)
+    return results
+
+def print_timing_summary(results: list[DesignResult], *, wall_secs: float, n_workers: int):
+    n_failed = sum(1 for result in results if result.error)
+    design_secs = sum(result.secs for result in results)
+    print("")
+    print(f"Ran {len(results):,} designs ({n_failed:,} failed) on {n_workers} worker processes "
+        f"in {wall_secs:.2f}s")
+    if results:
+        slowest = max(results, key=lambda result: result.secs)
+        print(f"Time across all designs {design_secs:.2f}s "
+            f"(speed-up {design_secs / wall_secs:.1f}x; mean {design_secs / len(results):.2f}s; "
+            f"slowest {slowest.secs:.2f}s '{slowest.name}')")
+
+def main(args: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog='sofastats-batch',
+        description="Run analysis designs from a YAML or JSON file and save the HTML reports")
+    parser.add_argument('designs_file', type=Path)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+        help="number of worker processes (default: one per CPU core)")
+    parser.add_argument('--output-folder', type=Path, default=DEFAULT_OUTPUT_FOLDER,
+        help=f"where to save reports (default: {DEFAULT_OUTPUT_FOLDER})")
+    parser.add_argument('--bundle-assets', action=argparse.BooleanOptionalAction, default=OUTPUT_BUNDLE_ASSETS,
+        help="link every report to one shared copy of the common CSS and scripts")
+    parser.add_argument('--gzip', action=argparse.BooleanOptionalAction, default=OUTPUT_GZIP,
+        help="write reports as .html.gz")
+    parsed_args = parser.parse_args(args)
+    designs = load_designs(parsed_args.designs_file)
+    n_workers = max(1, min(parsed_args.workers or 1, len(designs) or 1))
+    start = time.perf_counter()
+    results = run_designs(designs, output_dpath=parsed_args.output_folder, n_workers=n_workers,
+        bundle_assets=parsed_args.bundle_assets, gzip_output=parsed_args.gzip)
+    print_timing_summary(results, wall_secs=time.perf_counter() - start, n_workers=n_workers)
+    return 1 if any(result.error for result in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
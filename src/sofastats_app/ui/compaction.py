@@ -0,0 +1,103 @@
+"""
+Shrink a freshly loaded data frame.
+
+pd.read_csv gives int64, float64, and one Python string per cell, which is very wasteful for typical survey data
+e.g. small coded integers like country or agegroup, and low-cardinality strings like browser.
+So integers are downcast, and labelled or low-cardinality columns become categoricals.
+Floats are left alone - they're measures and we don't want to lose precision.
+
+Large CSVs are read and compacted a chunk at a time (see concat_compacted_chunks)
+so we never hold a full uncompacted copy of the data.
+"""
+from collections.abc import Mapping
+import hashlib
+import json
+from typing import Any
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+MAX_CATEGORY_FRACTION = 0.5  ## only worth making a categorical if values repeat a fair bit
+
+
+def _get_compacted_series(series: pd.Series, *, is_labelled: bool) -> pd.Series:
+    if pd.api.types.is_bool_dtype(series) or isinstance(series.dtype, pd.CategoricalDtype):
+        return series
+    if pd.api.types.is_integer_dtype(series):
+        downcast = pd.to_numeric(series, downcast='integer')
+        return downcast.astype('category') if is_labelled else downcast
+    if pd.api.types.is_float_dtype(series):
+        return series
+    ## strings (or anything else)
+    n_distinct = series.nunique(dropna=True)
+    if is_labelled or n_distinct <= len(series) * MAX_CATEGORY_FRACTION:
+        return series.astype('category')
+    return series
+
+def get_compaction_key(data_labels: Mapping[str, Any] | None) -> str:
+    """
+    Compaction only depends on which columns have value labels so data compacted for one set of labels
+    needs no compacting again for any other set labelling the same columns
+    """
+    labelled_cols = sorted(str(col) for col, col_labels in (data_labels or {}).items()
+        if (col_labels or {}).get('value_labels'))
+    return hashlib.sha256(json.dumps(labelled_cols).encode('utf-8')).hexdigest()
+
+def compact_df(df: pd.DataFrame, data_labels: Mapping[str, Any] | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Returns:
+        compacted data frame, and a report with the bytes used by each column before and after
+    """
+    data_labels = data_labels or {}
+    compacted_cols = {}
+    report_rows = []
+    for col in df.columns:
+        series = df[col]
+        is_labelled = bool((data_labels.get(col) or {}).get('value_labels'))
+        compacted_series = _get_compacted_series(series, is_labelled=is_labelled)
+        compacted_cols[col] = compacted_series
+        report_rows.append({
+            'column': col,
+            'dtype_before': str(series.dtype),
+            'dtype_after': str(compacted_series.dtype),
+            'bytes_before': int(series.memory_usage(index=False, deep=True)),
+            'bytes_after': int(compacted_series.memory_usage(index=False, deep=True)),
+        })
+    compacted_df = pd.DataFrame(compacted_cols, index=df.index, copy=False)  ## unchanged columns not copied (e.g. memory-mapped)
+    report = pd.DataFrame(report_rows)
+    return compacted_df, report
+
+def _get_concatenated_series(chunk_series: list[pd.Series], *, is_labelled: bool) -> pd.Series:
+    if all(isinstance(series.dtype, pd.CategoricalDtype) for series in chunk_series):
+        try:
+            return pd.Series(union_categoricals(chunk_series), name=chunk_series[0].name)
+        except TypeError:  ## e.g. int categories in one chunk and float in another (once a missing value turned up)
+            pass
+    series = pd.concat(chunk_series, ignore_index=True)
+    if isinstance(series.dtype, pd.CategoricalDtype) or series.dtype == np.dtype(object):
+        ## mixed categorical and non-categorical chunks end up as plain Python objects - compact again as a whole
+        series = _get_compacted_series(series.astype(object), is_labelled=is_labelled)
+    return series
+
+def concat_compacted_chunks(df_chunks: list[pd.DataFrame], data_labels: Mapping[str, Any] | None = None) -> pd.DataFrame:
+    """
+    Each chunk was compacted separately so categoricals may not share the same categories,
+    and integers may have been downcast to different sizes.
+    Plain pd.concat would silently turn mismatched categoricals back into Python objects.
+
+    The chunks list is emptied as we go so the memory can be released.
+    """
+    data_labels = data_labels or {}
+    if not df_chunks:
+        return pd.DataFrame()
+    cols = list(df_chunks[0].columns)
+    concatenated_cols = {}
+    for col in cols:
+        is_labelled = bool((data_labels.get(col) or {}).get('value_labels'))
+        concatenated_cols[col] = _get_concatenated_series([df_chunk[col] for df_chunk in df_chunks],
+            is_labelled=is_labelled)
+        for df_chunk in df_chunks:
+            del df_chunk[col]  ## release each chunk's column as soon as it has been merged
+    df_chunks.clear()
+    return pd.DataFrame(concatenated_cols)
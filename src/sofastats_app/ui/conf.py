@@ -1,7 +1,84 @@
 from enum import StrEnum
+import os
+from pathlib import Path
+import tempfile
 
 SIDEBAR_WIDTH = 600
 
+## panel serve worker processes (0 means one per CPU core) and threads per process for callbacks (None - no pool).
+## With more than one process, anything handled outside a session's own process (uploads, reports, datasets)
+## goes through the shared folders below rather than process memory.
+SERVER_NUM_PROCS = int(os.environ.get('SOFASTATS_NUM_PROCS', 1))
+SERVER_NUM_THREADS = int(os.environ['SOFASTATS_NUM_THREADS']) if os.environ.get('SOFASTATS_NUM_THREADS') else None
+SERVER_PORT = int(os.environ.get('SOFASTATS_PORT', 5006))
+## the browser tab is opened as soon as the server answers (or after this long regardless)
+SERVER_READY_TIMEOUT_SECS = float(os.environ.get('SOFASTATS_SERVER_READY_TIMEOUT_SECS', 60))
+
+## parsed uploads are cached by content so re-uploading the same CSV is near instant
+DATASET_CACHE_FOLDER = Path(os.environ.get('SOFASTATS_DATASET_CACHE_FOLDER',
+    Path(tempfile.gettempdir()) / 'sofastats_dataset_cache'))
+DATASET_CACHE_MAX_BYTES = int(os.environ.get('SOFASTATS_DATASET_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+## list stored datasets so they can be reopened without uploading them again. Off by default because every stored
+## dataset is listed to every session - only switch on for a single analyst (or a team who may all see each other's data)
+SHOW_STORED_DATASETS = os.environ.get('SOFASTATS_SHOW_STORED_DATASETS', 'false').lower() in ('true', '1', 'yes')
+
+## uploads are sent from the browser in chunks of this size (a dropped connection only loses the current chunk)
+UPLOAD_CHUNK_BYTES = int(os.environ.get('SOFASTATS_UPLOAD_CHUNK_BYTES', 8 * 1024 ** 2))
+UPLOAD_URL_PREFIX = '/sofastats_upload'
+## most a session may have uploaded (complete or partial) at once - anything bigger is refused
+UPLOAD_MAX_BYTES = int(os.environ.get('SOFASTATS_UPLOAD_MAX_BYTES', 16 * 1024 ** 3))
+## where server processes find each other's upload folders - see upload.py
+UPLOAD_REGISTRY_FOLDER = Path(os.environ.get('SOFASTATS_UPLOAD_REGISTRY_FOLDER',
+    Path(tempfile.gettempdir()) / 'sofastats_upload_registry'))
+
+## reports are shown from content-hashed URLs (see reports.py) - least recently published dropped beyond this
+REPORT_STORE_MAX_BYTES = int(os.environ.get('SOFASTATS_REPORT_STORE_MAX_BYTES', 256 * 1024 ** 2))
+REPORT_URL_PREFIX = '/sofastats_report'
+## published reports are also written here so any server process can serve them
+REPORT_STORE_FOLDER = Path(os.environ.get('SOFASTATS_REPORT_STORE_FOLDER',
+    Path(tempfile.gettempdir()) / 'sofastats_report_store'))
+
+## saved reports are standalone by default (e.g. so they can be emailed) - optionally link to shared CSS and script
+## files instead and / or write them gzipped (see report_bundle.py)
+OUTPUT_BUNDLE_ASSETS = os.environ.get('SOFASTATS_OUTPUT_BUNDLE_ASSETS', 'false').lower() in ('true', '1', 'yes')
+OUTPUT_GZIP = os.environ.get('SOFASTATS_OUTPUT_GZIP', 'false').lower() in ('true', '1', 'yes')
+
+## large CSVs are read (and compacted and profiled) this many rows at a time so the first rows can be shown early
+CSV_CHUNK_ROWS = int(os.environ.get('SOFASTATS_CSV_CHUNK_ROWS', 100_000))
+
+## CSVs at least this big are streamed straight into SQLite and queried from there instead of being held in memory
+OUT_OF_CORE_MIN_BYTES = int(os.environ.get('SOFASTATS_OUT_OF_CORE_MIN_BYTES', 2 * 1024 ** 3))
+
+## downcast integers and make labelled / low-cardinality columns categorical when loading data - see compaction.py
+COMPACT_DATA = os.environ.get('SOFASTATS_COMPACT_DATA', 'true').lower() in ('true', '1', 'yes')
+
+## heavy stats run off the Bokeh event loop (shared by every session) in a pool of this many threads
+ANALYSIS_WORKERS = int(os.environ.get('SOFASTATS_ANALYSIS_WORKERS', min(4, os.cpu_count() or 1)))
+
+## rendered results are cached so flipping back to an earlier design is instant (optionally persisted to disk)
+## - least recently used dropped beyond this many bytes of HTML (a report with charts is often 100 KB or more)
+RESULTS_CACHE_MAX_BYTES = int(os.environ.get('SOFASTATS_RESULTS_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+RESULTS_CACHE_FOLDER = (Path(os.environ['SOFASTATS_RESULTS_CACHE_FOLDER'])
+    if os.environ.get('SOFASTATS_RESULTS_CACHE_FOLDER') else None)
+
+## every result is kept (and indexed) so earlier runs can be reopened - oldest dropped beyond any of these limits
+RESULTS_HISTORY_FOLDER = Path(os.environ.get('SOFASTATS_RESULTS_HISTORY_FOLDER',
+    Path(tempfile.gettempdir()) / 'sofastats_results_history'))
+RESULTS_HISTORY_MAX_ITEMS = int(os.environ.get('SOFASTATS_RESULTS_HISTORY_MAX_ITEMS', 1_000))
+RESULTS_HISTORY_MAX_BYTES = int(os.environ.get('SOFASTATS_RESULTS_HISTORY_MAX_BYTES', 1024 ** 3))
+RESULTS_HISTORY_MAX_AGE_DAYS = float(os.environ.get('SOFASTATS_RESULTS_HISTORY_MAX_AGE_DAYS', 30))
+
+## per-group counts, sums etc. shared by every test of the same measure and grouping - see stats/group_stats.py
+GROUP_STATS_CACHE_MAX_ITEMS = int(os.environ.get('SOFASTATS_GROUP_STATS_CACHE_MAX_ITEMS', 500))
+GROUP_SORTED_VALUES_CACHE_MAX_BYTES = int(os.environ.get('SOFASTATS_GROUP_SORTED_VALUES_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+
+## log the bytes of Bokeh document patches each interaction sends to the browser - see patch_monitor.py
+DEBUG_PATCH_BYTES = os.environ.get('SOFASTATS_DEBUG_PATCH_BYTES', 'false').lower() in ('true', '1', 'yes')
+
+## drop an idle session's data (but not the session itself) after this long - checked no more often than the sweep
+SESSION_IDLE_TIMEOUT_SECS = float(os.environ.get('SOFASTATS_SESSION_IDLE_TIMEOUT_SECS', 30 * 60))
+SESSION_IDLE_SWEEP_SECS = float(os.environ.get('SOFASTATS_SESSION_IDLE_SWEEP_SECS', 60))
+
 class Colour(StrEnum):
     BLUE_MID = '#0072b5'
 
@@ -38,10 +115,20 @@ class OrdinalVsCategorical(StrEnum):
 class SharedKey(StrEnum):
     ACTIVE_STATS_CHOOSER_MODAL = 'active_stats_chooser_modal'  ## so I can hide it from anywhere
     ACTIVE_STATS_CONFIG_MODAL = 'active_stats_config_modal'
-    CSV_FPATH = 'csv_fpath'
+    CHOOSER_BTN_OPEN_STATS_CONFIG = 'chooser_btn_open_stats_config'
+    CHOOSER_PROGRESS = 'chooser_progress'
+    CHOOSER_STATS_CONFIG_MODALS = 'chooser_stats_config_modals'  ## built as first opened - see stats_config.py
+    CSV_LOAD_ID = 'csv_load_id'  ## lets a CSV still being read notice it has been replaced by a newer upload
     CURRENT_OUTPUT_FPATH = 'current_output_fpath'
+    SAVED_OUTPUT_FPATH = 'saved_output_fpath'  ## may differ from CURRENT_OUTPUT_FPATH e.g. if gzipped
+    DATA_PREVIEW = 'data_preview'
+    DATASET_NAME = 'dataset_name'  ## e.g. original CSV file name - used when listing stored datasets
+    DATASET_HASH = 'dataset_hash'  ## content hash of the uploaded CSV - identifies the dataset wherever it came from
+    DATASET_PROFILE = 'dataset_profile'  ## dtypes, distinct values etc. worked out once on upload - see profile.py
     DF_CSV = 'df_csv'
+    RECOMMENDED_STATS_TEST = 'recommended_stats_test'  ## by the stats chooser
     SERVABLES = 'servables'
+    SQL_DATASET = 'sql_dataset'  ## only for datasets too big to hold in memory - see sql_dataset.py
 
 class StatsOption(StrEnum):
     ANOVA = 'ANOVA'
@@ -1,3 +1,5 @@
+import asyncio
+from dataclasses import dataclass
 from io import BytesIO
 from pathlib import Path
 
@@ -5,20 +7,46 @@ import pandas as pd
 import panel as pn
 from ruamel.yaml import YAML
 
-from sofastats_app.ui.conf import SIDEBAR_WIDTH, Colour, SharedKey
-from sofastats_app.ui.state import data_labels_param, got_data_param, shared
+from sofastats_app import logger
+from sofastats_app.ui.compaction import compact_df, concat_compacted_chunks, get_compaction_key
+from sofastats_app.ui.conf import (COMPACT_DATA, CSV_CHUNK_ROWS, OUT_OF_CORE_MIN_BYTES, SHOW_STORED_DATASETS,
+    SIDEBAR_WIDTH, UPLOAD_URL_PREFIX, Colour, SharedKey)
+from sofastats_app.ui.data_preview import BaseDataPreview, DataPreview, SqlDataPreview
+from sofastats_app.ui.data_source import TableIngestion, release_data_source
+from sofastats_app.ui.dataset_cache import dataset_cache, get_content_hash
+from sofastats_app.ui.profile import DatasetProfile, DatasetProfileBuilder
+from sofastats_app.ui.sql_dataset import SqlDataset
+from sofastats_app.ui.state import Text
+from sofastats_app.ui.upload import ChunkedFileUpload, get_uploaded_fpath, remove_other_uploads
+from sofastats_app.ui.utils import get_app_url, get_relabelled_cols
+from sofastats_app.ui.workspace import get_workspace
 
 yaml = YAML(typ='safe')  ## default, if not specified, is 'rt' (round-trip)
 
+TABLE_WIDTH = SIDEBAR_WIDTH - 20  ## shrink a little so content not truncated
+
 pn.extension('tabulator')
 
-shared[SharedKey.DF_CSV] = pd.DataFrame()
+
+@dataclass(frozen=True)
+class LoadedCsv:
+    """
+    Args:
+        df: empty if out-of-core
+        sql_dataset: only if out-of-core
+    """
+    df: pd.DataFrame
+    sql_dataset: SqlDataset | None
+    profile: DatasetProfile
+    preview: BaseDataPreview
+    size_msg: str
 
 
 class Data:
 
     @staticmethod
     def set_data_labels(yaml_bytes):
+        data_labels_param = get_workspace().data_labels_param
         try:
             data_label_mappings = yaml.load(BytesIO(yaml_bytes)) if yaml_bytes else {}
             data_labels_param.value = data_label_mappings
@@ -26,46 +54,313 @@ class Data:
             data_labels_param.value = {}
 
     @staticmethod
-    def display_csv(csv_bytes, data_labels_value):
-        if csv_bytes:
-            got_data_param.value = True
-            df = pd.read_csv(BytesIO(csv_bytes))
-            shared[SharedKey.DF_CSV] = df.copy()  ## so we can decide what options to display in config forms
-            cwd = Path(__file__).parent
-            csv_fpath = cwd / 'data.csv'
-            with open(csv_fpath, 'wb') as f:
-                f.write(csv_bytes)
-            shared[SharedKey.CSV_FPATH] = csv_fpath  ## so we can supply csv path to stats calc (TODO: enable passing of actual CSV as an option alongside dbapi2 cursor or csv_fpath)
-            ## apply any labels
-            col_name_vals = []
-            for i, col in enumerate(df.columns):
-                col_name_vals.append((col, df[col]))
-                if col in data_labels_value.keys():
-                    val_mapping = data_labels_value.get(col, {}).get('value_labels', {})
-                    if val_mapping:
-                        col_name_vals.append((f"{col}<br>(labelled)", df[col].apply(lambda num_val: val_mapping.get(num_val, num_val))))
-            df_labelled = pd.DataFrame(dict(col_name_vals))
-            table_width = SIDEBAR_WIDTH - 20  ## shrink a little so content not truncated
-            table_df = pn.widgets.Tabulator(df_labelled, page_size=10, width=table_width, disabled=True)
-            table_df.value = df_labelled
-            return table_df
+    def get_data_size_msg(df: pd.DataFrame, bytes_before: dict[str, int]) -> str:
+        """
+        Args:
+            bytes_before: bytes used by each column as originally parsed (before any compaction)
+        """
+        bytes_after = {col: int(df[col].memory_usage(index=False, deep=True)) for col in df.columns}
+        msg = (f"Data uses {sum(bytes_after.values()):,} bytes "
+            f"(compacted from {sum(bytes_before.values()):,} bytes)")
+        for col in df.columns:
+            if bytes_after[col] != bytes_before.get(col):
+                msg += f"<br>{col}: {df[col].dtype} ({bytes_before.get(col, 0):,} → {bytes_after[col]:,} bytes)"
+        logger.info(msg.replace('<br>', '; '))
+        return msg
+
+    @staticmethod
+    def read_csv_chunk(reader, profile_builder: DatasetProfileBuilder, data_labels, bytes_before: dict[str, int]):
+        """
+        Parse, compact, and profile the next chunk. Run in a worker thread so the session stays responsive.
+
+        Returns:
+            the compacted chunk, or None if there are no more rows
+        """
+        df_chunk = next(reader, None)
+        if df_chunk is None:
+            return None
+        if COMPACT_DATA:
+            df_chunk, compaction_report = compact_df(df_chunk, data_labels)
+            for row in compaction_report.itertuples():
+                bytes_before[row.column] = bytes_before.get(row.column, 0) + row.bytes_before
         else:
+            for col in df_chunk.columns:
+                bytes_before[col] = bytes_before.get(col, 0) + int(df_chunk[col].memory_usage(index=False, deep=True))
+        profile_builder.add_chunk(df_chunk)
+        return df_chunk
+
+    @staticmethod
+    def prepare_cached_df(df: pd.DataFrame, content_hash: str,
+            data_labels) -> tuple[pd.DataFrame, dict[str, int], DatasetProfile]:
+        """
+        Compact again only if the labelled columns differ from those the stored data was compacted for -
+        otherwise the memory-mapped columns are used as they are (compacting copies). Run in a worker thread.
+
+        Returns:
+            data frame, bytes used by each column as stored, and profile
+        """
+        bytes_before = {col: int(df[col].memory_usage(index=False, deep=True)) for col in df.columns}
+        if COMPACT_DATA and dataset_cache.get_compaction_key(content_hash) != get_compaction_key(data_labels):
+            df, _compaction_report = compact_df(df, data_labels)
+        return df, bytes_before, DatasetProfile.from_df(df)
+
+    @staticmethod
+    def store_csv_chunk(reader, profile_builder: DatasetProfileBuilder, table_ingestion: TableIngestion):
+        """
+        Parse and profile the next chunk then append it to SQLite. Run in a worker thread.
+
+        Returns:
+            the chunk, or None if there are no more rows
+        """
+        df_chunk = next(reader, None)
+        if df_chunk is None:
             return None
+        profile_builder.add_chunk(df_chunk)
+        table_ingestion.append(df_chunk)
+        return df_chunk
+
+    @staticmethod
+    async def load_in_memory(csv_fpath: str | None, content_hash: str, *,
+            load_id: object, loading_msg: pn.pane.Markdown, data_col: pn.Column) -> LoadedCsv | None:
+        """
+        Args:
+            csv_fpath: None if a stored dataset was selected (so there is only the dataset cache to read from)
+
+        Returns:
+            None if a different CSV was uploaded before this one finished loading (or a stored dataset has gone)
+        """
+        workspace = get_workspace()
+        shared = workspace.shared
+        data_labels = workspace.data_labels_param.value
+        data_preview = None
+        df = await asyncio.to_thread(dataset_cache.get, content_hash)
+        if df is None and not csv_fpath:  ## evicted since it was listed
+            loading_msg.object = "That dataset is no longer stored - please select the CSV again"
+            return None
+        if df is None:
+            profile_builder = DatasetProfileBuilder()
+            bytes_before = {}
+            df_chunks = []
+            csv_size = Path(csv_fpath).stat().st_size
+            with open(csv_fpath, 'rb') as csv_file, pd.read_csv(csv_file, chunksize=CSV_CHUNK_ROWS) as reader:
+                while True:
+                    df_chunk = await asyncio.to_thread(
+                        Data.read_csv_chunk, reader, profile_builder, data_labels, bytes_before)
+                    if shared.get(SharedKey.CSV_LOAD_ID) is not load_id:
+                        return None  ## a different CSV has been uploaded since - let it take over
+                    if df_chunk is None:
+                        break
+                    df_chunks.append(df_chunk)
+                    if data_preview is None:  ## first chunk - show it straight away
+                        data_preview = DataPreview(df_chunk, data_labels, width=TABLE_WIDTH)
+                        shared[SharedKey.DATA_PREVIEW] = data_preview  ## so labels applied while still loading show
+                        data_col.insert(0, data_preview.ui())
+                    pct_read = csv_file.tell() / csv_size
+                    loading_msg.object = f"Reading CSV ... {profile_builder.n_rows:,} rows so far ({pct_read:.0%})"
+            df = await asyncio.to_thread(concat_compacted_chunks, df_chunks, data_labels)
+            dataset_profile = await asyncio.to_thread(profile_builder.build,
+                get_n_distinct=lambda col: df[col].nunique(dropna=True), dtypes=df.dtypes.to_dict())
+            await asyncio.to_thread(dataset_cache.put, content_hash, df, name=shared.get(SharedKey.DATASET_NAME),
+                compaction_key=get_compaction_key(data_labels) if COMPACT_DATA else None)
+        else:
+            df, bytes_before, dataset_profile = await asyncio.to_thread(
+                Data.prepare_cached_df, df, content_hash, data_labels)
+        logger.info(f"Dataset cache: {dataset_cache.stats}")
+        if data_preview is None:
+            data_preview = DataPreview(df, workspace.data_labels_param.value, width=TABLE_WIDTH)
+            data_col.insert(0, data_preview.ui())
+        else:
+            await data_preview.set_df(df)
+        data_size_msg = (await asyncio.to_thread(Data.get_data_size_msg, df, bytes_before) if COMPACT_DATA
+            else f"Data uses {sum(bytes_before.values()):,} bytes")
+        return LoadedCsv(df=df, sql_dataset=None, profile=dataset_profile, preview=data_preview,
+            size_msg=data_size_msg)
+
+    @staticmethod
+    async def load_out_of_core(csv_fpath: str, content_hash: str, *,
+            load_id: object, loading_msg: pn.pane.Markdown, data_col: pn.Column) -> LoadedCsv | None:
+        """
+        Stream the CSV straight into SQLite - only one chunk is ever in memory. See sql_dataset.py
+
+        Returns:
+            None if a different CSV was uploaded before this one finished loading
+        """
+        workspace = get_workspace()
+        shared = workspace.shared
+        profile_builder = DatasetProfileBuilder()
+        table_ingestion = TableIngestion(content_hash, user=workspace.session_id)
+        first_chunk_preview = None
+        csv_size = Path(csv_fpath).stat().st_size
+        is_finished = False
+        try:
+            with open(csv_fpath, 'rb') as csv_file, pd.read_csv(csv_file, chunksize=CSV_CHUNK_ROWS) as reader:
+                while True:
+                    df_chunk = await asyncio.to_thread(Data.store_csv_chunk, reader, profile_builder, table_ingestion)
+                    if shared.get(SharedKey.CSV_LOAD_ID) is not load_id:
+                        return None
+                    if df_chunk is None:
+                        break
+                    if first_chunk_preview is None:  ## show it straight away (the table isn't usable until complete)
+                        first_chunk_preview = DataPreview(df_chunk, workspace.data_labels_param.value, width=TABLE_WIDTH)
+                        data_col.insert(0, first_chunk_preview.ui())
+                    pct_read = csv_file.tell() / csv_size
+                    loading_msg.object = (f"Reading CSV into on-disk database ... "
+                        f"{profile_builder.n_rows:,} rows so far ({pct_read:.0%})")
+            await asyncio.to_thread(table_ingestion.finish)
+            is_finished = True
+        finally:
+            if not is_finished:
+                table_ingestion.discard()
+        sql_dataset = SqlDataset(table_ingestion.table_name, cols=list(profile_builder.dtypes))
+        dataset_profile = await asyncio.to_thread(profile_builder.build, get_n_distinct=sql_dataset.count_distinct)
+        numeric_cols = [col for col, column_profile in dataset_profile.columns.items() if column_profile.is_numeric]
+        data_preview = SqlDataPreview(sql_dataset, workspace.data_labels_param.value,
+            numeric_cols=numeric_cols, width=TABLE_WIDTH)
+        await data_preview.apply_filter_and_sort()  ## first page (queried in a worker thread)
+        if first_chunk_preview is None:
+            data_col.insert(0, data_preview.ui())
+        else:
+            data_col[0] = data_preview.ui()
+        data_size_msg = (f"{dataset_profile.n_rows:,} rows kept in an on-disk database "
+            f"(CSV is {csv_size:,} bytes - too big to hold in memory)")
+        logger.info(data_size_msg)
+        return LoadedCsv(df=pd.DataFrame(), sql_dataset=sql_dataset, profile=dataset_profile, preview=data_preview,
+            size_msg=data_size_msg)
+
+    @staticmethod
+    async def display_csv(csv_fpath: str | None, stored_dataset_hash: str | None = None):
+        """
+        Only bound to the CSV - changing labels doesn't require the data to be loaded again (see apply_data_labels)
+
+        The CSV is read a chunk at a time. The first page of the preview appears as soon as the first chunk is ready
+        and then the rows-so-far count is kept up to date until everything has been read.
+        Each chunk is compacted (and added to the profile) before the next is parsed
+        so at most one uncompacted chunk is ever held in memory alongside the compacted data.
+        CSVs of at least OUT_OF_CORE_MIN_BYTES are never held in memory at all - see load_out_of_core.
+
+        A stored dataset (already parsed, possibly by another server process) is read straight from the dataset cache.
+
+        Args:
+            csv_fpath: CSV to read. If it was uploaded to the session's spool folder (see upload.py)
+              it is deleted once read - any other file is left alone.
+            stored_dataset_hash: content hash of a dataset selected from those already stored
+        """
+        if not (csv_fpath or stored_dataset_hash):
+            yield None
+            return
+        workspace = get_workspace()
+        shared = workspace.shared
+        load_id = object()
+        shared[SharedKey.CSV_LOAD_ID] = load_id
+        loading_msg = pn.pane.Markdown("Reading CSV ...", styles={'font-size': '12px'})
+        data_col = pn.Column(loading_msg)
+        yield data_col
+        if csv_fpath:
+            content_hash = await asyncio.to_thread(get_content_hash, csv_fpath)
+            is_out_of_core = Path(csv_fpath).stat().st_size >= OUT_OF_CORE_MIN_BYTES
+        else:
+            content_hash = stored_dataset_hash
+            is_out_of_core = False
+        load = Data.load_out_of_core if is_out_of_core else Data.load_in_memory
+        ## only a file the chunked upload handler wrote to the session's spool folder is ours to delete
+        is_upload = bool(csv_fpath) and Path(csv_fpath).resolve().parent == workspace.spool_dpath.resolve()
+        try:
+            loaded_csv = await load(csv_fpath, content_hash, load_id=load_id, loading_msg=loading_msg, data_col=data_col)
+        finally:  ## only the parsed data is kept (dataset cache or SQLite) - unless a later load has the same upload
+            if is_upload and shared.get(SharedKey.CSV_LOAD_ID) is load_id:
+                Path(csv_fpath).unlink(missing_ok=True)
+        if loaded_csv is None or shared.get(SharedKey.CSV_LOAD_ID) is not load_id:
+            return
+        prev_dataset_hash = shared.get(SharedKey.DATASET_HASH)
+        if prev_dataset_hash and prev_dataset_hash != content_hash:
+            release_data_source(prev_dataset_hash, user=workspace.session_id)
+        shared[SharedKey.DATASET_HASH] = content_hash  ## identifies the dataset when getting a data source for the stats engine
+        shared[SharedKey.DF_CSV] = loaded_csv.df  ## nothing modifies it in place so no need for a defensive copy
+        shared[SharedKey.SQL_DATASET] = loaded_csv.sql_dataset  ## only if out-of-core
+        shared[SharedKey.DATASET_PROFILE] = loaded_csv.profile  ## so we can decide what options to display in config forms
+        shared[SharedKey.DATA_PREVIEW] = loaded_csv.preview
+        workspace.update_memory_usage()
+        loading_msg.object = loaded_csv.size_msg
+        workspace.got_data_param.value = True  ## only now is everything ready for the stats forms
+
+    @staticmethod
+    async def apply_data_labels(event):
+        """
+        Only the columns whose value labels actually changed are relabelled
+        """
+        data_preview = get_workspace().shared.get(SharedKey.DATA_PREVIEW)
+        if not data_preview:
+            return
+        relabelled_cols = get_relabelled_cols(event.old, event.new)
+        if data_preview.set_labels(event.new or {}, cols=relabelled_cols):
+            await data_preview.refresh()
+
+    def set_csv_fpath(self, _event):
+        """
+        Upload finished (the file is already in the session's spool folder) so it can be read
+        """
+        spool_dpath = get_workspace().spool_dpath
+        csv_fpath = get_uploaded_fpath(spool_dpath, self.csv_uploader.upload_id)
+        if csv_fpath:
+            remove_other_uploads(spool_dpath, self.csv_uploader.upload_id)
+            get_workspace().shared[SharedKey.DATASET_NAME] = self.csv_uploader.filename
+            self.stored_dataset_selector.value = None
+        self.csv_fpath_var.value = str(csv_fpath) if csv_fpath else None
+
+    def refresh_stored_datasets(self, *_events):
+        self.stored_dataset_selector.options = {'': None} | {
+            stored_dataset.label: stored_dataset.content_hash for stored_dataset in dataset_cache.list_datasets()}
+
+    def set_stored_dataset(self, event):
+        """
+        A stored dataset replaces any uploaded CSV (and vice versa - see set_csv_fpath)
+        """
+        if not event.new:
+            self.stored_dataset_hash_var.value = None
+            return
+        self.csv_fpath_var.value = None
+        self.csv_uploader.filename = ''
+        self.stored_dataset_hash_var.value = event.new
+
+    def reset_if_data_released(self, event):
+        """
+        If an idle session has its data released (spool folder included), clear the selected CSV as well
+        """
+        if not event.new:
+            self.csv_fpath_var.value = None
+            self.csv_uploader.filename = ''
+            self.stored_dataset_selector.value = None
+        elif SHOW_STORED_DATASETS:
+            self.refresh_stored_datasets()
 
     def __init__(self):
+        workspace = get_workspace()
+        data_labels_param = workspace.data_labels_param
         self.data_title = pn.pane.Markdown(
             f"## Start here - select a CSV", styles={'color': Colour.BLUE_MID, 'font-size': '18px'})
-        self.csv_file_input = pn.widgets.FileInput(accept='.csv')
-        self.data_table_or_none = pn.bind(
-            Data.display_csv, self.csv_file_input.param.value, data_labels_param.param.value)
+        self.csv_uploader = ChunkedFileUpload(accept='.csv',
+            upload_url=get_app_url(f"{UPLOAD_URL_PREFIX}/{workspace.upload_token}"))  ## not FileInput - see upload.py
+        self.csv_fpath_var = Text(value=None)
+        self.stored_dataset_hash_var = Text(value=None)
+        ## datasets already parsed in any session - off unless SHOW_STORED_DATASETS (see conf.py)
+        self.stored_dataset_selector = pn.widgets.Select(name="... or open a stored dataset", options={'': None},
+            width=TABLE_WIDTH, visible=SHOW_STORED_DATASETS)
+        if SHOW_STORED_DATASETS:
+            self.refresh_stored_datasets()
+            self.stored_dataset_selector.param.watch(self.set_stored_dataset, 'value')
+        self.csv_uploader.param.watch(self.set_csv_fpath, 'n_completed')
+        self.data_table_or_none = pn.bind(Data.display_csv,
+            self.csv_fpath_var.param.value, self.stored_dataset_hash_var.param.value)
+        data_labels_param.param.watch(Data.apply_data_labels, 'value')
         self.labels_title = pn.pane.Markdown(
             f"## Apply labels to your data (if you have a YAML file)", styles={'color': Colour.BLUE_MID, 'font-size': '14px'})
         self.labels_file_input = pn.widgets.FileInput(accept='.yaml,.yml')
         self.data_label_setter = pn.bind(Data.set_data_labels, self.labels_file_input.param.value)
+        workspace.got_data_param.param.watch(self.reset_if_data_released, 'value')
 
     def ui(self):
         data_column = pn.Column(
-            self.data_title, self.csv_file_input, self.data_table_or_none,
+            self.data_title, self.csv_uploader, self.stored_dataset_selector, self.data_table_or_none,
             self.labels_title, self.labels_file_input, self.data_label_setter,
         )
         return data_column
@@ -0,0 +1,344 @@
+"""
+Preview of the uploaded data.
+
+Handing the whole data frame (plus a labelled copy of every labelled column) to Tabulator
+doubles memory and sends far more to the browser than the 10 rows actually shown.
+Instead, only the visible page is sliced out and labelled. Sorting and filtering are done here on the server
+and only change which row positions make up the pages - the data frame itself is never copied.
+
+Sorting millions of rows (or querying a multi-GB table - see SqlDataPreview) takes a while
+so it is done in a worker thread and only the latest request is shown if the analyst changes their mind meanwhile.
+"""
+from abc import ABC, abstractmethod
+import asyncio
+from collections.abc import Collection, Mapping
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import panel as pn
+
+from sofastats_app.ui.sql_dataset import SqlDataset, quote_name
+from sofastats_app.ui.utils import apply_value_labels
+
+NO_COLUMN = ''
+
+
+@dataclass(frozen=True)
+class ViewSettings:
+    """
+    Read from the widgets on the event loop so the worker thread never touches them
+    """
+    sort_col: str
+    descending: bool
+    filter_col: str
+    filter_text: str
+    filter_value_labels: Mapping[Any, str] | None
+
+
+class BaseDataPreview(ABC):
+    """
+    Paging, labels, and the sort and filter widgets. Subclasses supply the rows.
+
+    A view is whatever the subclass needs to fetch pages once sorting and filtering has been applied
+    (e.g. row positions). Making a view and fetching a page are both run in a worker thread.
+    """
+
+    def _init_ui(self, data_labels: Mapping[str, Any], *, view: Any, width: int, page_size: int):
+        self.page_size = page_size
+        self.value_labels = {}
+        self.set_labels(data_labels)
+        self.view = view
+        self.page_idx = 0
+        self._n_view_requests = 0
+        self._n_page_requests = 0
+        col_options = [NO_COLUMN, ] + self.cols
+        self.select_sort_col = pn.widgets.Select(name='Sort by', options=col_options, width=150)
+        self.chk_sort_descending = pn.widgets.Checkbox(name='Descending', margin=(30, 10, 0, 10))
+        self.select_filter_col = pn.widgets.Select(name='Filter on', options=col_options, width=150)
+        self.filter_text = pn.widgets.TextInput(name='Value', placeholder='e.g. 3 or Archery', width=150)
+        for widget in (self.select_sort_col, self.chk_sort_descending, self.select_filter_col, self.filter_text):
+            widget.param.watch(self._respond_to_filter_or_sort, 'value')
+        self.btn_prev_page = pn.widgets.Button(name='◀', width=40)
+        self.btn_prev_page.on_click(self._go_to_prev_page)
+        self.btn_next_page = pn.widgets.Button(name='▶', width=40)
+        self.btn_next_page.on_click(self._go_to_next_page)
+        self.page_info = pn.pane.Markdown('', margin=(12, 10, 0, 10))
+        self.table = pn.widgets.Tabulator(pd.DataFrame(columns=self.cols), width=width, disabled=True,
+            configuration={'headerSort': False})  ## sorting a single page in the browser would be misleading
+        self._update_page_info()
+
+    @property
+    @abstractmethod
+    def cols(self) -> list[str]:
+        ...
+
+    @abstractmethod
+    def get_n_rows(self, view: Any) -> int:
+        ...
+
+    @abstractmethod
+    def get_view(self, view_settings: ViewSettings) -> Any:
+        """
+        Run in a worker thread
+        """
+
+    @abstractmethod
+    def get_unlabelled_page_df(self, view: Any, page_idx: int) -> pd.DataFrame:
+        """
+        Run in a worker thread
+        """
+
+    @property
+    def n_rows(self) -> int:
+        return self.get_n_rows(self.view)
+
+    @property
+    def n_pages(self) -> int:
+        return max(1, -(-self.n_rows // self.page_size))
+
+    def set_labels(self, data_labels: Mapping[str, Any], *, cols: set[str] | None = None) -> bool:
+        """
+        Only updates which labels are used - await refresh() to show them
+
+        Args:
+            cols: only these columns have changed labels. If None, treat every column as changed.
+
+        Returns:
+            True if any column shown has changed labels
+        """
+        cols = set(self.cols) if cols is None else cols & set(self.cols)
+        for col in cols:
+            val_mapping = (data_labels.get(col) or {}).get('value_labels')
+            if val_mapping:
+                self.value_labels[col] = val_mapping
+            else:
+                self.value_labels.pop(col, None)
+        return bool(cols)
+
+    def get_page_df(self, view: Any, page_idx: int) -> pd.DataFrame:
+        page_df = self.get_unlabelled_page_df(view, page_idx)
+        ## apply any labels (only to the handful of rows being shown)
+        col_name_vals = []
+        for col in page_df.columns:
+            col_name_vals.append((col, page_df[col]))
+            val_mapping = self.value_labels.get(col)
+            if val_mapping:
+                col_name_vals.append((f"{col}<br>(labelled)", apply_value_labels(page_df[col], val_mapping)))
+        return pd.DataFrame(dict(col_name_vals), index=page_df.index)
+
+    async def show_page(self, view: Any, page_idx: int):
+        self._n_page_requests += 1
+        request_n = self._n_page_requests
+        page_df = await asyncio.to_thread(self.get_page_df, view, page_idx)
+        if request_n != self._n_page_requests:
+            return  ## another page has been asked for since
+        self.view = view
+        self.page_idx = page_idx
+        self.table.value = page_df
+        self._update_page_info()
+
+    async def refresh(self):
+        await self.show_page(self.view, self.page_idx)
+
+    def _update_page_info(self):
+        if self.n_rows:
+            first_row = self.page_idx * self.page_size + 1
+            last_row = min(first_row + self.page_size - 1, self.n_rows)
+            self.page_info.object = f"Rows {first_row:,}-{last_row:,} of {self.n_rows:,}"
+        else:
+            self.page_info.object = "No matching rows"
+        self.btn_prev_page.disabled = self.page_idx == 0
+        self.btn_next_page.disabled = self.page_idx >= self.n_pages - 1
+
+    async def _go_to_prev_page(self, _event):
+        await self.show_page(self.view, max(0, self.page_idx - 1))
+
+    async def _go_to_next_page(self, _event):
+        await self.show_page(self.view, min(self.n_pages - 1, self.page_idx + 1))
+
+    def _get_view_settings(self) -> ViewSettings:
+        filter_col = self.select_filter_col.value
+        return ViewSettings(sort_col=self.select_sort_col.value, descending=self.chk_sort_descending.value,
+            filter_col=filter_col, filter_text=(self.filter_text.value or '').strip(),
+            filter_value_labels=self.value_labels.get(filter_col))
+
+    async def apply_filter_and_sort(self):
+        """
+        Back to the first page of the newly sorted and filtered rows
+        """
+        self._n_view_requests += 1
+        request_n = self._n_view_requests
+        view = await asyncio.to_thread(self.get_view, self._get_view_settings())
+        if request_n != self._n_view_requests:
+            return  ## sorting or filtering has changed again since
+        await self.show_page(view, 0)
+
+    async def _respond_to_filter_or_sort(self, _event):
+        await self.apply_filter_and_sort()
+
+    def ui(self):
+        return pn.Column(
+            pn.Row(self.select_sort_col, self.chk_sort_descending, self.select_filter_col, self.filter_text),
+            self.table,
+            pn.Row(self.btn_prev_page, self.page_info, self.btn_next_page),
+        )
+
+
+class DataPreview(BaseDataPreview):
+    """
+    The view is the row positions to page through (None means all rows in their original order)
+    """
+
+    def __init__(self, df: pd.DataFrame, data_labels: Mapping[str, Any], *, width: int, page_size: int = 10):
+        self.df = df
+        self._init_ui(data_labels, view=None, width=width, page_size=page_size)
+        self.table.value = self.get_page_df(None, 0)  ## only a page of an in-memory frame so quick enough to show now
+        self._update_page_info()
+
+    @property
+    def cols(self) -> list[str]:
+        return list(self.df.columns)
+
+    def get_n_rows(self, view: np.ndarray | None) -> int:
+        return len(self.df) if view is None else len(view)
+
+    async def set_df(self, df: pd.DataFrame):
+        """
+        E.g. swap the first chunk of a large CSV (shown while the rest is still loading) for the complete data.
+        Any sorting and filtering the user has already set up is applied to the new data.
+        """
+        self.df = df
+        await self.apply_filter_and_sort()
+
+    def get_unlabelled_page_df(self, view: np.ndarray | None, page_idx: int) -> pd.DataFrame:
+        start = page_idx * self.page_size
+        stop = start + self.page_size
+        if view is None:
+            return self.df.iloc[start:stop]
+        return self.df.iloc[view[start:stop]]
+
+    def _get_filter_mask(self, df: pd.DataFrame, view_settings: ViewSettings) -> np.ndarray | None:
+        filter_col = view_settings.filter_col
+        filter_text = view_settings.filter_text
+        if filter_col == NO_COLUMN or not filter_text:
+            return None
+        series = df[filter_col]
+        values_dtype = series.dtype.categories.dtype if isinstance(series.dtype, pd.CategoricalDtype) else series.dtype
+        if pd.api.types.is_numeric_dtype(values_dtype) and not pd.api.types.is_bool_dtype(values_dtype):
+            try:
+                mask = (series == float(filter_text)).to_numpy()
+            except ValueError:  ## not a number so only a label can match
+                mask = np.zeros(len(series), dtype=bool)
+        else:
+            mask = series.astype(str).str.contains(filter_text, case=False, regex=False).to_numpy()
+        val_mapping = view_settings.filter_value_labels
+        if val_mapping:  ## e.g. 'Archery' should find sport 1
+            matching_vals = [val for val, lbl in val_mapping.items() if filter_text.lower() in str(lbl).lower()]
+            mask = mask | series.isin(matching_vals).to_numpy()
+        return mask
+
+    def get_view(self, view_settings: ViewSettings) -> np.ndarray | None:
+        df = self.df  ## may be swapped for the complete data meanwhile (see set_df) - which then gets its own view
+        mask = self._get_filter_mask(df, view_settings)
+        row_positions = None if mask is None else np.flatnonzero(mask)
+        sort_col = view_settings.sort_col
+        if sort_col != NO_COLUMN:
+            sort_vals = df[sort_col] if row_positions is None else df[sort_col].iloc[row_positions]
+            sort_vals = sort_vals.reset_index(drop=True)
+            try:
+                order = sort_vals.sort_values(kind='stable', ascending=not view_settings.descending,
+                    na_position='last').index.to_numpy()
+            except TypeError:  ## mixed types
+                order = sort_vals.astype(str).sort_values(kind='stable',
+                    ascending=not view_settings.descending).index.to_numpy()
+            row_positions = order if row_positions is None else row_positions[order]
+        return row_positions
+
+
+@dataclass(frozen=True)
+class SqlView:
+    where_sql: str
+    where_params: list[Any]
+    sort_col: str | None
+    descending: bool
+    n_rows: int
+
+
+class SqlDataPreview(BaseDataPreview):
+    """
+    Same preview but for a dataset only held in SQLite (see sql_dataset.py).
+    Filtering and sorting become WHERE and ORDER BY clauses and only the visible page is ever fetched.
+    Each column sorted on gets an index (the first sort on a column takes a while but paging through it doesn't).
+
+    Nothing is queried until apply_filter_and_sort() is awaited.
+    """
+
+    def __init__(self, sql_dataset: SqlDataset, data_labels: Mapping[str, Any], *,
+            numeric_cols: Collection[str], width: int, page_size: int = 10):
+        """
+        Args:
+            numeric_cols: filtered on by exact value rather than by matching text
+        """
+        self.sql_dataset = sql_dataset
+        self.numeric_cols = set(numeric_cols)
+        self._n_rows_unfiltered = None  ## counting every row of a big table is slow so only done once
+        self._init_ui(data_labels, view=SqlView(where_sql='', where_params=[], sort_col=None, descending=False,
+            n_rows=0), width=width, page_size=page_size)
+
+    @property
+    def cols(self) -> list[str]:
+        return self.sql_dataset.cols
+
+    def get_n_rows(self, view: SqlView) -> int:
+        return view.n_rows
+
+    def get_unlabelled_page_df(self, view: SqlView, page_idx: int) -> pd.DataFrame:
+        return self.sql_dataset.get_rows_df(where_sql=view.where_sql, params=view.where_params,
+            sort_col=view.sort_col, descending=view.descending,
+            offset=page_idx * self.page_size, limit=self.page_size)
+
+    def _get_filter(self, view_settings: ViewSettings) -> tuple[str, list[Any]]:
+        """
+        Returns:
+            WHERE clause (empty if no filter) and its params
+        """
+        filter_col = view_settings.filter_col
+        filter_text = view_settings.filter_text
+        if filter_col == NO_COLUMN or not filter_text:
+            return '', []
+        col_sql = quote_name(filter_col)
+        conditions = []
+        where_params = []
+        if filter_col in self.numeric_cols:
+            try:
+                where_params.append(float(filter_text))
+                conditions.append(f"{col_sql} = ?")
+            except ValueError:  ## not a number so only a label can match
+                pass
+        else:
+            conditions.append(f"CAST({col_sql} AS TEXT) LIKE ?")  ## LIKE is case-insensitive (for ASCII) in SQLite
+            where_params.append(f"%{filter_text}%")
+        val_mapping = view_settings.filter_value_labels
+        if val_mapping:  ## e.g. 'Archery' should find sport 1
+            matching_vals = [val for val, lbl in val_mapping.items() if filter_text.lower() in str(lbl).lower()]
+            if matching_vals:
+                conditions.append(f"{col_sql} IN ({', '.join('?' * len(matching_vals))})")
+                where_params.extend(matching_vals)
+        return f"WHERE {' OR '.join(conditions) or '0'}", where_params
+
+    def get_view(self, view_settings: ViewSettings) -> SqlView:
+        where_sql, where_params = self._get_filter(view_settings)
+        sort_col = view_settings.sort_col or None
+        descending = view_settings.descending if sort_col else False
+        if sort_col:
+            self.sql_dataset.add_sort_index(sort_col, descending=descending)
+        if where_sql:
+            n_rows = self.sql_dataset.count_rows(where_sql, where_params)
+        else:
+            if self._n_rows_unfiltered is None:
+                self._n_rows_unfiltered = self.sql_dataset.count_rows()
+            n_rows = self._n_rows_unfiltered
+        return SqlView(where_sql=where_sql, where_params=where_params, sort_col=sort_col, descending=descending,
+            n_rows=n_rows)
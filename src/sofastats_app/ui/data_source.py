@@ -0,0 +1,209 @@
+"""
+Where the stats engine gets its data from.
+
+Supplying `csv_file_path` to a design makes sofastats_lib re-read the CSV and re-ingest it into SQLite
+on every single analysis. We already have the data in memory so we ingest it once per dataset
+into a table in the app's SQLite database (see SQLITE_DB_FPATH)
+and hand the design a cursor and table name instead.
+
+Tables are named after the dataset content hash so sessions working on the same data share one table.
+A table is dropped once no session is using it any more.
+
+Datasets too big to hold in memory are never turned into a single data frame.
+Instead they are appended to their table a chunk at a time as the CSV is read (see TableIngestion)
+and everything else is queried from there (see sql_dataset.py).
+
+Analyses, previews, and ingestion all run in worker threads. Each thread has its own connection
+(so one thread's commit can never include another's statements) and the database is in WAL mode so readers
+aren't held up by a write in progress. Dropping tables is left to a single writer thread - nothing on
+the event loop ever waits for SQLite.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import sqlite3 as sqlite
+import tempfile
+import threading
+from typing import Any
+
+import pandas as pd
+
+from sofastats_app import logger
+
+## On disk so big datasets aren't also held in RAM. One per process because each process tracks its own table users.
+SQLITE_DB_FPATH = Path(tempfile.gettempdir()) / f"sofastats_app_{os.getpid()}.db"
+SQLITE_BUSY_TIMEOUT_SECS = 60  ## e.g. a drop waiting for another table's ingestion to commit a chunk
+
+_thread_local = threading.local()  ## each thread's connection
+_con_lock = threading.Lock()
+_is_db_reset = False
+_table_users_lock = threading.Lock()  ## only ever held briefly - never while SQLite does any work
+_table_users: dict[str, set[Any]] = {}  ## table name -> sessions using it
+_table_locks: dict[str, threading.Lock] = {}  ## table name -> held while (only) worker threads create or drop it
+_sqlite_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sofastats-sqlite-writer')
+
+
+@dataclass(frozen=True)
+class DataSource:
+    cur: Any
+    database_engine_name: str
+    source_table_name: str
+
+    def to_design_kwargs(self) -> dict[str, Any]:
+        """
+        e.g. AnovaDesign(measure_field_name=..., **data_source.to_design_kwargs())
+        """
+        return {
+            'cur': self.cur,
+            'database_engine_name': self.database_engine_name,
+            'source_table_name': self.source_table_name,
+        }
+
+
+def get_sqlite_con() -> sqlite.Connection:
+    """
+    Returns:
+        this thread's connection (made on first use)
+    """
+    global _is_db_reset
+    con = getattr(_thread_local, 'con', None)
+    if con is None:
+        with _con_lock:
+            if not _is_db_reset:  ## anything left over from an earlier process with the same pid is stale
+                for suffix in ('', '-wal', '-shm'):
+                    SQLITE_DB_FPATH.with_name(SQLITE_DB_FPATH.name + suffix).unlink(missing_ok=True)
+                _is_db_reset = True
+        con = sqlite.connect(SQLITE_DB_FPATH, timeout=SQLITE_BUSY_TIMEOUT_SECS)
+        con.execute('PRAGMA journal_mode=WAL')
+        _thread_local.con = con
+    return con
+
+def get_table_name(dataset_hash: str) -> str:
+    return f"dataset_{dataset_hash[:16]}"
+
+def _get_table_lock(table_name: str) -> threading.Lock:
+    with _table_users_lock:
+        return _table_locks.setdefault(table_name, threading.Lock())
+
+def _get_sql_ready_df(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    SQLite would store categoricals as text so ingest their underlying values (e.g. country codes) instead
+    """
+    categorical_cols = {col: df[col].astype(df[col].cat.categories.dtype)
+        for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)}
+    return df.assign(**categorical_cols) if categorical_cols else df
+
+def get_data_source(df: pd.DataFrame, dataset_hash: str, *, user: Any = None) -> DataSource:
+    """
+    Ingest the data frame into SQLite the first time it is needed and reuse the table after that.
+    Only call from a worker thread (may have to ingest) - the cursor is for this thread only.
+
+    Args:
+        user: whatever is using the table e.g. a session id. Tables are dropped once they have no users left.
+    """
+    con = get_sqlite_con()
+    table_name = get_table_name(dataset_hash)
+    with _get_table_lock(table_name):  ## so two sessions don't both ingest the same dataset
+        with _table_users_lock:
+            is_ingested = table_name in _table_users
+        if not is_ingested:
+            _get_sql_ready_df(df).to_sql(table_name, con, if_exists='replace', index=False)
+            con.commit()
+            logger.info(f"Ingested {len(df):,} rows into internal SQLite table '{table_name}'")
+        with _table_users_lock:
+            _table_users.setdefault(table_name, set()).add(user)
+    return DataSource(cur=con.cursor(), database_engine_name='sqlite', source_table_name=table_name)
+
+def _drop_table(table_name: str, *, only_if_unused=True):
+    """
+    Run on the writer thread
+
+    Args:
+        only_if_unused: the table may have been ingested again since the drop was requested
+    """
+    with _get_table_lock(table_name):
+        with _table_users_lock:
+            if only_if_unused and table_name in _table_users:
+                return
+        con = get_sqlite_con()
+        con.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        con.commit()
+    logger.info(f"Dropped internal SQLite table '{table_name}'")
+
+def release_data_source(dataset_hash: str, *, user: Any = None):
+    """
+    Safe to call from the event loop - the table is dropped (if no longer used) by the writer thread
+    """
+    table_name = get_table_name(dataset_hash)
+    with _table_users_lock:
+        users = _table_users.get(table_name)
+        if users is None:
+            return
+        users.discard(user)
+        if users:
+            return
+        del _table_users[table_name]
+    _sqlite_writer.submit(_drop_table, table_name)
+
+
+class TableIngestion:
+    """
+    Append a dataset to its table a chunk at a time without ever holding all of it in memory.
+
+    Rows go into a loading table which is only renamed to the real table name once everything has arrived,
+    so a half-loaded table is never used (and if another session finished loading the same data first
+    we just use theirs). If the session already has a complete table for this dataset there is nothing to do.
+    """
+
+    def __init__(self, dataset_hash: str, *, user: Any = None):
+        self.dataset_hash = dataset_hash
+        self.user = user
+        self.table_name = get_table_name(dataset_hash)
+        self.loading_table_name = f"{self.table_name}_loading_{id(self)}"
+        self.n_rows = 0
+        with _table_users_lock:
+            self.is_needed = self.table_name not in _table_users
+            if not self.is_needed:
+                _table_users[self.table_name].add(user)
+
+    def append(self, df_chunk: pd.DataFrame):
+        """
+        Run in a worker thread. The loading table is only ever written by this ingestion so needs no lock.
+        """
+        if not self.is_needed:
+            return
+        con = get_sqlite_con()
+        _get_sql_ready_df(df_chunk).to_sql(self.loading_table_name, con, if_exists='append', index=False)
+        con.commit()
+        self.n_rows += len(df_chunk)
+
+    def finish(self):
+        """
+        Run in a worker thread
+        """
+        if not self.is_needed:
+            return
+        con = get_sqlite_con()
+        with _get_table_lock(self.table_name):
+            with _table_users_lock:
+                is_ingested = self.table_name in _table_users  ## another session got there first
+            if is_ingested:
+                con.execute(f'DROP TABLE IF EXISTS "{self.loading_table_name}"')
+            else:
+                con.execute(f'DROP TABLE IF EXISTS "{self.table_name}"')  ## e.g. released but drop still pending
+                con.execute(f'ALTER TABLE "{self.loading_table_name}" RENAME TO "{self.table_name}"')
+            con.commit()
+            with _table_users_lock:
+                _table_users.setdefault(self.table_name, set()).add(self.user)
+        logger.info(f"Ingested {self.n_rows:,} rows into internal SQLite table '{self.table_name}' a chunk at a time")
+
+    def discard(self):
+        """
+        E.g. the analyst uploaded a different CSV before this one finished loading.
+        Safe to call from the event loop - the loading table is dropped by the writer thread.
+        """
+        if not self.is_needed:
+            release_data_source(self.dataset_hash, user=self.user)
+            return
+        _sqlite_writer.submit(_drop_table, self.loading_table_name, only_if_unused=False)
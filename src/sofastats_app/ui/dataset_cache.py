@@ -0,0 +1,236 @@
+"""
+Content-addressed cache of parsed CSV uploads.
+
+Parsing a large CSV is slow and analysts often upload exactly the same extract many times a day.
+So parsed data frames are stored as uncompressed Feather (Arrow IPC) files named after a hash of the uploaded file.
+A repeat upload is read back memory-mapped instead of being re-parsed.
+The cache folder is kept under a size limit by evicting the least recently used files.
+
+The folder is shared by every server process (see SERVER_NUM_PROCS) so a dataset parsed by one
+can be opened by any other without reading the CSV again. Columns are handed to pandas without being
+consolidated into blocks so numeric columns without missing values can point straight at the memory-mapped file
+rather than being copied - several processes working on the same dataset then share one copy in the page cache.
+A small JSON file next to each dataset (name, size, when stored, which labels it was compacted for)
+lets stored datasets be listed without opening them.
+
+Feather needs pyarrow. If it isn't installed the cache does nothing and every upload is parsed as before.
+"""
+from dataclasses import dataclass
+import datetime
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+import pandas as pd
+
+from sofastats_app import logger
+from sofastats_app.ui.conf import DATASET_CACHE_FOLDER, DATASET_CACHE_MAX_BYTES
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    HAS_PYARROW = False
+else:
+    HAS_PYARROW = True
+
+
+def get_content_hash(fpath: Path) -> str:
+    """
+    Hashed in blocks so even a multi-GB upload is never read into memory all at once
+    """
+    with open(fpath, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def table_to_df(table) -> pd.DataFrame:
+    """
+    Numeric columns without missing values wrap the (memory-mapped) Arrow buffer instead of being copied.
+    Table.to_pandas() would copy everything into pandas blocks.
+    Everything else (e.g. text, categories, anything with nulls) is converted as usual.
+    """
+    series_by_col = {}
+    for col, chunked_array in zip(table.column_names, table.columns):
+        col_type = chunked_array.type
+        is_zero_copy_possible = (chunked_array.num_chunks == 1 and chunked_array.null_count == 0
+            and (pa.types.is_integer(col_type) or pa.types.is_floating(col_type)))
+        if is_zero_copy_possible:
+            series_by_col[col] = pd.Series(chunked_array.chunk(0).to_numpy(zero_copy_only=True), name=col, copy=False)
+        else:
+            series_by_col[col] = chunked_array.to_pandas().rename(col)
+    return pd.DataFrame(series_by_col, copy=False)
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    hits: int
+    misses: int
+    n_files: int
+    total_bytes: int
+
+    @property
+    def hit_rate(self) -> float:
+        n_lookups = self.hits + self.misses
+        return self.hits / n_lookups if n_lookups else 0
+
+    def __str__(self):
+        return (f"{self.hits:,} hits, {self.misses:,} misses (hit rate {self.hit_rate:.0%}); "
+            f"{self.n_files:,} cached datasets using {self.total_bytes:,} bytes")
+
+
+@dataclass(frozen=True)
+class StoredDataset:
+    """
+    Args:
+        compaction_key: see compaction.get_compaction_key. None if not compacted (or stored before this was kept).
+    """
+    content_hash: str
+    name: str
+    n_rows: int
+    n_cols: int
+    stored_at: float
+    compaction_key: str | None = None
+
+    @property
+    def label(self) -> str:
+        stored_at = datetime.datetime.fromtimestamp(self.stored_at).strftime('%Y-%m-%d %H:%M')
+        return f"{self.name} ({self.n_rows:,} rows; stored {stored_at})"
+
+
+class DatasetCache:
+
+    def __init__(self, cache_dpath: Path, max_bytes: int):
+        self.cache_dpath = Path(cache_dpath)
+        self.max_bytes = max_bytes
+        self.enabled = HAS_PYARROW
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not self.enabled:
+            logger.info("pyarrow not installed so uploaded datasets will not be cached")
+
+    def _get_fpath(self, content_hash: str) -> Path:
+        return self.cache_dpath / f"{content_hash}.feather"
+
+    def _get_metadata_fpath(self, content_hash: str) -> Path:
+        return self.cache_dpath / f"{content_hash}.json"
+
+    def get(self, content_hash: str) -> pd.DataFrame | None:
+        fpath = self._get_fpath(content_hash)
+        if not self.enabled or not fpath.exists():
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            df = table_to_df(feather.read_table(fpath, memory_map=True))
+            os.utime(fpath)  ## recently used so last to be evicted
+        except Exception as e:  ## e.g. evicted by another worker between exists() and reading
+            logger.info(f"Unable to read cached dataset '{fpath}' so treating as a cache miss. Orig error: {e}")
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return df
+
+    def get_compaction_key(self, content_hash: str) -> str | None:
+        """
+        Returns:
+            key of the labels the stored data was compacted for (None if unknown)
+        """
+        try:
+            metadata = json.loads(self._get_metadata_fpath(content_hash).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+        return metadata.get('compaction_key')
+
+    def put(self, content_hash: str, df: pd.DataFrame, *, name: str | None = None, compaction_key: str | None = None):
+        """
+        Args:
+            name: e.g. original CSV file name - shown when listing stored datasets
+            compaction_key: see compaction.get_compaction_key - so a later load with the same labelled columns
+              can use the data as stored
+        """
+        if not self.enabled:
+            return
+        self.cache_dpath.mkdir(parents=True, exist_ok=True)
+        fpath = self._get_fpath(content_hash)
+        tmp_fpath = fpath.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            df.to_feather(tmp_fpath, compression='uncompressed',  ## uncompressed so can be memory-mapped
+                chunksize=max(len(df), 1))  ## one chunk per column so numeric columns can be read without copying
+            tmp_fpath.replace(fpath)  ## atomic so nobody ever reads a half-written file
+        except Exception as e:  ## e.g. mixed types in a column which Arrow can't store
+            logger.info(f"Unable to cache dataset {content_hash}. Orig error: {e}")
+            tmp_fpath.unlink(missing_ok=True)
+            return
+        metadata = {'name': name or content_hash[:12], 'n_rows': len(df), 'n_cols': len(df.columns),
+            'stored_at': time.time(), 'compaction_key': compaction_key}
+        self._get_metadata_fpath(content_hash).write_text(json.dumps(metadata), encoding='utf-8')
+        self.evict()
+
+    def list_datasets(self) -> list[StoredDataset]:
+        """
+        Most recently used first
+        """
+        if not self.enabled:
+            return []
+        fpath_mtimes = []
+        for fpath in self._get_cached_fpaths():
+            try:
+                fpath_mtimes.append((fpath, fpath.stat().st_mtime))
+            except FileNotFoundError:
+                continue
+        stored_datasets = []
+        for fpath, mtime in sorted(fpath_mtimes, key=lambda fpath_mtime: fpath_mtime[1], reverse=True):
+            content_hash = fpath.stem
+            try:
+                metadata = json.loads(self._get_metadata_fpath(content_hash).read_text(encoding='utf-8'))
+            except (OSError, ValueError):  ## stored before names were kept - only the schema needs reading
+                try:
+                    table = feather.read_table(fpath, memory_map=True)
+                except (OSError, ValueError):  ## e.g. evicted in the meantime
+                    continue
+                metadata = {'name': content_hash[:12], 'n_rows': table.num_rows, 'n_cols': table.num_columns,
+                    'stored_at': mtime}
+            stored_datasets.append(StoredDataset(content_hash=content_hash, **metadata))
+        return stored_datasets
+
+    def _get_cached_fpaths(self) -> list[Path]:
+        return list(self.cache_dpath.glob('*.feather')) if self.cache_dpath.exists() else []
+
+    def evict(self):
+        """
+        Remove the least recently used datasets until the cache is back under its size limit.
+        """
+        fpath_stats = []
+        for fpath in self._get_cached_fpaths():
+            try:
+                fpath_stats.append((fpath, fpath.stat()))
+            except FileNotFoundError:  ## already evicted by someone else
+                continue
+        total_bytes = sum(stat.st_size for _fpath, stat in fpath_stats)
+        for fpath, stat in sorted(fpath_stats, key=lambda fpath_stat: fpath_stat[1].st_mtime):
+            if total_bytes <= self.max_bytes:
+                break
+            fpath.unlink(missing_ok=True)
+            self._get_metadata_fpath(fpath.stem).unlink(missing_ok=True)
+            total_bytes -= stat.st_size
+            logger.info(f"Evicted cached dataset '{fpath.name}' ({stat.st_size:,} bytes)")
+
+    @property
+    def stats(self) -> CacheStats:
+        fpaths = self._get_cached_fpaths()
+        total_bytes = 0
+        for fpath in fpaths:
+            try:
+                total_bytes += fpath.stat().st_size
+            except FileNotFoundError:
+                continue
+        return CacheStats(hits=self.hits, misses=self.misses, n_files=len(fpaths), total_bytes=total_bytes)
+
+
+dataset_cache = DatasetCache(DATASET_CACHE_FOLDER, max_bytes=DATASET_CACHE_MAX_BYTES)  ## shared by all sessions
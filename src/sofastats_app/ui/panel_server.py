@@ -1,14 +1,66 @@
+"""
+Start the server and open the app in the browser as soon as the server can serve it.
+
+Rather than sleeping a fixed time (too long on a fast machine, too short on a cold one) the liveness endpoint
+is polled until the server answers. Only light modules are imported here so the server process isn't kept waiting
+- the heavy ones (pandas, Panel etc.) are imported by the server itself (see server_setup.py).
+
+Startup is logged in phases: heavy imports (server_setup.py), server ready (here),
+and building each session's widgets and template (ui.py).
+"""
 from collections.abc import Sequence
 import os
 from pathlib import Path
 import subprocess
 import threading
-from time import sleep
+import time
+from urllib.error import URLError
+from urllib.request import ProxyHandler, build_opener
 from webbrowser import open_new_tab
 
-def run_server():
-    args = f"panel serve ui.py --static-dirs images=./images --session-token-expiration=900000"  ## https://discourse.bokeh.org/t/protocol-error-token-is-expired/11575
-    subprocess.run(args, shell=True)
+from sofastats_app import logger
+from sofastats_app.ui.conf import SERVER_NUM_PROCS, SERVER_NUM_THREADS, SERVER_PORT, SERVER_READY_TIMEOUT_SECS
+
+LIVENESS_ENDPOINT = 'liveness'
+
+url_opener = build_opener(ProxyHandler({}))  ## localhost - never via any proxy set in the environment
+
+def run_server(num_procs: int = SERVER_NUM_PROCS, num_threads: int | None = SERVER_NUM_THREADS):
+    """
+    Args:
+        num_procs: server processes sharing the port (0 - one per CPU core). Sessions stay in the process they start in
+          but uploads, reports, and parsed datasets are shared between processes - see conf.py
+        num_threads: threads per process for running callbacks. None - run them on the event loop
+    """
+    args = ['panel', 'serve', 'ui.py', '--static-dirs', 'images=./images',
+        '--session-token-expiration=900000',  ## https://discourse.bokeh.org/t/protocol-error-token-is-expired/11575
+        '--plugins', 'sofastats_app.ui.upload',  ## chunked CSV upload endpoint
+        '--plugins', 'sofastats_app.ui.reports',  ## content-hashed report endpoint
+        '--setup', 'server_setup.py',  ## heavy imports before the first session (timed)
+        '--num-procs', str(num_procs), '--port', str(SERVER_PORT),
+        '--liveness', '--liveness-endpoint', LIVENESS_ENDPOINT]  ## so serve() knows when the server is ready
+    if num_threads is not None:
+        args += ['--num-threads', str(num_threads)]
+    subprocess.run(args)  ## no shell - nothing in the arguments is ever interpreted
+
+def wait_until_ready(server_thread: threading.Thread, *, timeout_secs: float) -> bool:
+    """
+    Returns:
+        True if the server answered before the timeout (False if it didn't or the server stopped)
+    """
+    liveness_url = f"http://localhost:{SERVER_PORT}/{LIVENESS_ENDPOINT}"
+    deadline = time.perf_counter() + timeout_secs
+    poll_secs = 0.05
+    while time.perf_counter() < deadline and server_thread.is_alive():
+        try:
+            with url_opener.open(liveness_url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except (URLError, ConnectionError, TimeoutError):  ## not listening yet
+            pass
+        time.sleep(poll_secs)
+        poll_secs = min(poll_secs * 2, 0.5)
+    return False
 
 def speak(lines: Sequence[str]):
     print("")
@@ -22,12 +74,20 @@ def serve():
         os.chdir(cwd)
     except FileNotFoundError as e:
         speak(f"Can't change directory to '{cwd}' for some reason. Orig error: {e}")
-    speak(["Hi there - just starting SOFA Stats", "Waiting a couple of seconds so everything's ready"])
+    start = time.perf_counter()
+    speak(["Hi there - just starting SOFA Stats", "Waiting until everything's ready"])
     output_thread = threading.Thread(target=run_server)
     output_thread.start()
-    sleep(2)  ## to give server time to be ready before tab opens
-    open_new_tab("http://localhost:5006/ui")
+    if not wait_until_ready(output_thread, timeout_secs=SERVER_READY_TIMEOUT_SECS):
+        if not output_thread.is_alive():
+            speak(["SOFA Stats stopped before it was ready - see the messages above for why"])
+            return
+        speak([f"SOFA Stats still isn't ready after {SERVER_READY_TIMEOUT_SECS:,} seconds - opening it anyway"])
+    ready_secs = time.perf_counter() - start
+    logger.info(f"Server ready in {ready_secs:.2f}s (includes heavy imports if only one server process)")
+    open_new_tab(f"http://localhost:{SERVER_PORT}/ui")
     speak([
+        f"Server ready in {ready_secs:.2f} seconds",
         "I just opened a new tab in your web browser with the SOFA Stats App - enjoy!",
         ("Don't worry about all the technical chatter below - "
         "it might become useful if SOFA Stats stops working properly for some reason."),
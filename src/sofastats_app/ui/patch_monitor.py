@@ -0,0 +1,59 @@
+"""
+Debug counter of the Bokeh document patches sent to the browser.
+
+Rebuilding a widget tree (e.g. a pn.bind function returning new widgets) sends every model in it to the browser again
+whereas updating a widget in place only sends the changed property. The difference is invisible in the UI
+but not on a slow connection or a busy server. So, when SOFASTATS_DEBUG_PATCH_BYTES is set, each session logs
+how many patch events and bytes each interaction sent - a jump in the numbers flags a regression.
+
+Everything changed during one tick of the event loop (e.g. all the callbacks from a click) counts as one interaction.
+Each event is serialised here the same way the server serialises it so this has a cost - debug use only.
+"""
+from bokeh.document import Document
+from bokeh.document.events import DocumentChangedEvent, DocumentPatchedEvent
+from bokeh.protocol import Protocol
+from bokeh.server.session import ServerSession
+
+from sofastats_app import logger
+
+_protocol = Protocol()
+
+def get_patch_bytes(event: DocumentPatchedEvent) -> int:
+    msg = _protocol.create('PATCH-DOC', [event])
+    n_buffer_bytes = sum(len(buffer.to_bytes()) for buffer in msg.buffers)
+    return len(msg.header_json) + len(msg.metadata_json) + len(msg.content_json) + n_buffer_bytes
+
+
+class PatchTrafficMonitor:
+
+    def __init__(self, doc: Document, session_id: str | None):
+        self.doc = doc
+        self.session_id = session_id
+        self.n_interactions = 0
+        self.n_events_total = 0
+        self.n_bytes_total = 0
+        self._n_events = 0
+        self._n_bytes = 0
+        self._flush_scheduled = False
+        doc.on_change(self._on_change)
+
+    def _on_change(self, event: DocumentChangedEvent):
+        if not isinstance(event, DocumentPatchedEvent):  ## e.g. a callback being added - nothing sent
+            return
+        if isinstance(getattr(event, 'setter', None), ServerSession):  ## change came from the browser so isn't sent back
+            return
+        self._n_events += 1
+        self._n_bytes += get_patch_bytes(event)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.doc.add_next_tick_callback(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        self.n_interactions += 1
+        self.n_events_total += self._n_events
+        self.n_bytes_total += self._n_bytes
+        logger.info(f"Session {self.session_id} interaction {self.n_interactions:,} sent {self._n_events:,} "
+            f"patch events ({self._n_bytes:,} bytes) - session total {self.n_bytes_total:,} bytes")
+        self._n_events = 0
+        self._n_bytes = 0
@@ -0,0 +1,184 @@
+"""
+Column profile of the current dataset.
+
+Built once when the data is loaded so config forms never have to scan the data frame
+(which is slow for wide files with millions of rows) just to work out what options to show.
+"""
+from collections.abc import Callable, Mapping, Sequence
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+MAX_PROFILED_DISTINCT_VALUES = 10_000  ## beyond this (e.g. names, IDs) we don't keep the distinct values
+
+
+def _get_value_type_from_dtype(values_dtype: Any) -> type:
+    if pd.api.types.is_bool_dtype(values_dtype):
+        return str
+    if pd.api.types.is_integer_dtype(values_dtype):
+        return int
+    if pd.api.types.is_float_dtype(values_dtype):
+        return float
+    return str
+
+def _get_value_type_from_values(values: Sequence[Any]) -> type:
+    """
+    For object columns e.g. a column read as ints in some chunks and floats in others
+    can only be put back together as Python objects (see compaction.concat_compacted_chunks) but is still numeric
+    """
+    is_number = lambda val: isinstance(val, (int, float, np.integer, np.floating)) and not isinstance(val, (bool, np.bool_))
+    if not len(values) or not all(is_number(val) for val in values):
+        return str
+    if all(isinstance(val, (int, np.integer)) for val in values):
+        return int
+    return float
+
+
+@dataclass(frozen=True)
+class ColumnProfile:
+    """
+    Args:
+        value_type: int, float, or str - what to use to restore a value extracted from an option string
+            e.g. '1' from 'NZ (1)'
+        distinct_values: sorted, non-null. None if too many to be worth keeping
+        counts: number of rows for each distinct value
+    """
+    name: str
+    dtype: str
+    value_type: type
+    n_distinct: int
+    n_null: int
+    distinct_values: list[Any] | None
+    counts: list[int] | None
+
+    @property
+    def is_numeric(self) -> bool:
+        return self.value_type in (int, float)
+
+    def get_label_coverage(self, value_labels: Mapping[Any, str]) -> float | None:
+        """
+        Fraction of distinct values which have a label. None if we didn't keep the distinct values.
+        """
+        if self.distinct_values is None:
+            return None
+        if not self.distinct_values:
+            return 0
+        n_labelled = sum(1 for val in self.distinct_values if val in value_labels)
+        return n_labelled / len(self.distinct_values)
+
+    @staticmethod
+    def from_value_counts(name: str, dtype: Any, value_counts: pd.Series | None, *,
+            n_null: int, n_distinct: int | None = None, chunks_values_dtype: Any = None) -> 'ColumnProfile':
+        """
+        Args:
+            dtype: of the column (for a categorical, what matters is the dtype of the categories)
+            value_counts: non-null values as index. None if there were too many distinct values to count
+            n_distinct: only needed if value_counts is None
+            chunks_values_dtype: values dtype of the chunks the column was read in (if it was) - only used
+              if the column ended up as Python objects and there are too many distinct values to check them
+        """
+        is_categorical = isinstance(dtype, pd.CategoricalDtype)
+        values_dtype = dtype.categories.dtype if is_categorical else dtype  ## e.g. int8 for coded countries
+        if value_counts is not None:
+            value_counts = value_counts[value_counts > 0]  ## unused categories are still counted (as zero)
+            n_distinct = len(value_counts)
+        if values_dtype != np.dtype(object):
+            value_type = _get_value_type_from_dtype(values_dtype)
+        elif value_counts is not None:  ## e.g. ints and floats - what matters is the values not how they are held
+            value_type = _get_value_type_from_values(value_counts.index.tolist())
+        else:
+            value_type = _get_value_type_from_dtype(chunks_values_dtype)
+        if value_counts is not None and n_distinct <= MAX_PROFILED_DISTINCT_VALUES:
+            try:
+                value_counts = value_counts.sort_index()
+            except TypeError:  ## mixed types e.g. 1 and 'a'
+                value_counts = value_counts.iloc[sorted(range(n_distinct), key=lambda i: str(value_counts.index[i]))]
+            distinct_values = value_counts.index.tolist()  ## tolist() so Python types (not numpy) in options
+            counts = value_counts.astype(int).tolist()
+        else:
+            distinct_values = None
+            counts = None
+        return ColumnProfile(name=name, dtype=str(dtype), value_type=value_type,
+            n_distinct=n_distinct, n_null=n_null,
+            distinct_values=distinct_values, counts=counts)
+
+    @staticmethod
+    def from_series(series: pd.Series) -> 'ColumnProfile':
+        value_counts = series.value_counts(dropna=True, sort=False)
+        return ColumnProfile.from_value_counts(series.name, series.dtype, value_counts,
+            n_null=int(series.isna().sum()))
+
+
+@dataclass(frozen=True)
+class DatasetProfile:
+    n_rows: int
+    columns: dict[str, ColumnProfile]
+
+    @staticmethod
+    def from_df(df: pd.DataFrame) -> 'DatasetProfile':
+        columns = {col: ColumnProfile.from_series(df[col]) for col in df.columns}
+        return DatasetProfile(n_rows=len(df), columns=columns)
+
+
+def _get_common_dtype(dtype_a, dtype_b):
+    """
+    What the column would have been if every chunk had been read at once (near enough)
+    e.g. int64 and float64 -> float64 (a missing value turned up in a later chunk)
+    """
+    if dtype_a == dtype_b:
+        return dtype_a
+    is_numeric = lambda dtype: pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+    if is_numeric(dtype_a) and is_numeric(dtype_b):
+        return np.result_type(dtype_a, dtype_b)
+    return np.dtype(object)
+
+
+class DatasetProfileBuilder:
+    """
+    Builds the profile a chunk at a time while a CSV is being read, so the data never has to be scanned again.
+    Once a column has too many distinct values to be worth keeping, we stop counting them
+    and only work out how many there are at the end.
+    """
+
+    def __init__(self):
+        self.n_rows = 0
+        self.dtypes: dict[str, Any] = {}
+        self.n_nulls: dict[str, int] = {}
+        self.value_counts: dict[str, pd.Series | None] = {}
+
+    def add_chunk(self, df_chunk: pd.DataFrame):
+        self.n_rows += len(df_chunk)
+        for col in df_chunk.columns:
+            series = df_chunk[col]
+            self.n_nulls[col] = self.n_nulls.get(col, 0) + int(series.isna().sum())
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                series = series.astype(series.dtype.categories.dtype)  ## chunks may not share the same categories
+            self.dtypes[col] = _get_common_dtype(self.dtypes.get(col, series.dtype), series.dtype)
+            if col in self.value_counts and self.value_counts[col] is None:
+                continue  ## already too many distinct values
+            chunk_value_counts = series.value_counts(dropna=True, sort=False)
+            prev_value_counts = self.value_counts.get(col)
+            if prev_value_counts is not None:
+                chunk_value_counts = prev_value_counts.add(chunk_value_counts, fill_value=0)
+            if len(chunk_value_counts) > MAX_PROFILED_DISTINCT_VALUES:
+                chunk_value_counts = None
+            self.value_counts[col] = chunk_value_counts
+
+    def build(self, *, get_n_distinct: Callable[[str], int], dtypes: Mapping[str, Any] | None = None) -> DatasetProfile:
+        """
+        Args:
+            get_n_distinct: only called for columns where we gave up counting distinct values
+                e.g. lambda col: df[col].nunique()
+            dtypes: of the complete data if available (e.g. once compacted chunks have been put together).
+                Otherwise, worked out from the chunks.
+        """
+        dtypes = self.dtypes if dtypes is None else dtypes
+        columns = {}
+        for col, dtype in dtypes.items():
+            value_counts = self.value_counts.get(col)
+            n_distinct = int(get_n_distinct(col)) if value_counts is None else None
+            columns[col] = ColumnProfile.from_value_counts(col, dtype, value_counts,
+                n_null=self.n_nulls.get(col, 0), n_distinct=n_distinct, chunks_values_dtype=self.dtypes.get(col))
+        return DatasetProfile(n_rows=self.n_rows, columns=columns)
@@ -0,0 +1,110 @@
+"""
+Reports with their common CSS and scripts pulled out into shared, versioned asset files.
+
+Every report carries its own copy of the same styling (often twice - once in the head and again in the item itself)
+plus any library scripts. Someone generating hundreds of reports ends up with hundreds of copies.
+Instead, the styling is combined (duplicate blocks dropped) into one CSS bundle and any large inline script
+becomes its own file, both named by the hash of their content. Reports link to them in an assets subfolder
+so identical assets are written (and downloaded by the browser) once however many reports use them.
+Only JavaScript is moved - other inline scripts (e.g. type="application/json" data) are read in place so stay put.
+The rest of the report is left exactly as it was (whitespace can matter e.g. in pre elements)
+and can optionally be written gzipped - which is where most of the saving comes from anyway.
+
+Bundled reports are smaller but no longer self-contained so saving standalone reports (e.g. to email)
+is still the default - see OUTPUT_BUNDLE_ASSETS and OUTPUT_GZIP in conf.py.
+"""
+from dataclasses import dataclass
+import gzip
+import hashlib
+from pathlib import Path
+import re
+
+ASSETS_FOLDER_NAME = 'sofastats_assets'
+SCRIPT_ASSET_MIN_CHARS = 2_048  ## smaller inline scripts are usually specific to the report so left where they are
+
+STYLE_BLOCK_PATTERN = re.compile(r'<style\b[^>]*>(.*?)</style\s*>', flags=re.DOTALL | re.IGNORECASE)
+INLINE_SCRIPT_PATTERN = re.compile(r'<script\b(?![^>]*\bsrc=)([^>]*)>(.*?)</script\s*>', flags=re.DOTALL | re.IGNORECASE)
+SCRIPT_TYPE_PATTERN = re.compile(r'(?:^|\s)type\s*=\s*["\']?([^"\'\s>]*)', flags=re.IGNORECASE)
+## not module - relative imports would then resolve against the asset file rather than the report
+JAVASCRIPT_TYPES = {'', 'text/javascript', 'application/javascript', 'application/x-javascript',
+    'text/ecmascript', 'application/ecmascript'}
+
+
+@dataclass(frozen=True)
+class BundledReport:
+    html: str
+    assets: dict[str, str]  ## asset file name -> content
+
+
+def _get_asset_name(content: str, suffix: str) -> str:
+    return f"sofastats-{hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]}{suffix}"
+
+def minify_css(css: str) -> str:
+    css = css.replace('<!--', '').replace('-->', '')  ## old-school hiding of CSS from ancient browsers
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)  ## not before the colon - 'div :hover' isn't 'div:hover'
+    return css.replace(';}', '}').strip()
+
+def is_javascript(script_attrs: str) -> bool:
+    type_match = SCRIPT_TYPE_PATTERN.search(script_attrs)
+    return type_match is None or type_match.group(1).strip().lower() in JAVASCRIPT_TYPES
+
+def bundle_report(html: str) -> BundledReport:
+    """
+    Returns:
+        report linking to its assets in ASSETS_FOLDER_NAME (relative to wherever the report ends up)
+    """
+    assets = {}
+    ## one CSS bundle - when the same block appears more than once the last wins anyway so only it is kept
+    css_blocks = [minify_css(css) for css in STYLE_BLOCK_PATTERN.findall(html)]
+    css_blocks = [css for css in css_blocks if css]
+    deduped_css_blocks = list(reversed(dict.fromkeys(reversed(css_blocks))))
+    html = STYLE_BLOCK_PATTERN.sub('', html)
+    if deduped_css_blocks:
+        css = '\n'.join(deduped_css_blocks)
+        css_name = _get_asset_name(css, '.css')
+        assets[css_name] = css
+        css_link = f'<link rel="stylesheet" href="{ASSETS_FOLDER_NAME}/{css_name}">'
+        head_end_idx = html.lower().find('</head>')
+        if head_end_idx == -1:  ## just the report item e.g. as shown in the Results tab
+            html = css_link + html
+        else:
+            html = html[:head_end_idx] + css_link + html[head_end_idx:]
+    ## large scripts become files but stay in the same place so they still run in the same order
+    def externalise_script(match: re.Match) -> str:
+        attrs, script = match.groups()
+        if len(script) < SCRIPT_ASSET_MIN_CHARS or not is_javascript(attrs):
+            return match.group(0)
+        script_name = _get_asset_name(script, '.js')
+        assets[script_name] = script
+        return f'<script{attrs} src="{ASSETS_FOLDER_NAME}/{script_name}"></script>'
+    html = INLINE_SCRIPT_PATTERN.sub(externalise_script, html)
+    return BundledReport(html=html, assets=assets)
+
+def write_report(html: str, fpath: Path, *, bundle_assets=False, gzip_output=False) -> Path:
+    """
+    Args:
+        fpath: e.g. 'ANOVA.html'. If gzipped, '.gz' is added.
+        bundle_assets: write common CSS and scripts to the assets subfolder next to the report (once only)
+
+    Returns:
+        where the report was written
+    """
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    if bundle_assets:
+        bundled_report = bundle_report(html)
+        html = bundled_report.html
+        assets_dpath = fpath.parent / ASSETS_FOLDER_NAME
+        assets_dpath.mkdir(exist_ok=True)
+        for asset_name, asset_content in bundled_report.assets.items():
+            asset_fpath = assets_dpath / asset_name
+            if not asset_fpath.exists():  ## content-hashed name so an existing file already has this content
+                asset_fpath.write_text(asset_content, encoding='utf-8')
+    if gzip_output:
+        fpath = fpath.with_name(f"{fpath.name}.gz")
+        fpath.write_bytes(gzip.compress(html.encode('utf-8'), mtime=0))
+    else:
+        fpath.write_text(html, encoding='utf-8')
+    return fpath
@@ -0,0 +1,212 @@
+"""
+Generated reports served at content-hashed URLs.
+
+Putting the whole report in an iframe's srcdoc meant HTML-escaping it and sending it through the websocket
+every time the Results tab was rebuilt - even when only the "saved" message had changed.
+Instead, each report is published once under the hash of its content and the iframe just points at the URL.
+Because the URL changes whenever the content does, the browser can cache a report for good
+and the ETag lets it revalidate cheaply if it asks anyway. The gzipped copy is made once when published.
+
+Reports are served bundled (see report_bundle.py) - their common CSS and scripts come from
+content-hashed asset URLs next to them so the browser downloads those once however many reports are shown.
+
+The handler is mounted alongside the Panel app with `panel serve --plugins sofastats_app.ui.reports`
+(see panel_server.py). Reports are kept in memory - least recently published dropped first
+once REPORT_STORE_MAX_BYTES is reached. The results cache holds the HTML itself so a dropped report
+is simply published again the next time it is shown.
+They are also written to REPORT_STORE_FOLDER (kept to the same size limit) because, with several server processes,
+the browser's request for a report may arrive at a different process from the one which published it.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+import gzip
+import hashlib
+import os
+from pathlib import Path
+import threading
+
+from tornado.web import HTTPError, RequestHandler
+
+from sofastats_app import logger
+from sofastats_app.ui.conf import REPORT_STORE_FOLDER, REPORT_STORE_MAX_BYTES, REPORT_URL_PREFIX
+from sofastats_app.ui.report_bundle import ASSETS_FOLDER_NAME, bundle_report
+
+GZIP_MIN_BYTES = 1_024  ## not worth compressing anything smaller
+CONTENT_TYPES = {
+    '.css': 'text/css; charset=UTF-8',
+    '.html': 'text/html; charset=UTF-8',
+    '.js': 'application/javascript; charset=UTF-8',
+}
+
+
+@dataclass(frozen=True)
+class PublishedReport:
+    """
+    A report or one of its assets
+    """
+    content: bytes
+    gzipped_content: bytes | None
+
+    @classmethod
+    def from_str(cls, content_str: str) -> 'PublishedReport':
+        return cls.from_bytes(content_str.encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> 'PublishedReport':
+        gzipped_content = gzip.compress(content, compresslevel=6) if len(content) >= GZIP_MIN_BYTES else None
+        return cls(content=content, gzipped_content=gzipped_content)
+
+    @property
+    def n_bytes(self) -> int:
+        return len(self.content) + len(self.gzipped_content or b'')
+
+
+class ReportStore:
+
+    def __init__(self, max_bytes: int, store_dpath: Path | None = None):
+        """
+        Args:
+            store_dpath: also write everything here so other processes can serve it
+        """
+        self.max_bytes = max_bytes
+        self.store_dpath = store_dpath
+        self.n_bytes = 0
+        self._lock = threading.Lock()
+        self._reports: OrderedDict[str, PublishedReport] = OrderedDict()  ## path (relative to REPORT_URL_PREFIX) -> report or asset
+        self._asset_paths: dict[str, list[str]] = {}  ## report path -> paths of its assets
+
+    def _add(self, path: str, report: PublishedReport):
+        """
+        Must hold the lock
+        """
+        if path not in self._reports:
+            self._reports[path] = report
+            self.n_bytes += report.n_bytes
+        self._reports.move_to_end(path)
+        while self.n_bytes > self.max_bytes and len(self._reports) > 1:
+            dropped_path, dropped_report = self._reports.popitem(last=False)
+            self._asset_paths.pop(dropped_path, None)
+            self.n_bytes -= dropped_report.n_bytes
+
+    def _write_to_store(self, path: str, content: bytes):
+        fpath = self.store_dpath / path
+        if fpath.exists():  ## content-hashed name so already has this content
+            fpath.touch()  ## recently used so last to be evicted
+            return
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fpath = fpath.with_name(f"{fpath.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_fpath.write_bytes(content)
+        tmp_fpath.replace(fpath)  ## atomic so no process ever serves half a report
+
+    def _evict_from_store(self):
+        fpath_stats = []
+        for fpath in self.store_dpath.rglob('*'):
+            try:
+                if fpath.is_file() and fpath.suffix != '.tmp':
+                    fpath_stats.append((fpath, fpath.stat()))
+            except FileNotFoundError:  ## evicted by another process
+                continue
+        total_bytes = sum(stat.st_size for _fpath, stat in fpath_stats)
+        for fpath, stat in sorted(fpath_stats, key=lambda fpath_stat: fpath_stat[1].st_mtime):
+            if total_bytes <= self.max_bytes:
+                break
+            fpath.unlink(missing_ok=True)
+            total_bytes -= stat.st_size
+
+    def publish(self, html: str) -> str:
+        """
+        Returns:
+            route path the report is served from (the same path for the same content) - see get_url
+        """
+        report_path = f"{hashlib.sha256(html.encode('utf-8')).hexdigest()}.html"
+        is_in_store = not self.store_dpath or (self.store_dpath / report_path).exists()  ## e.g. evicted by another process
+        with self._lock:
+            if report_path in self._reports and is_in_store:
+                for asset_path in self._asset_paths.get(report_path, []):  ## keep its assets as fresh as the report
+                    if asset_path in self._reports:
+                        self._reports.move_to_end(asset_path)
+                self._reports.move_to_end(report_path)
+                return self.get_url(report_path)
+        bundled_report = bundle_report(html)
+        path_contents = {f"{ASSETS_FOLDER_NAME}/{asset_name}": asset_content.encode('utf-8')
+            for asset_name, asset_content in bundled_report.assets.items()}
+        asset_paths = list(path_contents)
+        path_contents[report_path] = bundled_report.html.encode('utf-8')  ## last so the assets are there first
+        if self.store_dpath:
+            try:
+                for path, content in path_contents.items():
+                    self._write_to_store(path, content)
+                self._evict_from_store()
+            except OSError as e:  ## still servable by this process
+                logger.info(f"Unable to write report {report_path} to '{self.store_dpath}'. Orig error: {e}")
+        with self._lock:
+            for path, content in path_contents.items():
+                self._add(path, PublishedReport.from_bytes(content))
+            self._asset_paths[report_path] = asset_paths
+        return self.get_url(report_path)
+
+    def get(self, path: str) -> PublishedReport | None:
+        with self._lock:
+            report = self._reports.get(path)
+        if report or not self.store_dpath:
+            return report
+        try:  ## published by another server process
+            report = PublishedReport.from_bytes((self.store_dpath / path).read_bytes())
+        except OSError:
+            return None
+        with self._lock:
+            self._add(path, report)
+        return report
+
+    @staticmethod
+    def get_url(path: str) -> str:
+        """
+        Route path on the server - make it relative to the page (see utils.get_app_url) before giving it to the browser
+        """
+        return f"{REPORT_URL_PREFIX}/{path}"
+
+
+report_store = ReportStore(REPORT_STORE_MAX_BYTES, store_dpath=REPORT_STORE_FOLDER)  ## shared by all sessions
+
+
+class ReportHandler(RequestHandler):
+
+    def _get_report(self, path: str) -> PublishedReport:
+        report = report_store.get(path)
+        if not report:
+            raise HTTPError(404)
+        self.set_header('Content-Type', CONTENT_TYPES[Path(path).suffix])
+        self.set_header('Cache-Control', 'private, max-age=31536000, immutable')  ## content never changes at this URL
+        self.set_header('ETag', f'"{Path(path).stem}"')  ## the stem is the content hash
+        self.set_header('Vary', 'Accept-Encoding')
+        return report
+
+    def _is_not_modified(self) -> bool:
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    def _get_body(self, report: PublishedReport) -> bytes:
+        if report.gzipped_content and 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            return report.gzipped_content
+        return report.content
+
+    def head(self, path: str):
+        report = self._get_report(path)
+        if not self._is_not_modified():
+            self.set_header('Content-Length', str(len(self._get_body(report))))
+
+    def get(self, path: str):
+        report = self._get_report(path)
+        if not self._is_not_modified():
+            self.write(self._get_body(report))
+
+    def compute_etag(self) -> str | None:
+        return None  ## the ETag is the content hash (set above) - no need to hash the body again
+
+
+ROUTES = [  ## picked up by panel serve --plugins
+    (rf'{REPORT_URL_PREFIX}/([0-9a-f]{{64}}\.html|{ASSETS_FOLDER_NAME}/sofastats-[0-9a-f]{{16}}\.(?:css|js))', ReportHandler),
+]
@@ -0,0 +1,38 @@
+"""
+Run by each server process before it serves any sessions (`panel serve --setup server_setup.py` - see panel_server.py).
+
+Imports the heavy modules ui.py needs so the first session in a process doesn't wait for them,
+and logs how long each took - the import part of the startup breakdown.
+The rest is logged by ui.py (building each session's widgets and template)
+and panel_server.py (how long until the server answers).
+"""
+import importlib
+import time
+
+from sofastats_app import logger
+
+UI_MODULE_NAMES = (  ## roughly in order of how much they drag in
+    'pandas',
+    'panel',
+    'sofastats_app.ui.data',
+    'sofastats_app.ui.charts_and_tables',
+    'sofastats_app.ui.stats.stats_tab',
+    'sofastats_app.ui.ui_template',
+    'sofastats_app.ui.reports',
+)
+
+def import_ui_modules() -> dict[str, float]:
+    """
+    Returns:
+        seconds taken by each module (anything already imported by an earlier one takes next to none)
+    """
+    secs_by_module_name = {}
+    for module_name in UI_MODULE_NAMES:
+        start = time.perf_counter()
+        importlib.import_module(module_name)
+        secs_by_module_name[module_name] = time.perf_counter() - start
+    return secs_by_module_name
+
+secs_by_module_name = import_ui_modules()
+breakdown = '; '.join(f"{module_name} {secs:.2f}s" for module_name, secs in secs_by_module_name.items())
+logger.info(f"Heavy imports took {sum(secs_by_module_name.values()):.2f}s ({breakdown})")
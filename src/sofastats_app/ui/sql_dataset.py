@@ -0,0 +1,141 @@
+"""
+Out-of-core access to a dataset held only in the app's SQLite database.
+
+A 50 GB survey extract won't fit in a data frame. So when a CSV is bigger than OUT_OF_CORE_MIN_BYTES
+it is streamed straight into SQLite (see data_source.TableIngestion) and never held in memory as a whole.
+Everything the app needs afterwards - preview pages, distinct values for option lists, value counts,
+and the per-group aggregates behind the stats - is a query against that table.
+The stats themselves already work this way because designs are given a cursor and table name (see data_source.py).
+"""
+from collections.abc import Sequence
+import hashlib
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+from sofastats_app.ui.data_source import get_sqlite_con
+
+def quote_name(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SqlDataset:
+
+    def __init__(self, table_name: str, cols: Sequence[str]):
+        self.table_name = table_name
+        self.cols = list(cols)
+
+    def _query_df(self, sql: str, params: Sequence[Any] = ()) -> pd.DataFrame:
+        return pd.read_sql_query(sql, get_sqlite_con(), params=list(params))
+
+    def _query_val(self, sql: str, params: Sequence[Any] = ()) -> Any:
+        cur = get_sqlite_con().cursor()
+        try:
+            cur.execute(sql, list(params))
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+    def count_rows(self, where_sql: str = '', params: Sequence[Any] = ()) -> int:
+        """
+        Args:
+            where_sql: e.g. 'WHERE "country" = ?' (with params holding the values)
+        """
+        return self._query_val(f"SELECT COUNT(*) FROM {quote_name(self.table_name)} {where_sql}", params)
+
+    def count_distinct(self, col: str) -> int:
+        return self._query_val(f"SELECT COUNT(DISTINCT {quote_name(col)}) FROM {quote_name(self.table_name)}")
+
+    def get_distinct_values(self, col: str) -> list[Any]:
+        sql = (f"SELECT DISTINCT {quote_name(col)} AS val FROM {quote_name(self.table_name)} "
+            f"WHERE {quote_name(col)} IS NOT NULL ORDER BY {quote_name(col)}")
+        return self._query_df(sql)['val'].tolist()
+
+    def get_value_counts(self, col: str) -> pd.Series:
+        sql = (f"SELECT {quote_name(col)} AS val, COUNT(*) AS n FROM {quote_name(self.table_name)} "
+            f"WHERE {quote_name(col)} IS NOT NULL GROUP BY {quote_name(col)} ORDER BY {quote_name(col)}")
+        df = self._query_df(sql)
+        return pd.Series(df['n'].to_numpy(), index=df['val'], name=col)
+
+    def get_col_values(self, col: str, *, where_sql: str = '', params: Sequence[Any] = (), sort=False) -> np.ndarray:
+        order_sql = f"ORDER BY {quote_name(col)}" if sort else ''
+        sql = f"SELECT {quote_name(col)} AS val FROM {quote_name(self.table_name)} {where_sql} {order_sql}"
+        return self._query_df(sql, params)['val'].to_numpy()
+
+    def add_sort_index(self, col: str, *, descending=False):
+        """
+        Index matching the ORDER BY in get_rows_df so a page of sorted rows doesn't mean sorting the whole table.
+        Made the first time a column is sorted on (in that direction). Run in a worker thread.
+        """
+        direction = 'DESC' if descending else 'ASC'
+        col_hash = hashlib.sha256(col.encode('utf-8')).hexdigest()[:16]
+        index_name = quote_name(f"{self.table_name}_sort_{col_hash}_{direction.lower()}")
+        con = get_sqlite_con()
+        con.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {quote_name(self.table_name)} "
+            f"(({quote_name(col)} IS NULL), {quote_name(col)} {direction})")
+        con.commit()
+
+    def get_rows_df(self, *, where_sql: str = '', params: Sequence[Any] = (),
+            sort_col: str | None = None, descending=False, offset: int = 0, limit: int = 10) -> pd.DataFrame:
+        """
+        One page of rows. The row positions (rowid) are kept as the index like iloc positions in the in-memory preview.
+        """
+        order_sql = ''
+        if sort_col:
+            direction = 'DESC' if descending else 'ASC'
+            order_sql = f"ORDER BY {quote_name(sort_col)} IS NULL, {quote_name(sort_col)} {direction}, rowid"
+        sql = (f"SELECT rowid - 1 AS row_position, * FROM {quote_name(self.table_name)} "
+            f"{where_sql} {order_sql} LIMIT ? OFFSET ?")
+        df = self._query_df(sql, [*params, limit, offset])
+        return df.set_index('row_position').rename_axis(None)
+
+    def get_group_aggregates(self, measure_col: str, grouping_col: str,
+            group_vals: Sequence[Any] | None = None) -> pd.DataFrame:
+        """
+        Count, mean, and sum of squared deviations from the mean of the measure for each group -
+        enough for variances and F. Only non-null measure values are included.
+        Deviations are from each group's own mean (a second pass in the same query) because sums of raw squares
+        lose precision for large-magnitude measures.
+
+        Returns:
+            indexed by group value with columns n, mean, sum_sq_dev
+        """
+        return self.get_group_aggregates_for_measures([measure_col], grouping_col, group_vals).rename(
+            columns={f"{measure_col}|{stat}": stat for stat in ('n', 'mean', 'sum_sq_dev')})
+
+    def get_group_aggregates_for_measures(self, measure_cols: Sequence[str], grouping_col: str,
+            group_vals: Sequence[Any] | None = None) -> pd.DataFrame:
+        """
+        Count (non-null), mean, and sum of squared deviations from the mean of many measures for each group
+        in a single query (the group means first then the deviations from them).
+
+        Returns:
+            indexed by group value with columns e.g. 'height|n', 'height|mean', 'height|sum_sq_dev'
+        """
+        table_sql = quote_name(self.table_name)
+        grouping_sql = quote_name(grouping_col)
+        where_sql = f"WHERE {grouping_sql} IS NOT NULL"
+        params = []
+        if group_vals is not None:
+            where_sql += f" AND {grouping_sql} IN ({', '.join('?' * len(group_vals))})"
+            params.extend(group_vals)
+        mean_clauses = []
+        select_clauses = []
+        for i, measure_col in enumerate(measure_cols):
+            measure_sql = f"{table_sql}.{quote_name(measure_col)}"
+            mean_clauses.append(f"AVG({measure_sql}) AS mean_{i}")
+            deviation_sql = f"({measure_sql} - group_means.mean_{i})"
+            select_clauses.extend([f"COUNT({measure_sql}) AS n_{i}", f"group_means.mean_{i} AS mean_{i}",
+                f"SUM({deviation_sql} * {deviation_sql}) AS sum_sq_dev_{i}"])
+        sql = (f"WITH group_means AS (SELECT {grouping_sql} AS group_val, {', '.join(mean_clauses)} "
+                f"FROM {table_sql} {where_sql} GROUP BY {grouping_sql}) "
+            f"SELECT group_means.group_val AS group_val, {', '.join(select_clauses)} "
+            f"FROM {table_sql} JOIN group_means ON {table_sql}.{grouping_sql} = group_means.group_val "
+            f"GROUP BY group_means.group_val")
+        df = self._query_df(sql, params).set_index('group_val')
+        col_names = {}
+        for i, measure_col in enumerate(measure_cols):
+            for stat in ('n', 'mean', 'sum_sq_dev'):
+                col_names[f"{stat}_{i}"] = f"{measure_col}|{stat}"
+        return df.rename(columns=col_names)
@@ -0,0 +1,72 @@
+"""
+Run analyses without blocking the Bokeh event loop.
+
+Every session on a server shares one event loop so a slow analysis run inside a callback freezes everyone.
+Instead, analyses are run in a small thread pool and awaited from async callbacks.
+
+The output modules of sofastats_lib are slow to import (matplotlib etc.) so they are only imported when needed.
+preload_analysis_modules imports them in the pool once a session has started so the first analysis doesn't wait.
+
+Only one report is rendered at a time though (see render_html_design) - sofastats_lib draws charts with
+matplotlib's pyplot and changes its global rcParams, neither of which is thread-safe.
+Everything else (ingesting data, group statistics, screening) still runs in parallel.
+
+Cancelling drops a queued analysis immediately.
+One that is already running cannot be interrupted (it is inside sofastats_lib)
+so it runs to completion in the background, and its result is discarded.
+"""
+import asyncio
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+import importlib
+import threading
+import time
+from typing import Any
+
+from sofastats_app import logger
+from sofastats_app.ui.conf import ANALYSIS_WORKERS
+
+ANALYSIS_MODULE_NAMES = ('sofastats.output.stats.anova', )
+
+analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix='sofastats_analysis')
+_preload_lock = threading.Lock()
+_preload_future: Future | None = None
+_render_lock = threading.Lock()  ## see render_html_design
+
+def _import_analysis_modules():
+    start = time.perf_counter()
+    for module_name in ANALYSIS_MODULE_NAMES:
+        importlib.import_module(module_name)
+    logger.info(f"Analysis modules imported in {time.perf_counter() - start:.2f}s")
+
+def preload_analysis_modules() -> Future:
+    """
+    Import the analysis modules in the background (once per process). Returns straight away.
+    """
+    global _preload_future
+    with _preload_lock:
+        if _preload_future is None:
+            _preload_future = analysis_executor.submit(_import_analysis_modules)
+        return _preload_future
+
+def submit_analysis(fn: Callable[..., Any], *args) -> asyncio.Future:
+    """
+    Must be called from the event loop e.g. inside an async callback.
+    Await the result or call .cancel() on it.
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(analysis_executor, fn, *args)
+
+def render_html_design(design: Any) -> Any:
+    """
+    Call design.to_html_design() - one design at a time across all workers.
+    Two sessions rendering at once could otherwise end up with each other's chart settings or corrupted charts.
+
+    Args:
+        design: e.g. a sofastats_lib AnovaDesign
+
+    Returns:
+        the design's HTMLItemSpec
+    """
+    with _render_lock:
+        return design.to_html_design()
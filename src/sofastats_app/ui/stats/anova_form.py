@@ -1,16 +1,23 @@
+import asyncio
+from collections.abc import Callable
 import datetime
 from typing import Any
 
+import pandas as pd
 import panel as pn
 
 from sofastats.conf.main import DEFAULT_OUTPUT_FOLDER
-from sofastats.output.stats import anova
+from sofastats_app import logger
 from sofastats_app.ui.conf import SharedKey
-from sofastats_app.ui.state import (
-    Text,
-    data_labels_param, give_output_tab_focus_param, html_param,
-    shared, show_output_saved_msg_param, show_output_tab_param)
+from sofastats_app.ui.data_source import get_data_source
+from sofastats_app.ui.state import Text
+from sofastats_app.ui.stats.analysis_runner import render_html_design, submit_analysis
+from sofastats_app.ui.stats.group_stats import (GroupSummary, get_anova_f_and_p, get_screening_results,
+    group_stats_cache)
+from sofastats_app.ui.stats.results_cache import results_cache
+from sofastats_app.ui.stats.results_history import results_history
 from sofastats_app.ui.utils import get_unlabelled
+from sofastats_app.ui.workspace import get_workspace
 
 pn.extension('modal')
 css = """\
@@ -29,20 +36,16 @@ class ANOVAForm:
         E.g. If variable is country, and we extract '1' from option 'nz (1)' then we want int() to restore to 1
         If variable is name, and we extract 'Grant' from 'Grant' then str('Grant') will return (what would already have been) the correct result
         """
-        dtype = dict(shared[SharedKey.DF_CSV].dtypes.items())[var]
-        if dtype in ('int64', ):
-            return int
-        elif dtype in ('float64', ):
-            return float
-        else:
-            return str
+        return get_workspace().shared[SharedKey.DATASET_PROFILE].columns[var].value_type
 
     @staticmethod
     def get_measure_options() -> list[str]:
+        workspace = get_workspace()
+        data_labels_param = workspace.data_labels_param
         measure_cols = []
-        for name, dtype in shared[SharedKey.DF_CSV].dtypes.items():
+        for name, column_profile in workspace.shared[SharedKey.DATASET_PROFILE].columns.items():
             has_val_labels = bool(data_labels_param.value.get(name, {}).get('value_labels'))
-            if dtype in ('int64', 'float64') and not has_val_labels:
+            if column_profile.is_numeric and not has_val_labels:
                 measure_cols.append(name)
         measure_options = []
         for measure_col in measure_cols:
@@ -53,8 +56,10 @@ class ANOVAForm:
 
     @staticmethod
     def get_grouping_options() -> list[str]:
+        workspace = get_workspace()
+        data_labels_param = workspace.data_labels_param
         grouping_options = []
-        for grouping_col in shared[SharedKey.DF_CSV].columns:
+        for grouping_col in workspace.shared[SharedKey.DATASET_PROFILE].columns:
             grouping_var_lbl = data_labels_param.value.get(grouping_col, {}).get('variable_label')
             grouping_option = f"{grouping_var_lbl} ({grouping_col})" if grouping_var_lbl else grouping_col  ## e.g. ['Sport (sport)', ]
             grouping_options.append(grouping_option)
@@ -62,8 +67,15 @@ class ANOVAForm:
 
     @staticmethod
     def get_value_options(grouping_variable: str) -> list[str]:
-        vals = sorted(shared[SharedKey.DF_CSV][grouping_variable].unique())
-        value_label_mappings = data_labels_param.value.get(grouping_variable, {}).get('value_labels', {})
+        workspace = get_workspace()
+        vals = workspace.shared[SharedKey.DATASET_PROFILE].columns[grouping_variable].distinct_values
+        if vals is None:  ## too many to keep in the profile - unlikely to be a sensible grouping variable but still allowed
+            sql_dataset = workspace.shared.get(SharedKey.SQL_DATASET)
+            if sql_dataset:
+                vals = sql_dataset.get_distinct_values(grouping_variable)
+            else:
+                vals = sorted(workspace.shared[SharedKey.DF_CSV][grouping_variable].dropna().unique().tolist(), key=str)
+        value_label_mappings = workspace.data_labels_param.value.get(grouping_variable, {}).get('value_labels', {})
         value_options = []
         for val in vals:
             val_lbl = value_label_mappings.get(val)
@@ -71,39 +83,106 @@ class ANOVAForm:
             value_options.append(val_option)
         return value_options
 
-    def get_values_multiselect_or_none(self, grouping_variable_str: str):
-        if not grouping_variable_str:
-            return None
-        value_options = ANOVAForm.get_value_options(grouping_variable_str)
-        group_value_selector = pn.widgets.CheckButtonGroup(name='Group Values',
-            options=value_options, orientation='vertical', button_type='primary', button_style='outline',
-        )
-        self.group_value_selector = group_value_selector
-        btn_select_all = pn.widgets.Button(name='Select All Values')
-        def toggle_select_all(event):
-            if btn_select_all.name == 'Select All Values':
-                group_value_selector.value = value_options  ## Select all
-                btn_select_all.name = 'Deselect All Values'
-            else:
-                group_value_selector.value = []  ## Deselect all
-                btn_select_all.name = 'Select All Values'
-        btn_select_all.on_click(toggle_select_all)
-        group_value_selector_col = pn.Column(group_value_selector, btn_select_all)
-        return group_value_selector_col
-
-    def set_grouping_variable(self, grouping_variable_option: str):
-        grouping_variable = get_unlabelled(grouping_variable_option)
+    def update_group_value_options(self, grouping_variable: str | None):
+        """
+        Same widgets for every grouping variable - only their options and values change
+        """
+        self.group_summary.object = ''  ## nothing selected yet for the new grouping variable
+        self.group_value_selector.value = []
+        self.btn_select_all.name = 'Select All Values'
+        self.group_value_selector.options = ANOVAForm.get_value_options(grouping_variable) if grouping_variable else []
+        self.group_value_selector_col.visible = bool(grouping_variable)
+
+    def toggle_select_all(self, _event):
+        if self.btn_select_all.name == 'Select All Values':
+            self.group_value_selector.value = list(self.group_value_selector.options)  ## Select all
+            self.btn_select_all.name = 'Deselect All Values'
+        else:
+            self.group_value_selector.value = []  ## Deselect all
+            self.btn_select_all.name = 'Select All Values'
+
+    def set_grouping_variable(self, grouping_variable_option: str | None):
+        grouping_variable = get_unlabelled(grouping_variable_option) if grouping_variable_option else None
         self.grouping_variable_var.value = grouping_variable
 
+    def get_selected_group_vals(self) -> list[Any]:
+        grouping_variable_name = get_unlabelled(self.select_grouping_variable.value)
+        var_restoration_fn = ANOVAForm.var_restoration_fn_from_var_from_option(grouping_variable_name)
+        return sorted(var_restoration_fn(get_unlabelled(val))
+            for val in self.group_value_selector.value)  ## same order as options no matter what order clicked in
+
+    def get_group_summaries_fn(self) -> Callable[[], dict[Any, GroupSummary]]:
+        """
+        Reads everything it needs from the session now so the returned function can run off the event loop
+        """
+        shared = self.workspace.shared
+        data = shared.get(SharedKey.SQL_DATASET) or shared[SharedKey.DF_CSV]
+        dataset_hash = shared[SharedKey.DATASET_HASH]
+        measure_field_name = get_unlabelled(self.measure.value)
+        grouping_variable_name = get_unlabelled(self.select_grouping_variable.value)
+        return lambda: group_stats_cache.get_summaries(data, dataset_hash=dataset_hash,
+            measure_col=measure_field_name, grouping_col=grouping_variable_name)
+
+    async def get_group_summaries(self) -> dict[Any, GroupSummary]:
+        """
+        Summaries for every group of the current measure and grouping variable.
+        Only the first request for a measure and grouping variable needs a pass over the data (off the event loop).
+        """
+        return await submit_analysis(self.get_group_summaries_fn())
+
+    async def update_group_summary(self, _event):
+        """
+        Live n, mean, and SD for each selected group plus F and p - so analysts can try out different groupings
+        without generating a full report each time
+        """
+        self._n_group_summary_requests += 1
+        request_n = self._n_group_summary_requests
+        if not (self.group_value_selector.value and self.measure.value):
+            self.group_summary.object = ''
+            self.group_summary.loading = False  ## an earlier request may still be running but its result isn't wanted
+            return
+        group_vals = self.get_selected_group_vals()
+        self.group_summary.loading = True
+        try:
+            group_summaries = await self.get_group_summaries()
+        except Exception as e:
+            if request_n == self._n_group_summary_requests:
+                logger.info(f"Unable to work out group statistics. Orig error: {e}")
+                self.group_summary.object = "Unable to work out group statistics for this selection"
+                self.group_summary.loading = False
+            return
+        if request_n != self._n_group_summary_requests:
+            return  ## the selection has changed since - that request will show its own summary
+        self.group_summary.loading = False
+        grouping_variable_name = get_unlabelled(self.select_grouping_variable.value)
+        value_label_mappings = self.workspace.data_labels_param.value.get(
+            grouping_variable_name, {}).get('value_labels', {})
+        rows = ["| Group | N | Mean | SD |", "|:--|--:|--:|--:|"]
+        selected_summaries = []
+        for group_val in group_vals:
+            group_lbl = value_label_mappings.get(group_val, group_val)
+            summary = group_summaries.get(group_val)
+            if summary is None:
+                rows.append(f"| {group_lbl} | 0 | | |")
+                continue
+            selected_summaries.append(summary)
+            rows.append(f"| {group_lbl} | {summary.n:,} | {summary.mean:.3f} | {summary.sd:.3f} |")
+        f_and_p = get_anova_f_and_p(selected_summaries) if len(selected_summaries) > 1 else None
+        if f_and_p:
+            F, p = f_and_p
+            rows.append(f"\nF = {F:.3f}, p = {p:.4g}")
+        self.group_summary.object = '\n'.join(rows)
+
     def __init__(self, btn_close: pn.widgets.Button):
         """
         Args:
             btn_close: passed in so we can set its on_click event to closing this modal from the outside
         """
+        self.workspace = get_workspace()
         self.user_msg_var = Text(value=None)
         self.grouping_variable_var = Text(value=None)
-        self.group_value_selector = None
-        self.user_msg_or_none = pn.bind(self.set_user_msg, self.user_msg_var.param.value)
+        self.user_msg_alert = pn.pane.Alert('', alert_type='warning', visible=False)
+        self.user_msg_var.param.watch(lambda event: self.set_user_msg(event.new), 'value')
         ## Measure Variable
         measure_options = ANOVAForm.get_measure_options()
         only_one_option = len(measure_options) == 1
@@ -117,16 +196,26 @@ class ANOVAForm:
                 description='Measure which varies between different groups ...',
                 options=measure_options,
             )
+        self.measure.param.watch(self.update_group_summary, 'value')
         ## Grouping Variable
         grouping_options = ANOVAForm.get_grouping_options()
         self.select_grouping_variable = pn.widgets.Select(name='Grouping Variable',
             description='Variable containing the groups ...',
             options=grouping_options,
         )
-        self.set_grouping_var = pn.bind(self.set_grouping_variable, self.select_grouping_variable.param.value)  ## set to a variable I can access when returning the item which goes in the template (thus making the param work)
-        ## Group Values
-        self.values_multiselect_or_none = pn.bind(
-            self.get_values_multiselect_or_none, self.grouping_variable_var.param.value)
+        ## Group Values (built once and updated in place when the grouping variable changes)
+        self.group_summary = pn.pane.Markdown('', styles={'font-size': '12px'})  ## see update_group_summary
+        self._n_group_summary_requests = 0  ## so a summary which arrives after a newer selection is ignored
+        self.group_value_selector = pn.widgets.CheckButtonGroup(name='Group Values',
+            options=[], orientation='vertical', button_type='primary', button_style='outline',
+        )
+        self.group_value_selector.param.watch(self.update_group_summary, 'value')
+        self.btn_select_all = pn.widgets.Button(name='Select All Values')
+        self.btn_select_all.on_click(self.toggle_select_all)
+        self.group_value_selector_col = pn.Column(self.group_value_selector, self.btn_select_all, visible=False)
+        self.grouping_variable_var.param.watch(lambda event: self.update_group_value_options(event.new), 'value')
+        self.select_grouping_variable.param.watch(lambda event: self.set_grouping_variable(event.new), 'value')
+        self.set_grouping_variable(self.select_grouping_variable.value)
         ## Buttons
         btn_run_analysis_stylesheet = """
         :host(.solid) .bk-btn.bk-btn-primary {
@@ -135,10 +224,55 @@ class ANOVAForm:
         """
         self.btn_run_analysis = pn.widgets.Button(name="Get ANOVA Results", button_type='primary', stylesheets=[btn_run_analysis_stylesheet])
         self.btn_run_analysis.on_click(self.run_analysis)
+        self.analysis_running_indicator = pn.indicators.LoadingSpinner(
+            value=True, visible=False, size=30, name="Running ANOVA ...")
+        self.btn_screen_measures = pn.widgets.Button(name="Screen All Measures",
+            description="Quick ANOVA of every measure across the selected groups - pick which to get full results for")
+        self.btn_screen_measures.on_click(self.run_screening)
+        self.screening_results = pn.widgets.Tabulator(pd.DataFrame(), visible=False, disabled=True,
+            show_index=False, height=300, buttons={'report': "Get Results"})  ## sortable by clicking headers
+        self.screening_results.on_click(self.open_screening_report, column='report')
+        self.btn_cancel_analysis = pn.widgets.Button(name="Cancel", button_type='warning', visible=False)
+        self.btn_cancel_analysis.on_click(self.cancel_analysis)
+        self.analysis_job = None
+        self.is_analysis_running = False  ## see set_analysis_running
+        self.is_cancelled = False  ## so an analysis with several steps stops at the next one
         self.btn_close = btn_close
 
-    def run_analysis(self, _event):
-        show_output_saved_msg_param.value = False  ## have to wait for Save Output button to be clicked again now
+    def set_analysis_running(self, is_running: bool):
+        self.is_analysis_running = is_running
+        self.btn_run_analysis.disabled = is_running
+        self.btn_screen_measures.disabled = is_running
+        self.analysis_running_indicator.visible = is_running
+        self.btn_cancel_analysis.visible = is_running
+
+    def cancel_analysis(self, _event):
+        self.is_cancelled = True
+        if self.analysis_job:
+            self.analysis_job.cancel()
+
+    async def run_cancellable_step(self, fn: Callable[[], Any]) -> Any:
+        """
+        Run one step of an analysis off the event loop as the job the Cancel button cancels
+
+        Raises:
+            asyncio.CancelledError: if Cancel was clicked before or during the step
+        """
+        if self.is_cancelled:
+            raise asyncio.CancelledError
+        self.analysis_job = submit_analysis(fn)
+        try:
+            result = await self.analysis_job
+        finally:
+            self.analysis_job = None
+        if self.is_cancelled:  ## too late to stop it running but no need to use the result
+            raise asyncio.CancelledError
+        return result
+
+    async def run_analysis(self, _event):
+        workspace = self.workspace
+        shared = workspace.shared
+        workspace.show_output_saved_msg_param.value = False  ## have to wait for Save Output button to be clicked again now
         ## validate
         selected_values = self.group_value_selector.value
         if len(selected_values) < 2:
@@ -147,29 +281,68 @@ class ANOVAForm:
             return
         self.user_msg_var.value = None
         grouping_variable_name = get_unlabelled(self.select_grouping_variable.value)
-        var_restoration_fn = ANOVAForm.var_restoration_fn_from_var_from_option(grouping_variable_name)
-        group_vals = [var_restoration_fn(get_unlabelled(val)) for val in selected_values]
-        ## get HTML
+        group_vals = self.get_selected_group_vals()
+        ## get HTML (off the event loop - read everything needed from the session first)
+        df = shared[SharedKey.DF_CSV]
+        dataset_hash = shared[SharedKey.DATASET_HASH]
+        measure_field_name = get_unlabelled(self.measure.value)
+        get_group_summaries = self.get_group_summaries_fn()
+        data_label_mappings = workspace.data_labels_param.value
         now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        anova_design = anova.AnovaDesign(
-            measure_field_name=get_unlabelled(self.measure.value),
-            grouping_field_name=get_unlabelled(self.select_grouping_variable.value),
-            group_values=group_vals,
-            csv_file_path=shared[SharedKey.CSV_FPATH],
-            data_label_mappings=data_labels_param.value,
-            show_in_web_browser=False,
-            output_file_path=DEFAULT_OUTPUT_FOLDER / f"ANOVA Report generated at {now}.html"
-        )
-        show_output_tab_param.value = True
+        output_file_path = DEFAULT_OUTPUT_FOLDER / f"ANOVA Report generated at {now}.html"
+
+        results_cache_key = results_cache.get_key(dataset_hash=dataset_hash, test_name='ANOVA',
+            measure_field_name=measure_field_name, grouping_field_name=grouping_variable_name,
+            group_values=group_vals, data_label_mappings=data_label_mappings)
+
+        def get_html_design():
+            from sofastats.output.stats import anova  ## slow first import (matplotlib etc.) so not until needed - see preload_analysis_modules
+            data_source = get_data_source(df, dataset_hash,
+                user=workspace.session_id)  ## only ingested on first analysis of this dataset
+            anova_design = anova.AnovaDesign(
+                measure_field_name=measure_field_name,
+                grouping_field_name=grouping_variable_name,
+                group_values=group_vals,
+                **data_source.to_design_kwargs(),
+                data_label_mappings=data_label_mappings,
+                show_in_web_browser=False,
+                output_file_path=output_file_path,
+            )
+            return render_html_design(anova_design)  ## data source (above) may be worked out in parallel but not this
+
+        self.is_cancelled = False
+        self.set_analysis_running(True)
+        try:
+            ## every group needs some values (group statistics are shared with other tests so usually already worked out)
+            group_summaries = await self.run_cancellable_step(get_group_summaries)
+            empty_group_vals = [val for val in group_vals if val not in group_summaries]
+            if empty_group_vals:
+                self.user_msg_var.value = (f"No {measure_field_name} values for "
+                    f"{', '.join(str(val) for val in empty_group_vals)} - please select other grouping values.")
+                return
+            html_item_str = results_cache.get(results_cache_key)
+            if html_item_str is None:
+                html_design = await self.run_cancellable_step(get_html_design)
+                html_item_str = html_design.html_item_str
+                results_cache.put(results_cache_key, html_item_str)
+        except asyncio.CancelledError:
+            self.user_msg_var.value = "ANOVA cancelled"
+            return
+        finally:
+            self.set_analysis_running(False)
+        await asyncio.to_thread(results_history.add, html_item_str, dataset_hash=dataset_hash, test_name='ANOVA',
+            measure_field_name=measure_field_name, grouping_field_name=grouping_variable_name,
+            group_values=group_vals, title=f"ANOVA of {measure_field_name} by {grouping_variable_name}")
+        workspace.show_output_tab_param.value = True
         # store HTML
-        html_design = anova_design.to_html_design()
-        html_param.value = html_design.html_item_str
-        give_output_tab_focus_param.value = True
+        workspace.html_param.value = html_item_str
+        workspace.give_output_tab_focus_param.value = True
         ## clear and hide stats config
-        open_stats_config_modal = shared[SharedKey.ACTIVE_STATS_CONFIG_MODAL]
-        # open_stats_config_modal.clear()
-        open_stats_config_modal.hide()
-        shared[SharedKey.ACTIVE_STATS_CONFIG_MODAL] = None
+        if shared.get(SharedKey.ACTIVE_STATS_CONFIG_MODAL):  ## e.g. already closed while the analysis ran
+            open_stats_config_modal = shared[SharedKey.ACTIVE_STATS_CONFIG_MODAL]
+            # open_stats_config_modal.clear()
+            open_stats_config_modal.hide()
+            shared[SharedKey.ACTIVE_STATS_CONFIG_MODAL] = None
         ## clear and hide stats chooser if open
         if shared.get(SharedKey.ACTIVE_STATS_CHOOSER_MODAL):
             open_stats_chooser_modal = shared[SharedKey.ACTIVE_STATS_CHOOSER_MODAL]
@@ -177,26 +350,63 @@ class ANOVAForm:
             open_stats_chooser_modal.hide()
             shared[SharedKey.ACTIVE_STATS_CHOOSER_MODAL] = None
         ## store location to save output (if user wants to)
-        shared[SharedKey.CURRENT_OUTPUT_FPATH] = anova_design.output_file_path  ## can access later if they want to save the result
+        shared[SharedKey.CURRENT_OUTPUT_FPATH] = output_file_path  ## can access later if they want to save the result
 
-    @staticmethod
-    def set_user_msg(msg: str):
+    async def run_screening(self, _event):
+        """
+        Which measures differ across the selected groups? F and p for every measure in one pass over the data.
+        Any of them can then be opened as a full report (see open_screening_report).
+        """
+        if len(self.group_value_selector.value) < 2:
+            self.user_msg_var.value = "Please select at least two grouping values to screen measures across."
+            return
+        self.user_msg_var.value = None
+        shared = self.workspace.shared
+        data = shared.get(SharedKey.SQL_DATASET) or shared[SharedKey.DF_CSV]
+        grouping_variable_name = get_unlabelled(self.select_grouping_variable.value)
+        measure_option_by_col = {get_unlabelled(option): option for option in ANOVAForm.get_measure_options()}
+        measure_option_by_col.pop(grouping_variable_name, None)  ## no point comparing groups by their own values
+        group_vals = self.get_selected_group_vals()
+        self.is_cancelled = False
+        self.set_analysis_running(True)
+        try:
+            screening_results = await self.run_cancellable_step(lambda: get_screening_results(data,
+                measure_cols=list(measure_option_by_col), grouping_col=grouping_variable_name, group_vals=group_vals))
+        except asyncio.CancelledError:
+            self.user_msg_var.value = "Screening cancelled"
+            return
+        finally:
+            self.set_analysis_running(False)
+        screening_results['measure'] = screening_results['measure'].map(measure_option_by_col)
+        screening_results['F'] = screening_results['F'].round(3)
+        self.screening_results.value = screening_results.rename(columns={'measure': 'Measure'})
+        self.screening_results.visible = True
+
+    async def open_screening_report(self, event):
+        if self.is_analysis_running:  ## the report buttons in the table can't be disabled like the others
+            self.user_msg_var.value = "Please wait for the current analysis to finish (or cancel it)."
+            return
+        self.measure.value = self.screening_results.value['Measure'].iloc[event.row]
+        await self.run_analysis(None)
+
+    def set_user_msg(self, msg: str | None):
         if msg:
-            alert = pn.pane.Alert(msg, alert_type='warning')
-        else:
-            alert = None
-        return alert
+            self.user_msg_alert.object = msg
+        self.user_msg_alert.visible = bool(msg)
 
     def ui(self):
         form = pn.layout.WidgetBox(
             pn.pane.Markdown("## Configure ANOVA then get results"),
-            self.user_msg_or_none,
+            self.user_msg_alert,
             self.measure,
             self.select_grouping_variable,
             "Click values you'd like to include in the test<br>(must select more than one)",
-            self.values_multiselect_or_none,
-            self.btn_run_analysis, self.btn_close,
-            self.set_grouping_var, self.group_value_selector,
+            self.group_value_selector_col,
+            self.group_summary,
+            pn.Row(self.btn_run_analysis, self.btn_screen_measures,
+                self.analysis_running_indicator, self.btn_cancel_analysis),
+            self.screening_results,
+            self.btn_close,
             name=f"ANOVA Design", margin=20,
         )
         return form
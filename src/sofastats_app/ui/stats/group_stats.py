@@ -0,0 +1,338 @@
+"""
+Per-group sufficient statistics shared by every test of a measure across groups.
+
+ANOVA, t-tests, Kruskal-Wallis, and Mann-Whitney on the same measure and grouping variable all need the same thing -
+per-group counts, means, and sums of squared deviations (parametric tests) or sorted values and ranks (non-parametric tests).
+So they are worked out in one pass over the data for all groups at once and cached by dataset, measure, and grouping.
+Switching tests, or toggling which group values to include, then just picks out the groups needed
+instead of scanning the data again.
+
+Screening (get_screening_results) goes the other way - many measures across one set of groups -
+and gets the same sufficient statistics for every measure in a single pass.
+
+Sorted values are only worked out when first asked for. An out-of-core dataset (see sql_dataset.py)
+can supply counts and sums straight from a GROUP BY but sorted values mean reading the whole measure column.
+"""
+from collections import OrderedDict
+from collections.abc import Sequence
+from dataclasses import dataclass
+import math
+import threading
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+from sofastats.stats_calc.engine import fprob
+from sofastats_app import logger
+from sofastats_app.ui.conf import GROUP_SORTED_VALUES_CACHE_MAX_BYTES, GROUP_STATS_CACHE_MAX_ITEMS
+from sofastats_app.ui.sql_dataset import SqlDataset, quote_name
+
+SCREENING_BLOCK_N_MEASURES = 50
+
+
+BETACF_MAX_ITERATIONS = 200  ## as in sofastats.stats_calc.engine.betacf
+BETACF_EPS = 3.0e-7
+GAMMLN_COEFFS = (76.18009173, -86.50532033, 24.01409822, -1.231739516, 0.120858003e-2, -0.536382e-5)
+
+
+@dataclass(frozen=True)
+class GroupSummary:
+    """
+    Args:
+        sum_sq_dev: sum of squared deviations from the group mean. Kept instead of the sum of squares
+          because subtracting the squared total from that loses precision for large-magnitude measures.
+    """
+    n: int
+    mean: float
+    sum_sq_dev: float
+
+    @property
+    def variance(self) -> float:
+        """
+        Sample variance (n - 1)
+        """
+        if self.n < 2:
+            return math.nan
+        return self.sum_sq_dev / (self.n - 1)
+
+    @property
+    def sd(self) -> float:
+        return math.sqrt(self.variance)
+
+
+def _get_summaries_from_df(df: pd.DataFrame, measure_col: str, grouping_col: str) -> dict[Any, GroupSummary]:
+    measure = df[measure_col].astype(float)
+    grouping = df[grouping_col]
+    usable = measure.notna() & grouping.notna()
+    aggregates = measure[usable].groupby(grouping[usable], observed=True, sort=True).agg(['size', 'mean', 'var'])
+    return {group_val: GroupSummary(n=int(row.size), mean=float(row.mean),
+            sum_sq_dev=float(row.var) * (row.size - 1) if row.size > 1 else 0.0)  ## pandas var is from centred values
+        for group_val, row in zip(aggregates.index.tolist(), aggregates.itertuples())}
+
+def _get_summaries_from_sql(sql_dataset: SqlDataset, measure_col: str, grouping_col: str) -> dict[Any, GroupSummary]:
+    aggregates = sql_dataset.get_group_aggregates(measure_col, grouping_col)
+    return {group_val: GroupSummary(n=int(row.n), mean=float(row.mean), sum_sq_dev=float(row.sum_sq_dev))
+        for group_val, row in zip(aggregates.index.tolist(), aggregates.itertuples())
+        if row.n > 0}  ## no measure values in this group
+
+def _get_sorted_values_from_df(df: pd.DataFrame, measure_col: str, grouping_col: str) -> dict[Any, np.ndarray]:
+    measure = df[measure_col].astype(float)
+    grouping = df[grouping_col]
+    usable = measure.notna() & grouping.notna()
+    return {group_val: np.sort(vals.to_numpy())
+        for group_val, vals in measure[usable].groupby(grouping[usable], observed=True, sort=True)}
+
+def _get_sorted_values_from_sql(sql_dataset: SqlDataset, measure_col: str, grouping_col: str) -> dict[Any, np.ndarray]:
+    sorted_values = {}
+    for group_val in sql_dataset.get_distinct_values(grouping_col):
+        where_sql = f"WHERE {quote_name(grouping_col)} = ? AND {quote_name(measure_col)} IS NOT NULL"
+        vals = sql_dataset.get_col_values(measure_col, where_sql=where_sql, params=[group_val], sort=True)
+        sorted_values[group_val] = vals.astype(float)
+    return sorted_values
+
+def get_anova_f_and_p(summaries: Sequence[GroupSummary]) -> tuple[float, float] | None:
+    """
+    One-way ANOVA straight from group summaries - no pass over the data. A quick preview only.
+    The full report is still produced by sofastats_lib (with higher precision available).
+
+    Returns:
+        F and p, or None if there isn't enough data or variability to work them out
+    """
+    n_groups = len(summaries)
+    n_total = sum(summary.n for summary in summaries)
+    df_between = n_groups - 1
+    df_within = n_total - n_groups
+    if df_between < 1 or df_within < 1:
+        return None
+    grand_mean = sum(summary.n * summary.mean for summary in summaries) / n_total
+    ss_between = sum(summary.n * (summary.mean - grand_mean) ** 2 for summary in summaries)
+    ss_within = sum(summary.sum_sq_dev for summary in summaries)
+    mean_sq_within = ss_within / df_within
+    if mean_sq_within == 0:
+        return None
+    F = (ss_between / df_between) / mean_sq_within
+    p = fprob(df_between, df_within, F)
+    return F, p
+
+def _get_gammlns(xx: np.ndarray) -> np.ndarray:
+    """
+    sofastats.stats_calc.engine.gammln for a whole array at once
+    """
+    x = xx - 1.0
+    tmp = x + 5.5
+    tmp = tmp - (x + 0.5) * np.log(tmp)
+    ser = np.ones_like(x)
+    for coeff in GAMMLN_COEFFS:
+        x = x + 1.0
+        ser = ser + coeff / x
+    return -tmp + np.log(2.50662827465 * ser)
+
+def _get_betacfs(a: np.ndarray, b: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """
+    sofastats.stats_calc.engine.betacf for whole arrays at once - each element stops changing once it has converged
+
+    Returns:
+        NaN where it doesn't converge (as for betacf, which returns None)
+    """
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    am = np.ones_like(x)
+    bm = np.ones_like(x)
+    az = np.ones_like(x)
+    bz = 1.0 - qab * x / qap
+    results = np.full_like(x, np.nan)
+    is_converged = np.zeros(x.shape, dtype=bool)
+    for i in range(BETACF_MAX_ITERATIONS + 1):
+        em = i + 1.0
+        tem = em + em
+        d = em * (b - em) * x / ((qam + tem) * (a + tem))
+        ap = az + d * am
+        bp = bz + d * bm
+        d = -(a + em) * (qab + em) * x / ((qap + tem) * (a + tem))
+        app = ap + d * az
+        bpp = bp + d * bz
+        aold = az
+        am = ap / bpp
+        bm = bp / bpp
+        az = app / bpp
+        bz = np.ones_like(x)
+        newly_converged = ~is_converged & (np.abs(az - aold) < BETACF_EPS * np.abs(az))
+        results[newly_converged] = az[newly_converged]
+        is_converged |= newly_converged
+        if is_converged.all():
+            break
+    return results
+
+def get_fprobs(dfs_between: np.ndarray, dfs_within: np.ndarray, Fs: np.ndarray) -> np.ndarray:
+    """
+    sofastats.stats_calc.engine.fprob (via betai) for many F statistics at once
+
+    Returns:
+        p for each F (NaN where F isn't finite)
+    """
+    ps = np.full(len(Fs), np.nan)
+    usable = np.isfinite(Fs)
+    a = 0.5 * np.asarray(dfs_within, dtype=float)[usable]
+    b = 0.5 * np.asarray(dfs_between, dtype=float)[usable]
+    x = a / (a + b * np.asarray(Fs, dtype=float)[usable])
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        bts = np.exp(_get_gammlns(a + b) - _get_gammlns(a) - _get_gammlns(b) + a * np.log(x) + b * np.log(1.0 - x))
+        bts[(x == 0) | (x == 1)] = 0.0
+        is_direct = x < (a + 1.0) / (a + b + 2.0)  ## whichever side the continued fraction converges quickly for
+        ps[usable] = np.where(is_direct, bts * _get_betacfs(a, b, x) / a, 1.0 - bts * _get_betacfs(b, a, 1.0 - x) / b)
+    return ps
+
+def _get_measure_moments_from_df(df: pd.DataFrame, measure_cols: Sequence[str], grouping_col: str,
+        group_vals: Sequence[Any]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    One measure at a time so memory is only ever a few arrays the length of the selected rows however wide the data.
+
+    Returns:
+        counts, means, and sums of squared deviations from the group means - each an array of groups by measures.
+        Means are relative to the measure's overall mean (only the differences between them matter for F)
+        so summing large-magnitude values doesn't lose the differences.
+    """
+    grouping = df[grouping_col]
+    in_groups = grouping.isin(group_vals).to_numpy()
+    group_idxs = pd.Categorical(grouping[in_groups], categories=list(group_vals)).codes
+    n_groups = len(group_vals)
+    counts, means, sums_sq_dev = (np.zeros((n_groups, len(measure_cols))) for _i in range(3))
+    for i, measure_col in enumerate(measure_cols):
+        vals = df[measure_col].to_numpy(dtype=float, na_value=np.nan)[in_groups]
+        is_valid = ~np.isnan(vals)
+        vals = vals[is_valid]
+        if len(vals):
+            vals = vals - vals.mean()
+        val_group_idxs = group_idxs[is_valid]
+        counts[:, i] = np.bincount(val_group_idxs, minlength=n_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means[:, i] = np.bincount(val_group_idxs, weights=vals, minlength=n_groups) / counts[:, i]
+        deviations = vals - means[val_group_idxs, i]
+        sums_sq_dev[:, i] = np.bincount(val_group_idxs, weights=deviations * deviations, minlength=n_groups)
+    return counts, means, sums_sq_dev
+
+def _get_measure_moments_from_sql(sql_dataset: SqlDataset, measure_cols: Sequence[str], grouping_col: str,
+        group_vals: Sequence[Any]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    counts, means, sums_sq_dev = (np.zeros((len(group_vals), len(measure_cols))) for _i in range(3))
+    for start in range(0, len(measure_cols), SCREENING_BLOCK_N_MEASURES):  ## SQLite limits columns per query
+        block_cols = list(measure_cols[start: start + SCREENING_BLOCK_N_MEASURES])
+        aggregates = sql_dataset.get_group_aggregates_for_measures(block_cols, grouping_col, group_vals)
+        aggregates = aggregates.reindex(list(group_vals))
+        block_slice = slice(start, start + len(block_cols))
+        counts[:, block_slice] = aggregates[[f"{col}|n" for col in block_cols]].fillna(0).to_numpy()
+        means[:, block_slice] = aggregates[[f"{col}|mean" for col in block_cols]].to_numpy(dtype=float)
+        sums_sq_dev[:, block_slice] = aggregates[[f"{col}|sum_sq_dev" for col in block_cols]].fillna(0).to_numpy()
+    return counts, means, sums_sq_dev
+
+def get_screening_results(data: pd.DataFrame | SqlDataset, *, measure_cols: Sequence[str], grouping_col: str,
+        group_vals: Sequence[Any]) -> pd.DataFrame:
+    """
+    One-way ANOVA of every measure across the same groups - all in one pass over the data.
+    For deciding which measures are worth a full report.
+
+    Returns:
+        one row per measure (most significant first) with columns measure, N, F, p.
+        F and p are NaN if there isn't enough data or variability.
+    """
+    if isinstance(data, SqlDataset):
+        counts, means, sums_sq_dev = _get_measure_moments_from_sql(data, measure_cols, grouping_col, group_vals)
+    else:
+        counts, means, sums_sq_dev = _get_measure_moments_from_df(data, measure_cols, grouping_col, group_vals)
+    n_totals = counts.sum(axis=0)
+    n_groups = (counts > 0).sum(axis=0)
+    df_between = n_groups - 1
+    df_within = n_totals - n_groups
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grand_means = np.nansum(counts * means, axis=0) / n_totals
+        ss_between = np.nansum(counts * (means - grand_means) ** 2, axis=0)
+        ss_within = sums_sq_dev.sum(axis=0)
+        Fs = (ss_between / df_between) / (ss_within / df_within)
+    Fs[(df_between < 1) | (df_within < 1) | (ss_within == 0)] = np.nan
+    ps = get_fprobs(df_between, df_within, Fs)
+    results = pd.DataFrame({'measure': list(measure_cols), 'N': n_totals.astype(int), 'F': Fs, 'p': ps})
+    return results.sort_values(['p', 'F'], ascending=[True, False], na_position='last', ignore_index=True)
+
+def get_rank_sums(sorted_values: dict[Any, np.ndarray], group_vals: Sequence[Any]) -> dict[Any, float]:
+    """
+    Sum of ranks for each group when the values of just these groups are ranked together (ties get the average rank)
+    e.g. for Kruskal-Wallis and Mann-Whitney
+    """
+    vals = np.concatenate([sorted_values[group_val] for group_val in group_vals])
+    group_idxs = np.repeat(np.arange(len(group_vals)), [len(sorted_values[group_val]) for group_val in group_vals])
+    order = np.argsort(vals, kind='stable')
+    _unique_vals, first_idxs, tie_counts = np.unique(vals[order], return_index=True, return_counts=True)
+    average_ranks = first_idxs + (tie_counts + 1) / 2  ## ranks start at 1
+    ranks = np.repeat(average_ranks, tie_counts)
+    rank_sums = np.bincount(group_idxs[order], weights=ranks, minlength=len(group_vals))
+    return dict(zip(group_vals, rank_sums.tolist()))
+
+
+class GroupStatsCache:
+    """
+    Summaries are tiny so we keep plenty. Sorted values are as big as the measure column
+    so they are limited by total bytes instead.
+    """
+
+    def __init__(self, *, max_summaries: int, max_sorted_values_bytes: int):
+        self.max_summaries = max_summaries
+        self.max_sorted_values_bytes = max_sorted_values_bytes
+        self._lock = threading.Lock()
+        self._summaries: OrderedDict[tuple, dict[Any, GroupSummary]] = OrderedDict()
+        self._sorted_values: OrderedDict[tuple, dict[Any, np.ndarray]] = OrderedDict()
+
+    @staticmethod
+    def _get_sorted_values_bytes(sorted_values: dict[Any, np.ndarray]) -> int:
+        return sum(vals.nbytes for vals in sorted_values.values())
+
+    def _evict(self):
+        while len(self._summaries) > self.max_summaries:
+            self._summaries.popitem(last=False)
+        total_bytes = sum(self._get_sorted_values_bytes(vals) for vals in self._sorted_values.values())
+        while len(self._sorted_values) > 1 and total_bytes > self.max_sorted_values_bytes:  ## always keep the latest
+            _key, sorted_values = self._sorted_values.popitem(last=False)
+            total_bytes -= self._get_sorted_values_bytes(sorted_values)
+
+    def _get_or_make(self, store: OrderedDict, key: tuple, make_fn) -> dict:
+        with self._lock:
+            if key in store:
+                store.move_to_end(key)
+                return store[key]
+        logger.info(f"Working out group statistics for {key[1:]}")
+        val = make_fn()  ## outside the lock - may take a while and other keys shouldn't have to wait
+        with self._lock:
+            store[key] = val
+            store.move_to_end(key)
+            self._evict()
+        return val
+
+    def get_summaries(self, data: pd.DataFrame | SqlDataset, *, dataset_hash: str,
+            measure_col: str, grouping_col: str) -> dict[Any, GroupSummary]:
+        """
+        Returns:
+            summaries of every group (not only those selected) so changing the selection needs no new pass
+        """
+        key = (dataset_hash, measure_col, grouping_col)
+        if isinstance(data, SqlDataset):
+            make_fn = lambda: _get_summaries_from_sql(data, measure_col, grouping_col)
+        else:
+            make_fn = lambda: _get_summaries_from_df(data, measure_col, grouping_col)
+        return self._get_or_make(self._summaries, key, make_fn)
+
+    def get_sorted_values(self, data: pd.DataFrame | SqlDataset, *, dataset_hash: str,
+            measure_col: str, grouping_col: str) -> dict[Any, np.ndarray]:
+        """
+        Returns:
+            sorted non-missing measure values for every group e.g. to pass to get_rank_sums
+        """
+        key = (dataset_hash, measure_col, grouping_col)
+        if isinstance(data, SqlDataset):
+            make_fn = lambda: _get_sorted_values_from_sql(data, measure_col, grouping_col)
+        else:
+            make_fn = lambda: _get_sorted_values_from_df(data, measure_col, grouping_col)
+        return self._get_or_make(self._sorted_values, key, make_fn)
+
+
+group_stats_cache = GroupStatsCache(max_summaries=GROUP_STATS_CACHE_MAX_ITEMS,
+    max_sorted_values_bytes=GROUP_SORTED_VALUES_CACHE_MAX_BYTES)  ## shared by all sessions (keyed by dataset content)
@@ -0,0 +1,117 @@
+"""
+Cache of rendered results.
+
+Analysts often flip back and forth between the same few designs.
+Results are keyed by everything that can change the output:
+the dataset content hash, the test, the fields, the group values, and the data labels.
+So an identical request returns the earlier HTML instead of running the analysis again.
+
+Bounded by total bytes of HTML (least recently used dropped first) - results vary a lot in size
+(a report with charts can be hundreds of times bigger than one without) so a count of results says little.
+If a folder is configured the HTML is kept there instead of in memory, so it survives restarts.
+"""
+from collections import OrderedDict
+from collections.abc import Sequence
+import hashlib
+import json
+from pathlib import Path
+import threading
+from typing import Any
+
+from sofastats_app import logger
+from sofastats_app.ui.conf import RESULTS_CACHE_FOLDER, RESULTS_CACHE_MAX_BYTES
+
+
+class ResultsCache:
+
+    def __init__(self, max_bytes: int, cache_dpath: Path | None = None):
+        self.max_bytes = max_bytes
+        self.cache_dpath = cache_dpath
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self._results: OrderedDict[str, str | None] = OrderedDict()  ## None if the HTML is only on disk
+        self._n_bytes: dict[str, int] = {}
+        if self.cache_dpath:
+            self.cache_dpath.mkdir(parents=True, exist_ok=True)
+            fpaths_and_stats = [(fpath, fpath.stat()) for fpath in self.cache_dpath.glob('*.html')]
+            for fpath, fpath_stat in sorted(fpaths_and_stats, key=lambda fpath_and_stat: fpath_and_stat[1].st_mtime):
+                self._add(fpath.stem, None, fpath_stat.st_size)
+            self._evict()
+
+    @staticmethod
+    def get_key(*, dataset_hash: str, test_name: str, measure_field_name: str, grouping_field_name: str,
+            group_values: Sequence[Any], data_label_mappings: dict | None) -> str:
+        labels_json = json.dumps(data_label_mappings or {}, sort_keys=True, default=str)
+        key_content = json.dumps([
+            dataset_hash, test_name, measure_field_name, grouping_field_name,
+            sorted(group_values, key=str),
+            hashlib.sha256(labels_json.encode()).hexdigest(),
+        ], default=str)
+        return hashlib.sha256(key_content.encode()).hexdigest()
+
+    def _get_fpath(self, key: str) -> Path:
+        return self.cache_dpath / f"{key}.html"
+
+    def _add(self, key: str, html: str | None, n_bytes: int):
+        """
+        Must hold the lock (or still be in __init__)
+        """
+        self._remove(key)
+        self._results[key] = html
+        self._n_bytes[key] = n_bytes
+        self.total_bytes += n_bytes
+
+    def _remove(self, key: str):
+        """
+        Must hold the lock (or still be in __init__)
+        """
+        self._results.pop(key, None)
+        self.total_bytes -= self._n_bytes.pop(key, 0)
+
+    def _evict(self):
+        while len(self._results) > 1 and self.total_bytes > self.max_bytes:  ## always keep the latest
+            key = next(iter(self._results))
+            self._remove(key)
+            if self.cache_dpath:
+                self._get_fpath(key).unlink(missing_ok=True)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            if key not in self._results:
+                self.misses += 1
+                html = None
+            else:
+                self._results.move_to_end(key)
+                html = self._results[key]
+                if html is None:
+                    try:
+                        html = self._get_fpath(key).read_text(encoding='utf-8')
+                    except FileNotFoundError:
+                        self._remove(key)
+                if html is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        logger.debug(f"Results cache: {self.hits:,} hits, {self.misses:,} misses (hit rate {self.hit_rate:.0%}) "
+            f"holding {self.total_bytes:,} bytes")
+        return html
+
+    def put(self, key: str, html: str):
+        content = html.encode('utf-8')
+        with self._lock:
+            if self.cache_dpath:
+                self._get_fpath(key).write_bytes(content)
+                self._add(key, None, len(content))
+            else:
+                self._add(key, html, len(content))
+            self._evict()
+
+    @property
+    def hit_rate(self) -> float:
+        n_lookups = self.hits + self.misses
+        return self.hits / n_lookups if n_lookups else 0
+
+
+results_cache = ResultsCache(RESULTS_CACHE_MAX_BYTES, cache_dpath=RESULTS_CACHE_FOLDER)  ## shared by all sessions
@@ -0,0 +1,220 @@
+"""
+History of results, indexed in SQLite.
+
+Each new result used to replace the last one (only the latest HTML was kept) so there was no way back
+to an earlier run short of running it again. Now every result is written to the history folder
+and indexed by its design (test, fields, group values), dataset content hash, and when it was run.
+Listing the history only reads the index - a report body is only read when it is opened.
+
+Reports are listed for the dataset currently loaded. Anyone with the same data (same content hash)
+can already produce the same results so nothing is revealed to other sessions that they couldn't see anyway.
+
+Running the same design on the same data again doesn't add a copy - the existing entry just moves to the top.
+The folder is kept bounded by number of reports, total bytes, and age (oldest dropped first)
+- see RESULTS_HISTORY_MAX_ITEMS, RESULTS_HISTORY_MAX_BYTES, and RESULTS_HISTORY_MAX_AGE_DAYS in conf.py.
+
+With several server processes they all share the one index so it is opened in WAL mode (readers never block the writer)
+and waits for a busy index rather than failing straight away. If it is still busy (or otherwise unusable)
+the result is just left out of the history - it has already been shown so nothing is lost but the entry.
+"""
+from collections.abc import Sequence
+from dataclasses import dataclass
+import hashlib
+import json
+from pathlib import Path
+import sqlite3 as sqlite
+import threading
+import time
+from typing import Any
+
+import pandas as pd
+
+from sofastats_app import logger
+from sofastats_app.ui.conf import (RESULTS_HISTORY_FOLDER, RESULTS_HISTORY_MAX_AGE_DAYS, RESULTS_HISTORY_MAX_BYTES,
+    RESULTS_HISTORY_MAX_ITEMS)
+
+INDEX_FNAME = 'index.db'
+SQLITE_BUSY_TIMEOUT_SECS = 30
+
+
+@dataclass(frozen=True)
+class ResultsHistoryItem:
+    result_id: int
+    created_at: float
+    test_name: str
+    measure_field_name: str
+    grouping_field_name: str
+    group_values: list[Any]
+    title: str
+    n_bytes: int
+    fpath: Path
+
+
+class ResultsHistory:
+
+    def __init__(self, history_dpath: Path, *, max_items: int, max_bytes: int, max_age_days: float):
+        self.history_dpath = history_dpath
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self._lock = threading.Lock()
+        self._con = None  ## connect on first use - nothing written to disk until there is a result
+
+    def _get_con(self) -> sqlite.Connection:
+        """
+        Must hold the lock
+        """
+        if self._con is None:
+            self.history_dpath.mkdir(parents=True, exist_ok=True)
+            con = sqlite.connect(self.history_dpath / INDEX_FNAME, timeout=SQLITE_BUSY_TIMEOUT_SECS,
+                check_same_thread=False)  ## only ever used while holding the lock
+            con.execute('PRAGMA journal_mode=WAL')  ## persists in the file so only really needed the first time
+            con.executescript("""\
+                CREATE TABLE IF NOT EXISTS results (
+                    result_id INTEGER PRIMARY KEY,
+                    report_hash TEXT NOT NULL UNIQUE,
+                    created_at REAL NOT NULL,
+                    dataset_hash TEXT NOT NULL,
+                    test_name TEXT NOT NULL,
+                    measure_field_name TEXT,
+                    grouping_field_name TEXT,
+                    group_values TEXT,
+                    title TEXT NOT NULL,
+                    n_bytes INTEGER NOT NULL,
+                    fname TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_results_dataset ON results (dataset_hash, created_at);
+                CREATE INDEX IF NOT EXISTS idx_results_created ON results (created_at);
+            """)
+            self._con = con  ## only once ready - otherwise the next call tries again
+        return self._con
+
+    def add(self, html: str, *, dataset_hash: str, test_name: str, measure_field_name: str | None = None,
+            grouping_field_name: str | None = None, group_values: Sequence[Any] = (), title: str) -> int | None:
+        """
+        Returns:
+            ID of the (new or refreshed) history entry. None if the index couldn't be written to (e.g. busy for too long)
+        """
+        content = html.encode('utf-8')
+        report_hash = hashlib.sha256(content).hexdigest()
+        fname = f"{report_hash}.html"
+        with self._lock:
+            try:
+                con = self._get_con()
+                fpath = self.history_dpath / fname
+                if not fpath.exists():
+                    fpath.write_bytes(content)
+                ## latest run wins outright e.g. the same report from a differently named dataset gets the new name
+                cur = con.execute("""\
+                    INSERT INTO results (report_hash, created_at, dataset_hash, test_name, measure_field_name,
+                        grouping_field_name, group_values, title, n_bytes, fname)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (report_hash) DO UPDATE SET
+                        created_at = excluded.created_at,
+                        dataset_hash = excluded.dataset_hash,
+                        test_name = excluded.test_name,
+                        measure_field_name = excluded.measure_field_name,
+                        grouping_field_name = excluded.grouping_field_name,
+                        group_values = excluded.group_values,
+                        title = excluded.title,
+                        n_bytes = excluded.n_bytes,
+                        fname = excluded.fname
+                    RETURNING result_id
+                """, (report_hash, time.time(), dataset_hash, test_name, measure_field_name, grouping_field_name,
+                    json.dumps(list(group_values), default=str), title, len(content), fname))
+                result_id = cur.fetchone()[0]
+                con.commit()
+                self._apply_retention()
+            except sqlite.OperationalError as e:
+                if self._con is not None:
+                    self._con.rollback()
+                logger.info(f"Unable to add '{title}' to the results history. Orig error: {e}")
+                return None
+        return result_id
+
+    def _apply_retention(self):
+        """
+        Must hold the lock. Drop the oldest reports until within every limit.
+        """
+        con = self._get_con()
+        min_created_at = time.time() - self.max_age_days * 24 * 60 * 60
+        rows = con.execute("SELECT result_id, created_at, n_bytes, fname FROM results "
+            "ORDER BY created_at DESC").fetchall()
+        n_items = 0
+        n_bytes = 0
+        dropped_rows = []
+        for row in rows:
+            result_id, created_at, row_n_bytes, fname = row
+            n_items += 1
+            n_bytes += row_n_bytes
+            if n_items > self.max_items or n_bytes > self.max_bytes or created_at < min_created_at:
+                dropped_rows.append((result_id, fname))
+        if not dropped_rows:
+            return
+        con.executemany("DELETE FROM results WHERE result_id = ?", [(result_id, ) for result_id, _fname in dropped_rows])
+        con.commit()
+        for _result_id, fname in dropped_rows:
+            (self.history_dpath / fname).unlink(missing_ok=True)
+        logger.info(f"Results history: dropped {len(dropped_rows):,} old reports")
+
+    def list_items(self, dataset_hash: str, *, limit: int = 200) -> list[ResultsHistoryItem]:
+        """
+        Newest first. Only the index is read - not the reports themselves.
+        """
+        with self._lock:
+            if self._con is None and not (self.history_dpath / INDEX_FNAME).exists():
+                return []
+            try:
+                rows = self._get_con().execute("""\
+                    SELECT result_id, created_at, test_name, measure_field_name, grouping_field_name, group_values,
+                        title, n_bytes, fname
+                    FROM results WHERE dataset_hash = ? ORDER BY created_at DESC LIMIT ?
+                """, (dataset_hash, limit)).fetchall()
+            except sqlite.OperationalError as e:
+                logger.info(f"Unable to list the results history. Orig error: {e}")
+                return []
+        items = []
+        for (result_id, created_at, test_name, measure_field_name, grouping_field_name, group_values,
+                title, n_bytes, fname) in rows:
+            items.append(ResultsHistoryItem(result_id=result_id, created_at=created_at, test_name=test_name,
+                measure_field_name=measure_field_name, grouping_field_name=grouping_field_name,
+                group_values=json.loads(group_values or '[]'), title=title, n_bytes=n_bytes,
+                fpath=self.history_dpath / fname))
+        return items
+
+    def get_items_df(self, dataset_hash: str, *, limit: int = 200) -> pd.DataFrame:
+        """
+        For listing in the Results tab
+        """
+        items = self.list_items(dataset_hash, limit=limit)
+        return pd.DataFrame({
+            'result_id': [item.result_id for item in items],
+            'Run': [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(item.created_at)) for item in items],
+            'Result': [item.title for item in items],
+            'Groups': [', '.join(str(val) for val in item.group_values) for item in items],
+            'KB': [round(item.n_bytes / 1024) for item in items],
+        }, columns=['result_id', 'Run', 'Result', 'Groups', 'KB'])
+
+    def get_html(self, result_id: int) -> str | None:
+        """
+        None if the report has been dropped from the history in the meantime (or the index can't be read)
+        """
+        with self._lock:
+            if self._con is None and not (self.history_dpath / INDEX_FNAME).exists():
+                return None
+            try:
+                row = self._get_con().execute("SELECT fname FROM results WHERE result_id = ?",
+                    (result_id, )).fetchone()
+            except sqlite.OperationalError as e:
+                logger.info(f"Unable to read the results history. Orig error: {e}")
+                return None
+        if not row:
+            return None
+        try:
+            return (self.history_dpath / row[0]).read_text(encoding='utf-8')
+        except FileNotFoundError:
+            return None
+
+
+results_history = ResultsHistory(RESULTS_HISTORY_FOLDER, max_items=RESULTS_HISTORY_MAX_ITEMS,
+    max_bytes=RESULTS_HISTORY_MAX_BYTES, max_age_days=RESULTS_HISTORY_MAX_AGE_DAYS)  ## shared by all sessions
@@ -4,13 +4,8 @@ import panel as pn
 
 from sofastats_app.ui.conf import (
     Colour, DiffVsRel, IndepVsPaired, Normal, NumGroups, OrdinalVsCategorical, SharedKey, StatsOption)
-from sofastats_app.ui.state import (
-    difference_not_relationship_param, independent_not_paired_for_diff_param,
-    normal_not_abnormal_for_diff_param, normal_not_abnormal_for_rel_param,
-    ordinal_at_least_for_rel_param, shared,
-    two_not_three_plus_groups_for_diff_param,
-)
-from sofastats_app.ui.stats.stats_config import get_stats_config_modal
+from sofastats_app.ui.stats.stats_config import StatsConfigModals
+from sofastats_app.ui.workspace import get_workspace
 
 pn.extension('modal')
 
@@ -20,8 +15,21 @@ progress {
   height: 5px;
 }
 """
-chooser_progress = pn.indicators.Progress(name='Progress', value=0, width=400, height=5, height_policy='fixed',
-    stylesheets=[progress_stylesheet])
+btn_stats_config_stylesheet = """
+:host(.solid) .bk-btn.bk-btn-primary {
+  font-size: 14px;
+}
+"""
+
+def get_chooser_progress() -> pn.indicators.Progress:
+    """
+    One per session - otherwise every analyst would see the progress of whoever last answered a question
+    """
+    shared = get_workspace().shared
+    if shared.get(SharedKey.CHOOSER_PROGRESS) is None:
+        shared[SharedKey.CHOOSER_PROGRESS] = pn.indicators.Progress(name='Progress', value=0,
+            width=400, height=5, height_policy='fixed', stylesheets=[progress_stylesheet])
+    return shared[SharedKey.CHOOSER_PROGRESS]
 
 def set_chooser_progress(items: Collection[StatsOption]):
     """
@@ -38,19 +46,37 @@ def set_chooser_progress(items: Collection[StatsOption]):
     total = n_all_options - 1
     progress_fraction = score / total
     progress_value = round(progress_fraction * 100)
-    chooser_progress.value = progress_value
+    get_chooser_progress().value = progress_value
 
+def get_chooser_stats_config_modals() -> StatsConfigModals:
+    """
+    One per session - the config modals opened from inside the chooser modal
+    """
+    shared = get_workspace().shared
+    if shared.get(SharedKey.CHOOSER_STATS_CONFIG_MODALS) is None:
+        shared[SharedKey.CHOOSER_STATS_CONFIG_MODALS] = StatsConfigModals()
+    return shared[SharedKey.CHOOSER_STATS_CONFIG_MODALS]
 
-class SubChooser:
+def open_recommended_stats_config(_event):
+    shared = get_workspace().shared
+    get_chooser_stats_config_modals().show(shared[SharedKey.RECOMMENDED_STATS_TEST])
 
-    ## https://panel.holoviz.org/how_to/styling/apply_css.html
-    btn_stats_config_stylesheet = """
-    :host(.solid) .bk-btn.bk-btn-primary {
-      font-size: 14px;
-    }
+def get_btn_open_stats_config() -> pn.widgets.Button:
+    """
+    One per session, with one click handler, however often the recommendation changes.
+    It opens whichever test is recommended at the time.
     """
-    btn_open_stats_config = pn.widgets.Button(
-        name="Configure Test", button_type='primary', stylesheets=[btn_stats_config_stylesheet])
+    shared = get_workspace().shared
+    if shared.get(SharedKey.CHOOSER_BTN_OPEN_STATS_CONFIG) is None:
+        ## https://panel.holoviz.org/how_to/styling/apply_css.html
+        btn_open_stats_config = pn.widgets.Button(
+            name="Configure Test", button_type='primary', stylesheets=[btn_stats_config_stylesheet])
+        btn_open_stats_config.on_click(open_recommended_stats_config)
+        shared[SharedKey.CHOOSER_BTN_OPEN_STATS_CONFIG] = btn_open_stats_config
+    return shared[SharedKey.CHOOSER_BTN_OPEN_STATS_CONFIG]
+
+
+class SubChooser:
 
     @staticmethod
     def respond_to_choices(difference_not_relationship_value, two_not_three_plus_groups_for_diff_value,
@@ -179,17 +205,10 @@ class SubChooser:
                 <p>Under Construction</p>
                 """
             recommendation_html.object = content
-            SubChooser.btn_open_stats_config.name = f"Configure {stats_test} ⮕"
-            btn_close = pn.widgets.Button(name="Close")
-            stats_config_modal = get_stats_config_modal(stats_test, btn_close)
-            def open_stats_config_modal(_event):
-                stats_config_modal.show()
-            def close_stats_config_modal(_event):
-                stats_config_modal.hide()
-            btn_close.on_click(close_stats_config_modal)
-
-            SubChooser.btn_open_stats_config.on_click(open_stats_config_modal)
-
+            get_workspace().shared[SharedKey.RECOMMENDED_STATS_TEST] = stats_test
+            btn_open_stats_config = get_btn_open_stats_config()
+            btn_open_stats_config.name = f"Configure {stats_test} ⮕"
+            ## the config modal itself isn't built until the button is clicked
             col_recommendation_styles = {
                 'background-color': '#F6F6F6',
                 'border': '2px solid black',
@@ -197,8 +216,8 @@ class SubChooser:
                 'padding': '0 5px 5px 5px',
             }
             col_recommendation = pn.Column(
-                recommendation_html, SubChooser.btn_open_stats_config,
-                stats_config_modal,
+                recommendation_html, btn_open_stats_config,
+                get_chooser_stats_config_modals().container,
                 styles=col_recommendation_styles)
         else:
             col_recommendation = None
@@ -208,7 +227,7 @@ class SubChooser:
     ## DIFFERENCE ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     @staticmethod
     def _set_indep_vs_paired_param(indep_vs_paired_value):
-        independent_not_paired_for_diff_param.value = indep_vs_paired_value
+        get_workspace().independent_not_paired_for_diff_param.value = indep_vs_paired_value
 
     @staticmethod
     def get_indep_vs_paired_chooser(two_not_three_plus_groups_for_diff_param_val):
@@ -235,11 +254,11 @@ class SubChooser:
 
     @staticmethod
     def _set_norm_for_diff_param(norm_vs_abnormal_value):
-        normal_not_abnormal_for_diff_param.value = norm_vs_abnormal_value
+        get_workspace().normal_not_abnormal_for_diff_param.value = norm_vs_abnormal_value
 
     @staticmethod
     def _set_num_of_groups_param(num_of_groups_value):
-        two_not_three_plus_groups_for_diff_param.value = num_of_groups_value
+        get_workspace().two_not_three_plus_groups_for_diff_param.value = num_of_groups_value
 
     @staticmethod
     def difference_sub_chooser():  ## <====================== DIFFERENCE Main Act!
@@ -283,7 +302,7 @@ class SubChooser:
 
     @staticmethod
     def _set_norm_for_rel(normal_not_abnormal_for_rel_value):
-        normal_not_abnormal_for_rel_param.value = normal_not_abnormal_for_rel_value
+        get_workspace().normal_not_abnormal_for_rel_param.value = normal_not_abnormal_for_rel_value
 
     @staticmethod
     def get_normal_chooser_or_none(ordinal_vs_categorical_val):
@@ -309,7 +328,7 @@ class SubChooser:
     @staticmethod
     def _set_ordinal_vs_categorical(ordinal_vs_categorical_value):
         # print(f"ordinal_at_least_for_rel_param is now '{ordinal_vs_categorical_value}'")
-        ordinal_at_least_for_rel_param.value = ordinal_vs_categorical_value
+        get_workspace().ordinal_at_least_for_rel_param.value = ordinal_vs_categorical_value
 
     @staticmethod
     def relationship_sub_chooser():  ## <====================== RELATIONSHIP Main Act!
@@ -335,13 +354,14 @@ class SubChooser:
 
     @staticmethod
     def get_ui(diff_not_rel: DiffVsRel) -> pn.Column | None:
+        workspace = get_workspace()
         recommendation = pn.bind(SubChooser.respond_to_choices,
-            difference_not_relationship_param.param.value,
-            two_not_three_plus_groups_for_diff_param.param.value,
-            normal_not_abnormal_for_diff_param.param.value,
-            independent_not_paired_for_diff_param.param.value,
-            ordinal_at_least_for_rel_param.param.value,
-            normal_not_abnormal_for_rel_param.param.value)
+            workspace.difference_not_relationship_param.param.value,
+            workspace.two_not_three_plus_groups_for_diff_param.param.value,
+            workspace.normal_not_abnormal_for_diff_param.param.value,
+            workspace.independent_not_paired_for_diff_param.param.value,
+            workspace.ordinal_at_least_for_rel_param.param.value,
+            workspace.normal_not_abnormal_for_rel_param.param.value)
         if diff_not_rel == DiffVsRel.UNKNOWN:
             sub_chooser = None
         elif diff_not_rel == DiffVsRel.DIFFERENCE:
@@ -355,6 +375,7 @@ class SubChooser:
 
 
 def get_stats_chooser_modal():
+    workspace = get_workspace()
     difference_vs_relationship_radio = pn.widgets.RadioButtonGroup(
         name='Difference vs Relationship',
         options=[
@@ -370,14 +391,14 @@ def get_stats_chooser_modal():
     )
 
     def set_diff_vs_rel_param(difference_vs_relationship_value):
-        difference_not_relationship_param.value = difference_vs_relationship_value
+        workspace.difference_not_relationship_param.value = difference_vs_relationship_value
 
     sub_chooser_or_none = pn.bind(SubChooser.get_ui, difference_vs_relationship_radio)
     diff_vs_rel_param_setter = pn.bind(set_diff_vs_rel_param, difference_vs_relationship_radio)
 
     chooser_col = pn.Column(
         pn.pane.Markdown("# Test Selection"),
-        chooser_progress,
+        get_chooser_progress(),
         pn.pane.Markdown("### Answer the questions below to find the best statistical test to use"),
         pn.pane.Markdown("Finding differences or relationships?"),
         difference_vs_relationship_radio,
@@ -389,5 +410,5 @@ def get_stats_chooser_modal():
         chooser_col,
         sizing_mode='stretch_width',
         background_close=True)
-    shared[SharedKey.ACTIVE_STATS_CHOOSER_MODAL] = stats_chooser_modal
+    workspace.shared[SharedKey.ACTIVE_STATS_CHOOSER_MODAL] = stats_chooser_modal
     return stats_chooser_modal
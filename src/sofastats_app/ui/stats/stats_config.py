@@ -1,13 +1,24 @@
+"""
+Stats config modals e.g. the ANOVA form.
+
+Each is only built the first time it is opened and is then kept (per session) so opening it again
+just shows it - selections included. A modal is rebuilt if the dataset or its labels have changed since
+because its options come from them. Modals have to be inside whatever opens them (see stats_tab.py)
+so each place they can be opened from has its own StatsConfigModals.
+"""
+from typing import Any
+
 import panel as pn
 
 from sofastats_app.ui.conf import SharedKey, StatsOption
-from sofastats_app.ui.state import shared
 from sofastats_app.ui.stats.anova_form import ANOVAForm
+from sofastats_app.ui.workspace import get_workspace
 
 pn.extension('modal')
 
 
-def get_stats_config_modal(stats_test: StatsOption, btn_close: pn.widgets.Button):
+def get_stats_config_modal(stats_test: StatsOption) -> pn.layout.Modal:
+    btn_close = pn.widgets.Button(name="Close")
     if stats_test == StatsOption.ANOVA:
         anova_form_obj=ANOVAForm(btn_close)
         form = anova_form_obj.ui()
@@ -17,5 +28,40 @@ def get_stats_config_modal(stats_test: StatsOption, btn_close: pn.widgets.Button
         form,
         background_close=True,
     )
-    shared[SharedKey.ACTIVE_STATS_CONFIG_MODAL] = stats_config_modal
+    btn_close.on_click(lambda _event: stats_config_modal.hide())
     return stats_config_modal
+
+
+class StatsConfigModals:
+    """
+    Args:
+        container: put this in the layout where the modals can be opened from
+    """
+
+    def __init__(self):
+        self.container = pn.Column()
+        self._modals: dict[StatsOption, tuple[tuple[Any, Any], pn.layout.Modal]] = {}  ## stats test -> (data key, modal)
+
+    @staticmethod
+    def _get_data_key() -> tuple[Any, Any]:
+        workspace = get_workspace()
+        return workspace.shared.get(SharedKey.DATASET_HASH), workspace.data_labels_param.value
+
+    def get(self, stats_test: StatsOption) -> pn.layout.Modal:
+        data_key = StatsConfigModals._get_data_key()
+        cached = self._modals.get(stats_test)
+        if cached:
+            cached_data_key, stats_config_modal = cached
+            cached_dataset_hash, cached_data_labels = cached_data_key
+            if cached_dataset_hash == data_key[0] and cached_data_labels is data_key[1]:
+                return stats_config_modal
+            self.container.remove(stats_config_modal)  ## out of date
+        stats_config_modal = get_stats_config_modal(stats_test)
+        self.container.append(stats_config_modal)
+        self._modals[stats_test] = (data_key, stats_config_modal)
+        return stats_config_modal
+
+    def show(self, stats_test: StatsOption):
+        stats_config_modal = self.get(stats_test)
+        get_workspace().shared[SharedKey.ACTIVE_STATS_CONFIG_MODAL] = stats_config_modal  ## so running the test can hide it
+        stats_config_modal.show()
@@ -3,14 +3,18 @@ Stats form, stats chooser, and stats config
 
 Using nested modals.
 Upper modals and buttons opening and closing them must be defined inside lower modals.
+
+Nothing here is built until the Stats Tests tab is first opened (see ui.py) and the modals
+aren't built until they are first opened - after that they are kept for the rest of the session.
 """
 from bokeh.models import Tooltip
 from bokeh.models.dom import HTML
 import panel as pn
 
-from sofastats_app.ui.conf import Colour, StatsOption
+from sofastats_app.ui.conf import Colour, SharedKey, StatsOption
 from sofastats_app.ui.stats.stats_chooser import get_stats_chooser_modal
-from sofastats_app.ui.stats.stats_config import get_stats_config_modal
+from sofastats_app.ui.stats.stats_config import StatsConfigModals
+from sofastats_app.ui.workspace import get_workspace
 
 pn.extension('modal')
 
@@ -93,7 +97,7 @@ def get_stats_main():
     }
     stats_text = pn.pane.Markdown(
         "### Need help choosing a test?", width_policy='max', styles={'color': Colour.BLUE_MID, 'font-size': '16px'})
-    stats_chooser_modal = get_stats_chooser_modal()
+    stats_chooser_modal_col = pn.Column()  ## the chooser modal once built
     btn_open_stats_chooser_styles = {
         'margin-top': '10px',
     }
@@ -106,6 +110,10 @@ def get_stats_main():
     btn_open_stats_chooser = pn.widgets.Button(name="Test Selector", button_type='primary',
         styles=btn_open_stats_chooser_styles, stylesheets=[btn_test_selector_stylesheet, ])
     def open_stats_chooser(_event):
+        if not stats_chooser_modal_col.objects:
+            stats_chooser_modal_col.append(get_stats_chooser_modal())
+        stats_chooser_modal = stats_chooser_modal_col[0]
+        get_workspace().shared[SharedKey.ACTIVE_STATS_CHOOSER_MODAL] = stats_chooser_modal  ## so running a test can hide it
         stats_chooser_modal.show()
     btn_open_stats_chooser.on_click(open_stats_chooser)
     get_help_row = pn.Row(stats_text, btn_open_stats_chooser, styles=stats_need_help_style, width=800)
@@ -215,19 +223,18 @@ def get_stats_main():
     wilcoxon_tip = pn.widgets.TooltipIcon(value=get_html_tooltip(under_construction_html,
         horizontal_offset=TOOLTIP_HORIZONTAL_OFFSET_2, vertical_offset=125 - (1 * VERT_BTN_DROP), width=775),
         margin=tip_margins)
-    btn_close = pn.widgets.Button(name="Close")
+    stats_config_modals = StatsConfigModals()
+    servables.append(stats_config_modals.container)
     def open_anova_config(_event):
-        stats_config_modal = get_stats_config_modal(StatsOption.ANOVA, btn_close)
-        servables.append(stats_config_modal)
-        stats_config_modal.show()
-        def close_config_modal(_event):
-            stats_config_modal.hide()
-        btn_close.on_click(close_config_modal)
+        stats_config_modals.show(StatsOption.ANOVA)
     btn_anova.on_click(open_anova_config)
+    under_construction_modals = {}
     def test_under_construction(event):
-        stats_config_modal = pn.layout.Modal(pn.pane.Markdown(f"{event.obj.name} under construction"))
-        servables.append(stats_config_modal)
-        stats_config_modal.show()
+        if event.obj.name not in under_construction_modals:
+            under_construction_modal = pn.layout.Modal(pn.pane.Markdown(f"{event.obj.name} under construction"))
+            servables.append(under_construction_modal)
+            under_construction_modals[event.obj.name] = under_construction_modal
+        under_construction_modals[event.obj.name].show()
     btn_chi_square.on_click(test_under_construction)
     btn_indep_ttest.on_click(test_under_construction)
     btn_kruskal_wallis.on_click(test_under_construction)
@@ -263,4 +270,4 @@ def get_stats_main():
         ),
         servables,
     )
-    return pn.Column(stats_col, stats_chooser_modal, )
+    return pn.Column(stats_col, stats_chooser_modal_col, )
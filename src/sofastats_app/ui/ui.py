@@ -1,22 +1,35 @@
 """
-c && cd ~/projects/sofastats/src/sofastats_app/ui && panel serve ui.py --static-dirs images=./images
+c && cd ~/projects/sofastats/src/sofastats_app/ui && panel serve ui.py --static-dirs images=./images --setup server_setup.py
 """
+import asyncio
 from enum import StrEnum
-import html
+from functools import partial
+import time
 
 import panel as pn
 
-from sofastats_app.ui.conf import SIDEBAR_WIDTH, Colour, SharedKey
+from sofastats.conf.main import DEFAULT_OUTPUT_FOLDER
+from sofastats_app import logger
+from sofastats_app.ui.conf import OUTPUT_BUNDLE_ASSETS, OUTPUT_GZIP, SIDEBAR_WIDTH, Colour, SharedKey
 from sofastats_app.ui.data import Data
 from sofastats_app.ui.charts_and_tables import get_charts_and_tables_main
-from sofastats_app.ui.state import (data_toggle, give_output_tab_focus_param, got_data_param, html_param, shared,
-                                    show_output_saved_msg_param, show_output_tab_param)
+from sofastats_app.ui.report_bundle import write_report
+from sofastats_app.ui.reports import report_store
+from sofastats_app.ui.stats.analysis_runner import preload_analysis_modules
+from sofastats_app.ui.stats.results_history import results_history
 from sofastats_app.ui.stats.stats_tab import get_stats_main
 from sofastats_app.ui.ui_template import ChocolateTemplate
+from sofastats_app.ui.utils import get_app_url
+from sofastats_app.ui.workspace import get_workspace
 
 pn.extension('modal')
 pn.extension('tabulator')
 
+## this script runs once per session. The imports above are already done by server_setup.py
+## (and logged there) if the server was started by panel_server.py - otherwise the first session in a process waits for them
+session_start = time.perf_counter()
+preload_analysis_modules()  ## in the background - not needed until the first analysis
+
 class TabLabel(StrEnum):
     CHARTS_AND_TABLES = 'Charts & Tables'
     STATS_TESTS = 'Stats Tests'
@@ -42,101 +55,148 @@ css = f"""
 """
 pn.extension(raw_css=[css])
 
+workspace = get_workspace()  ## this script is run once per session so this is the current session's workspace
+shared = workspace.shared
+
 data_col = Data().ui()
 charts_and_tables_col = get_charts_and_tables_main()
-stats_col = get_stats_main()
+stats_col = pn.Column()  ## only built when the tab is first opened - see build_stats_tab
 
 def save_output(_event):
-    html_text = html_param.value
-    shared[SharedKey.CURRENT_OUTPUT_FPATH].parent.mkdir(exist_ok=True)  ## only make as required - minimise messing with user's file system
-    with open(shared[SharedKey.CURRENT_OUTPUT_FPATH], 'w') as f:
-        f.write(html_text)
-    show_output_saved_msg_param.value = True
-
-def show_output(html_value: str, show_output_saved_msg_value):
-    if html_value:
-        btn_save_output = pn.widgets.Button(
-            name="Save Results", description="Save results so you can share them e.g. email as an attachment")
-        btn_save_output.on_click(save_output)
-        escaped_html = html.escape(html_value)
-        iframe_html = f'<iframe srcdoc="{escaped_html}" style="height:100%; width:100%" frameborder="0"></iframe>'
-        html_output_widget = pn.pane.HTML(iframe_html, sizing_mode='stretch_both')
-        if show_output_saved_msg_value:
-            saved_msg = f"Saved output to '{shared[SharedKey.CURRENT_OUTPUT_FPATH]}'"
-            saved_alert = pn.pane.Alert(saved_msg, alert_type='info')
-            html_col = pn.Column(btn_save_output, saved_alert, html_output_widget)
-        else:
-            html_col = pn.Column(btn_save_output, html_output_widget)
+    html_text = workspace.html_param.value
+    saved_fpath = write_report(html_text, shared[SharedKey.CURRENT_OUTPUT_FPATH],  ## only makes folder as required - minimise messing with user's file system
+        bundle_assets=OUTPUT_BUNDLE_ASSETS, gzip_output=OUTPUT_GZIP)
+    shared[SharedKey.SAVED_OUTPUT_FPATH] = saved_fpath
+    workspace.show_output_saved_msg_param.value = True
+
+WAITING_FOR_OUTPUT_MSG = 'Waiting for some output to be generated ...'
+
+## built once - only the iframe URL and the saved message change (see reports.py)
+btn_save_output = pn.widgets.Button(name="Save Results",
+    description="Save results so you can share them e.g. email as an attachment", visible=False)
+btn_save_output.on_click(save_output)
+saved_alert = pn.pane.Alert('', alert_type='info', visible=False)
+html_output_widget = pn.pane.HTML(WAITING_FOR_OUTPUT_MSG, sizing_mode='stretch_both')
+## earlier results - only the index is listed; a report is read from the history when opened
+results_history_table = pn.widgets.Tabulator(results_history.get_items_df(''), disabled=True, show_index=False,
+    hidden_columns=['result_id'], buttons={'open': "Open"}, height=200, sizing_mode='stretch_width')
+results_history_card = pn.Card(results_history_table, title="Earlier Results", collapsed=True,
+    sizing_mode='stretch_width')
+html_output = pn.Column(btn_save_output, saved_alert, results_history_card, html_output_widget,
+    sizing_mode='stretch_both')
+
+def refresh_results_history():
+    results_history_table.value = results_history.get_items_df(shared.get(SharedKey.DATASET_HASH) or '')
+
+def open_earlier_result(event):
+    row = results_history_table.value.iloc[event.row]
+    html_text = results_history.get_html(int(row['result_id']))
+    if html_text is None:  ## dropped from the history since the list was shown
+        refresh_results_history()
+        return
+    workspace.show_output_saved_msg_param.value = False
+    shared[SharedKey.CURRENT_OUTPUT_FPATH] = DEFAULT_OUTPUT_FOLDER / f"{row['Result']} generated at {row['Run']}.html"
+    workspace.html_param.value = html_text
+
+results_history_table.on_click(open_earlier_result, column='open')
+
+async def show_output(html_value: str):
+    """
+    Publishing bundles the report's assets and writes it to the shared store (see reports.py)
+    so it is done in a worker thread rather than holding up every session's callbacks on the event loop
+    """
+    btn_save_output.visible = bool(html_value)
+    if not html_value:
+        html_output_widget.object = WAITING_FOR_OUTPUT_MSG
+        return
+    report_path = await asyncio.to_thread(report_store.publish, html_value)
+    if html_value != workspace.html_param.value:
+        return  ## a newer result has arrived meanwhile and shows itself
+    report_url = get_app_url(report_path)
+    html_output_widget.object = (
+        f'<iframe src="{report_url}" style="height:100%; width:100%" frameborder="0"></iframe>')
+
+async def show_new_output(event):
+    await show_output(event.new)
+
+def show_output_saved_msg(show_output_saved_msg_value: bool):
+    if show_output_saved_msg_value:
+        saved_alert.object = f"Saved output to '{shared[SharedKey.SAVED_OUTPUT_FPATH]}'"
+    saved_alert.visible = show_output_saved_msg_value
+
+pn.state.execute(partial(show_output, workspace.html_param.value))
+workspace.html_param.param.watch(show_new_output, 'value')
+workspace.html_param.param.watch(lambda _event: refresh_results_history(), 'value')
+workspace.got_data_param.param.watch(lambda _event: refresh_results_history(), 'value')  ## new dataset so other history
+workspace.show_output_saved_msg_param.param.watch(lambda event: show_output_saved_msg(event.new), 'value')
+
+## built once - the Results tab is added when there is output and the whole lot only shown once there is data
+tabs = pn.layout.Tabs(
+    (TabLabel.CHARTS_AND_TABLES, charts_and_tables_col),
+    (TabLabel.STATS_TESTS, stats_col),
+    visible=workspace.got_data_param.value,
+)
+tabs.css_classes = ['bk-tabs']  ## Add the CSS class for styling
+STATS_TAB_IDX = 1
+RESULTS_TAB_IDX = 2
+
+def build_stats_tab(active_tab_idx: int):
+    if active_tab_idx == STATS_TAB_IDX and not stats_col.objects:
+        stats_col.append(get_stats_main())
+
+def show_results_tab(show_output_tab_value: bool):
+    has_results_tab = len(tabs) > RESULTS_TAB_IDX
+    if show_output_tab_value and not has_results_tab:
+        tabs.append((TabLabel.RESULTS, html_output))
+    elif not show_output_tab_value and has_results_tab:
+        tabs.pop(RESULTS_TAB_IDX)
+
+def give_results_tab_focus(give_output_tab_focus_value: bool):
+    if give_output_tab_focus_value and len(tabs) > RESULTS_TAB_IDX:
+        tabs.active = RESULTS_TAB_IDX
+
+def allow_user_to_set_tab_focus(_event):
+    workspace.give_output_tab_focus_param.value = False  ## so the next result can take focus again
+
+show_results_tab(workspace.show_output_tab_param.value)
+workspace.show_output_tab_param.param.watch(lambda event: show_results_tab(event.new), 'value')
+workspace.give_output_tab_focus_param.param.watch(lambda event: give_results_tab_focus(event.new), 'value')
+tabs.param.watch(allow_user_to_set_tab_focus, 'active')
+tabs.param.watch(lambda event: build_stats_tab(event.new), 'active')
+workspace.got_data_param.param.watch(lambda event: setattr(tabs, 'visible', event.new), 'value')
+
+btn_data_toggle = pn.widgets.Button(
+    icon="arrow-big-left", #"images/left_arrow.svg",
+    name="Close Data Window",
+    button_type="light", button_style='solid',
+    styles={
+        'margin-top': '-5px', 'margin-right': '20px', 'margin-bottom': '5px', 'margin-left': '-20px',
+        'border': '2px solid grey',
+        'border-radius': '5px',
+    },
+    visible=workspace.got_data_param.value,
+)
+
+def toggle_data_window(_event):
+    workspace.data_toggle.value = not workspace.data_toggle.value
+    if not workspace.data_toggle.value:
+        btn_data_toggle.icon = "arrow-big-right"
+        btn_data_toggle.name = "Open Data Window"
     else:
-        html_output_widget = pn.pane.HTML('Waiting for some output to be generated ...',
-            sizing_mode="stretch_both")
-        html_col = pn.Column(html_output_widget)
-    return html_col
-
-html_output = pn.bind(show_output, html_param.param.value, show_output_saved_msg_param.param.value)
+        btn_data_toggle.icon = "arrow-big-left"
+        btn_data_toggle.name = "Close Data Window"
 
-def get_tabs(show_output_tab_value, give_output_tab_focus_value, got_data_value):
-
-    if not got_data_value:
-        return None
-
-    if show_output_tab_value:
-        tabs = pn.layout.Tabs(
-            (TabLabel.CHARTS_AND_TABLES, charts_and_tables_col),
-            (TabLabel.STATS_TESTS, stats_col),
-            (TabLabel.RESULTS, html_output),
-        )
-    else:
-        tabs = pn.layout.Tabs(
-            (TabLabel.CHARTS_AND_TABLES, charts_and_tables_col),
-            (TabLabel.STATS_TESTS, stats_col),
-        )
-    tabs.css_classes = ['bk-tabs']  ## Add the CSS class for styling
-
-    def allow_user_to_set_tab_focus(_current_active_tab):
-        give_output_tab_focus_param.value = False
-
-    user_tab_focus = pn.bind(allow_user_to_set_tab_focus, tabs.param.active)
-
-    if give_output_tab_focus_value:
-        tabs.active = 2
-    return pn.Column(tabs, user_tab_focus)
-
-output_tabs = pn.bind(get_tabs,
-    show_output_tab_param.param.value, give_output_tab_focus_param.param.value, got_data_param.param.value)
-
-def get_btn_data_toggle(got_data_value):
-    if not got_data_value:
-        return None
-    btn_data_toggle = pn.widgets.Button(  ## seems like we must define in same place as you are watching it
-        icon="arrow-big-left", #"images/left_arrow.svg",
-        name="Close Data Window",
-        button_type="light", button_style='solid',
-        styles={
-            'margin-top': '-5px', 'margin-right': '20px', 'margin-bottom': '5px', 'margin-left': '-20px',
-            'border': '2px solid grey',
-            'border-radius': '5px',
-        })
-
-    @pn.depends(btn_data_toggle, watch=True)
-    def _update_main(_):
-        data_toggle.value = not data_toggle.value
-
-        if not data_toggle.value:
-            btn_data_toggle.icon = "arrow-big-right"
-            btn_data_toggle.name = "Open Data Window"
-        else:
-            btn_data_toggle.icon = "arrow-big-left"
-            btn_data_toggle.name = "Close Data Window"
-
-    return btn_data_toggle
-
-btn_data_toggle_or_none = pn.bind(get_btn_data_toggle, got_data_param.param.value)
+btn_data_toggle.on_click(toggle_data_window)
+workspace.got_data_param.param.watch(lambda event: setattr(btn_data_toggle, 'visible', event.new), 'value')
 
+widgets_built = time.perf_counter()
 ChocolateTemplate(
     title="SOFA Stats - no sweat stats!",
     sidebar_width=SIDEBAR_WIDTH,
     sidebar=[data_col, ],
-    main=[btn_data_toggle_or_none, data_toggle, output_tabs, ],
+    main=[btn_data_toggle, workspace.data_toggle, tabs, ],
     local_logo_url='bunny_head_small.svg',
 ).servable()
+template_built = time.perf_counter()
+logger.info(f"Session {workspace.session_id} UI built in {template_built - session_start:.2f}s "
+    f"(widgets {widgets_built - session_start:.2f}s; template {template_built - widgets_built:.2f}s)")
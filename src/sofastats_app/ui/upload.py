@@ -0,0 +1,401 @@
+"""
+Chunked, resumable CSV uploads.
+
+pn.widgets.FileInput sends the whole file base64-encoded through the Bokeh websocket as a single message.
+That is a third bigger than the file, runs into websocket message size limits,
+and leaves several copies of the file in server memory.
+
+Instead, the browser PUTs the file in chunks to a plain Tornado handler
+which appends each chunk straight to the session's spool folder on disk.
+Before sending anything the browser asks how much of the file the server already has (HEAD)
+so an interrupted upload carries on from where it stopped rather than starting again.
+Once the last chunk has arrived the browser tells the session (through the ChunkedFileUpload component)
+and the file is read from disk.
+
+The handler is mounted alongside the Panel app with `panel serve --plugins sofastats_app.ui.upload`
+(see panel_server.py). It only accepts uploads for a session which has registered its spool folder
+under a random token - the token is the only thing the browser knows about where the file goes.
+With several server processes the upload may not arrive at the process holding the session
+so tokens are also registered as files in UPLOAD_REGISTRY_FOLDER which every process can read.
+Registrations left behind by a process which has stopped (e.g. crashed) are removed the next time a session registers.
+
+Each chunk is written at its stated offset rather than appended, only if that offset is how much the server already has,
+and never beyond the stated length of the upload. Only one request at a time may write to any given upload -
+whichever server process it arrives at. The writer holds a marker file next to the upload
+so clearing out a spool folder (in any process) leaves an upload which is still arriving alone.
+Once a complete upload has been read (see data.py) it is deleted - the parsed data is kept instead.
+"""
+import json
+import os
+from pathlib import Path
+import re
+import secrets
+import shutil
+import threading
+
+import panel as pn
+import param
+from tornado.web import HTTPError, RequestHandler, stream_request_body
+
+from sofastats_app import logger
+from sofastats_app.ui.conf import UPLOAD_CHUNK_BYTES, UPLOAD_MAX_BYTES, UPLOAD_REGISTRY_FOLDER, UPLOAD_URL_PREFIX
+
+UPLOAD_ID_PATTERN = r'[A-Za-z0-9_-]{1,64}'
+COMPLETE_SUFFIX = '.csv'
+PARTIAL_SUFFIX = '.part'
+WRITING_SUFFIX = '.writing'  ## marker held by whichever request is writing to the upload right now
+UPLOAD_SUFFIXES = (COMPLETE_SUFFIX, PARTIAL_SUFFIX, WRITING_SUFFIX)
+
+_upload_dpaths: dict[str, Path] = {}
+_upload_dpaths_lock = threading.Lock()
+
+def _is_process_running(pid: int) -> bool:
+    if os.name != 'posix':  ## os.kill(pid, 0) would terminate the process on Windows - so assume still running
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  ## running but not ours
+        return True
+    return True
+
+def remove_stale_registrations():
+    """
+    Registrations whose upload folder has gone or whose process has stopped (the folder goes too)
+    """
+    for registration_fpath in UPLOAD_REGISTRY_FOLDER.glob('*'):
+        try:
+            registration = json.loads(registration_fpath.read_text(encoding='utf-8'))
+            upload_dpath = Path(registration['upload_dpath'])
+            pid = int(registration['pid'])
+        except (OSError, ValueError, KeyError, TypeError):  ## e.g. unregistered meanwhile or not one of ours
+            continue
+        if upload_dpath.exists() and _is_process_running(pid):
+            continue
+        shutil.rmtree(upload_dpath, ignore_errors=True)
+        registration_fpath.unlink(missing_ok=True)
+        logger.info(f"Removed stale upload registration for '{upload_dpath}'")
+
+def register_upload_dpath(upload_dpath: Path) -> str:
+    """
+    Returns:
+        token to put in the upload URL
+    """
+    token = secrets.token_urlsafe(24)
+    with _upload_dpaths_lock:
+        _upload_dpaths[token] = upload_dpath
+    UPLOAD_REGISTRY_FOLDER.mkdir(mode=0o700, parents=True, exist_ok=True)
+    remove_stale_registrations()
+    registration = {'upload_dpath': str(upload_dpath), 'pid': os.getpid()}
+    (UPLOAD_REGISTRY_FOLDER / token).write_text(json.dumps(registration), encoding='utf-8')
+    return token
+
+def unregister_upload_dpath(token: str):
+    with _upload_dpaths_lock:
+        _upload_dpaths.pop(token, None)
+    (UPLOAD_REGISTRY_FOLDER / token).unlink(missing_ok=True)
+
+def get_upload_dpath(token: str) -> Path | None:
+    """
+    Registered by this process or (if several server processes) any other
+    """
+    with _upload_dpaths_lock:
+        upload_dpath = _upload_dpaths.get(token)
+    if upload_dpath:
+        return upload_dpath
+    try:
+        registration = json.loads((UPLOAD_REGISTRY_FOLDER / token).read_text(encoding='utf-8'))
+        return Path(registration['upload_dpath'])
+    except (OSError, ValueError, KeyError, TypeError):  ## e.g. not registered (or already unregistered)
+        return None
+
+def get_uploaded_fpath(upload_dpath: Path, upload_id: str) -> Path | None:
+    """
+    None if the upload isn't complete (or the ID isn't one we could have been sent)
+    """
+    if not re.fullmatch(UPLOAD_ID_PATTERN, upload_id or ''):
+        return None
+    fpath = upload_dpath / f"{upload_id}{COMPLETE_SUFFIX}"
+    return fpath if fpath.exists() else None
+
+def _get_writing_fpath(upload_dpath: Path, upload_id: str) -> Path:
+    return upload_dpath / f"{upload_id}{WRITING_SUFFIX}"
+
+def _is_writer_running(writing_fpath: Path) -> bool:
+    try:
+        pid = int(writing_fpath.read_text(encoding='utf-8'))
+    except FileNotFoundError:  ## finished meanwhile
+        return False
+    except (OSError, ValueError):  ## only just created - pid not written yet
+        return True
+    return _is_process_running(pid)
+
+def claim_upload(upload_dpath: Path, upload_id: str) -> bool:
+    """
+    Claimed on disk, not in memory, because with several server processes another may be writing to the same upload.
+    A marker left behind by a process which stopped mid-chunk is taken over.
+
+    Returns:
+        False if another request (in this process or any other) is still writing to the upload
+    """
+    writing_fpath = _get_writing_fpath(upload_dpath, upload_id)
+    for _attempt in range(2):
+        try:
+            fd = os.open(writing_fpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except FileExistsError:
+            if _is_writer_running(writing_fpath):
+                return False
+            writing_fpath.unlink(missing_ok=True)
+            continue
+        except FileNotFoundError:  ## spool folder gone e.g. session closed
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as writing_file:
+            writing_file.write(str(os.getpid()))
+        return True
+    return False
+
+def release_upload(upload_dpath: Path, upload_id: str):
+    _get_writing_fpath(upload_dpath, upload_id).unlink(missing_ok=True)
+
+def is_upload_being_written(upload_dpath: Path, upload_id: str) -> bool:
+    return _is_writer_running(_get_writing_fpath(upload_dpath, upload_id))
+
+def remove_uploads(upload_dpath: Path, *, keep_upload_id: str | None = None):
+    """
+    Any upload still being written to (possibly by another server process) is left alone
+    """
+    for fpath in upload_dpath.glob('*'):
+        if fpath.suffix not in UPLOAD_SUFFIXES or fpath.stem == keep_upload_id:
+            continue
+        if is_upload_being_written(upload_dpath, fpath.stem):
+            continue
+        fpath.unlink(missing_ok=True)
+
+def remove_other_uploads(upload_dpath: Path, upload_id: str):
+    """
+    Only the latest upload is needed once it has been read
+    """
+    remove_uploads(upload_dpath, keep_upload_id=upload_id)
+
+def get_uploads_size(upload_dpath: Path, *, excluding_upload_id: str) -> int:
+    return sum(fpath.stat().st_size for fpath in upload_dpath.glob('*')
+        if fpath.suffix in (COMPLETE_SUFFIX, PARTIAL_SUFFIX) and fpath.stem != excluding_upload_id and fpath.is_file())
+
+
+@stream_request_body
+class ChunkedUploadHandler(RequestHandler):
+    """
+    HEAD - how many bytes of the upload we already have (Upload-Offset header)
+    PUT - write the body at Upload-Offset. Once Upload-Length bytes have arrived the upload is complete.
+
+    409 (with the server's Upload-Offset) if Upload-Offset isn't how much the server already has
+    or another request is still writing to the same upload. 413 if the upload would be too big.
+    """
+
+    def initialize(self):
+        self.upload_file = None
+        self.is_writer = False  ## holds the upload's marker file (see claim_upload)
+        self.is_too_long = False
+
+    def prepare(self):
+        token, upload_id = self.path_args
+        upload_dpath = get_upload_dpath(token)
+        if not upload_dpath:
+            raise HTTPError(404)
+        self.upload_dpath = upload_dpath
+        self.upload_id = upload_id
+        self.part_fpath = upload_dpath / f"{upload_id}{PARTIAL_SUFFIX}"
+        self.complete_fpath = upload_dpath / f"{upload_id}{COMPLETE_SUFFIX}"
+        if self.request.method != 'PUT':
+            return
+        self.request.connection.set_max_body_size(UPLOAD_CHUNK_BYTES)
+        try:
+            offset = int(self.request.headers['Upload-Offset'])
+            self.upload_length = int(self.request.headers['Upload-Length'])
+            body_length = int(self.request.headers.get('Content-Length', 0))
+        except ValueError:
+            raise HTTPError(400, "Upload-Offset and Upload-Length headers must be whole numbers")
+        except KeyError:
+            raise HTTPError(400, "Upload-Offset and Upload-Length headers required")
+        if offset < 0 or offset + body_length > self.upload_length:
+            raise HTTPError(413, "Chunk goes beyond Upload-Length")
+        if self.upload_length + get_uploads_size(upload_dpath, excluding_upload_id=upload_id) > UPLOAD_MAX_BYTES:
+            raise HTTPError(413, f"Uploads are limited to {UPLOAD_MAX_BYTES:,} bytes")
+        self.is_writer = claim_upload(upload_dpath, upload_id)
+        current_offset = self.get_current_offset()
+        ## e.g. a retried chunk which had actually arrived, or the same chunk still arriving from an earlier attempt
+        ## - browser must ask again
+        if not self.is_writer or offset != current_offset:
+            self.set_header('Upload-Offset', str(current_offset))
+            self.set_status(409)
+            self.finish()
+            return
+        if not self.complete_fpath.exists():
+            self.part_fpath.touch()
+            self.upload_file = open(self.part_fpath, 'r+b')
+            self.upload_file.seek(offset)  ## not appended - so a chunk written twice (e.g. via another process) is harmless
+
+    def get_current_offset(self) -> int:
+        if self.complete_fpath.exists():
+            return self.complete_fpath.stat().st_size
+        if self.part_fpath.exists():
+            return self.part_fpath.stat().st_size
+        return 0
+
+    def data_received(self, chunk: bytes):
+        if not self.upload_file:
+            return
+        n_bytes_allowed = self.upload_length - self.upload_file.tell()
+        if len(chunk) > n_bytes_allowed:  ## e.g. no Content-Length (chunked transfer encoding) so not refused earlier
+            chunk = chunk[:n_bytes_allowed]
+            self.is_too_long = True
+        self.upload_file.write(chunk)
+
+    def head(self, _token: str, _upload_id: str):
+        self.set_header('Upload-Offset', str(self.get_current_offset()))
+
+    def put(self, _token: str, _upload_id: str):
+        if self.upload_file:
+            self.upload_file.close()
+            self.upload_file = None
+            if self.part_fpath.stat().st_size >= self.upload_length:
+                self.part_fpath.replace(self.complete_fpath)
+                logger.info(f"Upload complete: '{self.complete_fpath}' ({self.upload_length:,} bytes)")
+        self.set_header('Upload-Offset', str(self.get_current_offset()))
+        if self.is_too_long:
+            raise HTTPError(413, "Chunk went beyond Upload-Length")
+        self.set_status(204)
+
+    def on_finish(self):
+        if self.upload_file:  ## whatever arrived before a dropped connection is kept so the upload can resume
+            self.upload_file.close()
+            self.upload_file = None
+        if self.is_writer:
+            release_upload(self.upload_dpath, self.upload_id)
+            self.is_writer = False
+
+    def on_connection_close(self):
+        self.on_finish()
+
+
+ROUTES = [  ## picked up by panel serve --plugins
+    (rf'{UPLOAD_URL_PREFIX}/([A-Za-z0-9_-]+)/({UPLOAD_ID_PATTERN})', ChunkedUploadHandler),
+]
+
+
+class ChunkedFileUpload(pn.custom.JSComponent):
+    """
+    File selector which uploads through ChunkedUploadHandler.
+    Watch n_completed - when it goes up, upload_id identifies the file (see get_uploaded_fpath).
+    """
+    accept = param.String(default='.csv')
+    upload_url = param.String(doc="Includes the session's token but not the upload ID")
+    chunk_bytes = param.Integer(default=UPLOAD_CHUNK_BYTES)
+    filename = param.String(default='', doc="Set to '' from Python to clear the selected file")
+    upload_id = param.String(default='')
+    n_completed = param.Integer(default=0)
+
+    _esm = """
+const MAX_RETRIES = 5;
+
+class UploadRefusedError extends Error {}  // e.g. too big - no point retrying
+
+function getUploadId(file) {
+    // same file (name, size, and modification time) gets the same ID so an interrupted upload can resume
+    let hash = 0x811c9dc5;  // FNV-1a
+    for (const char of `${file.name}|${file.size}|${file.lastModified}`) {
+        hash ^= char.codePointAt(0);
+        hash = Math.imul(hash, 0x01000193) >>> 0;
+    }
+    return `${hash.toString(16)}-${file.size}`;
+}
+
+async function getOffset(url) {
+    const response = await fetch(url, { method: 'HEAD' });
+    if (!response.ok) {
+        throw new Error(`server responded ${response.status}`);
+    }
+    return parseInt(response.headers.get('Upload-Offset'), 10);
+}
+
+export function render({ model, el }) {
+    const input = document.createElement('input');
+    input.type = 'file';
+    input.accept = model.accept;
+    const progress = document.createElement('progress');
+    progress.max = 100;
+    progress.style.display = 'none';
+    const status = document.createElement('div');
+    status.style.fontSize = '12px';
+    el.append(input, progress, status);
+
+    async function upload(file) {
+        const uploadId = getUploadId(file);
+        const url = `${model.upload_url}/${uploadId}`;
+        let offset = await getOffset(url);  // more than zero if resuming
+        let nFailures = 0;
+        progress.style.display = 'block';
+        while (offset < file.size) {
+            progress.value = Math.floor(100 * offset / file.size);
+            status.textContent = `Uploading ${file.name} ... ${progress.value}%`;
+            try {
+                const response = await fetch(url, {
+                    method: 'PUT',
+                    body: file.slice(offset, offset + model.chunk_bytes),
+                    headers: { 'Upload-Offset': String(offset), 'Upload-Length': String(file.size) },
+                });
+                if (response.status === 413) {
+                    throw new UploadRefusedError('file too big');
+                }
+                if (!response.ok && response.status !== 409) {  // 409 - out of step so carry on from the server's offset
+                    throw new Error(`server responded ${response.status}`);
+                }
+                if (response.status === 409) {  // possibly an earlier attempt still arriving - give it a moment
+                    await new Promise(resolve => setTimeout(resolve, 250));
+                }
+                offset = parseInt(response.headers.get('Upload-Offset'), 10);
+                nFailures = 0;
+            } catch (err) {
+                nFailures += 1;
+                if (err instanceof UploadRefusedError || nFailures > MAX_RETRIES) {
+                    throw err;
+                }
+                status.textContent = `Connection problem - retrying upload of ${file.name} ...`;
+                await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** nFailures));
+                offset = await getOffset(url);
+            }
+        }
+        progress.style.display = 'none';
+        status.textContent = '';
+        model.filename = file.name;
+        model.upload_id = uploadId;
+        model.n_completed += 1;
+    }
+
+    input.addEventListener('change', async () => {
+        const file = input.files[0];
+        if (!file) {
+            return;
+        }
+        if (!file.size) {
+            status.textContent = `${file.name} is empty`;
+            return;
+        }
+        input.disabled = true;
+        try {
+            await upload(file);
+        } catch (err) {
+            progress.style.display = 'none';
+            status.textContent = `Unable to upload ${file.name} (${err.message}) - please try again`;
+        } finally {
+            input.disabled = false;
+        }
+    });
+    model.on('filename', () => {
+        if (!model.filename) {
+            input.value = '';
+        }
+    });
+}
+"""
@@ -1,5 +1,9 @@
+from collections.abc import Mapping
 from typing import Any
 
+import pandas as pd
+import panel as pn
+
 def get_unlabelled(possibly_labelled: Any) -> str:
     """
     e.g. 'Country (country)' => 'country'
@@ -14,3 +18,31 @@ def get_unlabelled(possibly_labelled: Any) -> str:
     except TypeError as e:  ## e.g. a number
         unlabelled = possibly_labelled
     return unlabelled
+
+def apply_value_labels(series: pd.Series, val_mapping: Mapping[Any, str]) -> pd.Series:
+    """
+    Vectorised equivalent of series.apply(lambda val: val_mapping.get(val, val))
+    e.g. [1, 2, 9] with {1: 'NZ', 2: 'USA'} => ['NZ', 'USA', 9]
+    """
+    labelled = series.map(val_mapping)
+    return labelled.astype(object).where(labelled.notna(), series)
+
+def get_app_url(route_path: str) -> str:
+    """
+    One of our own routes (e.g. under REPORT_URL_PREFIX) relative to the current page
+    so it still works if the server has a --prefix or sits behind a proxy
+    e.g. '/sofastats_report/x.html' => 'sofastats_report/x.html' (app served at <prefix>/ui)
+    """
+    route_path = route_path.lstrip('/')
+    rel_path = pn.state.rel_path
+    return f"{rel_path.rstrip('/')}/{route_path}" if rel_path else route_path
+
+def get_relabelled_cols(prev_data_labels: Mapping[str, Any], data_labels: Mapping[str, Any]) -> set[str]:
+    """
+    Columns whose value labels differ between two sets of data label mappings
+    (changes to variable labels don't alter any values so are ignored)
+    """
+    cols = set(prev_data_labels or {}) | set(data_labels or {})
+    return {col for col in cols
+        if ((prev_data_labels or {}).get(col) or {}).get('value_labels')
+            != ((data_labels or {}).get(col) or {}).get('value_labels')}
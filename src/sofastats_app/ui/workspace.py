@@ -0,0 +1,187 @@
+"""
+Per-session state.
+
+`panel serve` runs ui.py once per browser session but every other module is only imported once per server process.
+So anything stored at module level is shared by every analyst connected to the server
+e.g. one analyst uploads a CSV and everyone else's data is silently replaced.
+Instead, each Bokeh session gets its own Workspace holding its params, shared dict, and temporary files.
+
+Workspaces are evicted when the session is destroyed.
+If a session is left idle for too long its data is released (the session itself survives
+and the analyst is asked to select their CSV again). Any change to the session's document counts as activity
+(see Workspace.touch) so an analyst busy running analyses is never treated as idle.
+"""
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+import time
+
+from bokeh.document.events import DocumentChangedEvent, DocumentPatchedEvent
+import pandas as pd
+import panel as pn
+
+from sofastats_app import logger
+from sofastats_app.ui.conf import (DEBUG_PATCH_BYTES, SESSION_IDLE_SWEEP_SECS, SESSION_IDLE_TIMEOUT_SECS,
+    DiffVsRel, IndepVsPaired, Normal, NumGroups, OrdinalVsCategorical, SharedKey)
+from sofastats_app.ui.data_source import release_data_source
+from sofastats_app.ui.patch_monitor import PatchTrafficMonitor
+from sofastats_app.ui.state import Bool, Choice, Dict, SidebarToggle, Text
+from sofastats_app.ui.upload import register_upload_dpath, remove_uploads, unregister_upload_dpath
+
+
+class Workspace:
+
+    def __init__(self, session_id: str | None):
+        self.session_id = session_id
+        self.doc = pn.state.curdoc  ## so we can safely schedule changes to this session's UI from elsewhere
+        self.last_active = time.monotonic()
+        self.memory_bytes = 0
+        self.spool_dpath = Path(tempfile.mkdtemp(prefix='sofastats_session_'))  ## e.g. for uploaded files
+        self.upload_token = register_upload_dpath(self.spool_dpath)  ## so uploads for this session end up in its spool folder
+        self.patch_monitor = PatchTrafficMonitor(self.doc, session_id) if DEBUG_PATCH_BYTES and self.doc else None
+        if self.doc:
+            self.doc.on_change(self._on_doc_change)
+        self.shared = {  ## common state for session that is not param
+            SharedKey.DF_CSV: pd.DataFrame(),
+            SharedKey.SERVABLES: pn.Column(),
+        }
+        ## PARAMS
+        ## data
+        self.got_data_param = Bool(value=False)
+        self.data_labels_param = Dict(value={})
+        ## stats helper
+        self.difference_not_relationship_param = Choice(value=DiffVsRel.UNKNOWN)
+        self.two_not_three_plus_groups_for_diff_param = Choice(value=NumGroups.UNKNOWN)
+        self.normal_not_abnormal_for_diff_param = Choice(value=Normal.UNKNOWN)
+        self.independent_not_paired_for_diff_param = Choice(value=IndepVsPaired.UNKNOWN)
+        self.ordinal_at_least_for_rel_param = Choice(value=OrdinalVsCategorical.UNKNOWN)
+        self.normal_not_abnormal_for_rel_param = Choice(value=Normal.UNKNOWN)
+        ## output / results
+        self.give_output_tab_focus_param = Bool(value=False)
+        self.html_param = Text(value='')
+        self.show_output_tab_param = Bool(value=False)
+        self.show_output_saved_msg_param = Bool(value=False)
+        ## layout
+        self.data_toggle = SidebarToggle(value=True)
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def _on_doc_change(self, event: DocumentChangedEvent):
+        """
+        Every change to the session's document - whether from the browser (e.g. selecting a value)
+        or from the server (e.g. results arriving) - counts as activity so no callback has to say so itself
+        """
+        if isinstance(event, DocumentPatchedEvent):  ## not e.g. a callback being added
+            self.touch()
+
+    def is_idle(self, now: float) -> bool:
+        return bool(self.memory_bytes) and now - self.last_active > SESSION_IDLE_TIMEOUT_SECS
+
+    def update_memory_usage(self) -> int:
+        """
+        Bytes held by this session's data frames plus its temporary files.
+        Recalculated on demand (e.g. after a new CSV is loaded) because a deep memory_usage isn't free.
+        """
+        df_bytes = sum(int(val.memory_usage(deep=True).sum())
+            for val in self.shared.values() if isinstance(val, pd.DataFrame))
+        spool_bytes = sum(fpath.stat().st_size for fpath in self.spool_dpath.glob('*') if fpath.is_file())
+        self.memory_bytes = df_bytes + spool_bytes
+        logger.info(f"Session {self.session_id} now using {self.memory_bytes:,} bytes "
+            f"(data frames {df_bytes:,}; temporary files {spool_bytes:,})")
+        return self.memory_bytes
+
+    def release_data(self):
+        """
+        Drop the data but leave params and widgets alone so the session can carry on.
+        """
+        self.shared[SharedKey.DF_CSV] = pd.DataFrame()
+        self.shared.pop(SharedKey.DATASET_PROFILE, None)
+        self.shared.pop(SharedKey.SQL_DATASET, None)
+        self.shared.pop(SharedKey.DATA_PREVIEW, None)
+        dataset_hash = self.shared.pop(SharedKey.DATASET_HASH, None)
+        if dataset_hash:
+            release_data_source(dataset_hash, user=self.session_id)
+        self.spool_dpath.mkdir(parents=True, exist_ok=True)
+        remove_uploads(self.spool_dpath)  ## not rmtree - an upload may still be arriving (possibly at another process)
+        self.memory_bytes = 0
+
+    def release_idle_data(self) -> bool:
+        """
+        Must run in the session's own context (see release_idle_workspaces)
+
+        Returns:
+            False if the session has been active again since it was found to be idle
+        """
+        if not self.is_idle(time.monotonic()):
+            return False
+        self.release_data()
+        self.got_data_param.value = False
+        logger.info(f"Released data for idle session {self.session_id}")
+        return True
+
+    def close(self):
+        unregister_upload_dpath(self.upload_token)
+        self.release_data()
+        shutil.rmtree(self.spool_dpath, ignore_errors=True)
+        self.shared.clear()
+        self.doc = None
+        self.patch_monitor = None
+
+
+_workspaces: dict[str | None, Workspace] = {}
+_workspaces_lock = threading.Lock()
+_last_idle_sweep = time.monotonic()
+
+def _get_session_id() -> str | None:
+    """
+    None if not running inside a served session e.g. when running a script directly
+    """
+    doc = pn.state.curdoc
+    session_context = doc.session_context if doc else None
+    return session_context.id if session_context else None
+
+def _on_session_destroyed(session_context):
+    with _workspaces_lock:
+        workspace = _workspaces.pop(session_context.id, None)
+    if workspace:
+        workspace.close()
+        logger.info(f"Evicted workspace for destroyed session {session_context.id}")
+
+def release_idle_workspaces():
+    """
+    Each idle session's data is released by a callback on its own document - never directly from whichever
+    session (or thread) happens to run the sweep - so nothing else touches a session's state
+    """
+    now = time.monotonic()
+    with _workspaces_lock:
+        idle_workspaces = [workspace for workspace in _workspaces.values() if workspace.is_idle(now)]
+    for workspace in idle_workspaces:
+        if workspace.doc:
+            workspace.doc.add_next_tick_callback(workspace.release_idle_data)  ## thread-safe
+        else:  ## not served e.g. a script
+            workspace.release_idle_data()
+
+def get_workspace() -> Workspace:
+    """
+    The workspace for the current Bokeh session (created on first request).
+    Also, at most once a minute or so, the data for sessions which have been left idle is released.
+    """
+    global _last_idle_sweep
+    session_id = _get_session_id()
+    with _workspaces_lock:
+        workspace = _workspaces.get(session_id)
+        if not workspace:
+            workspace = Workspace(session_id)
+            _workspaces[session_id] = workspace
+            if session_id:
+                pn.state.on_session_destroyed(_on_session_destroyed)
+        sweep_due = time.monotonic() - _last_idle_sweep > SESSION_IDLE_SWEEP_SECS
+        if sweep_due:
+            _last_idle_sweep = time.monotonic()
+    if not workspace.doc:  ## not served (e.g. a script) so there are no document changes to count as activity
+        workspace.touch()
+    if sweep_due:
+        release_idle_workspaces()
+    return workspace
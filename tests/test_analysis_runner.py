@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from sofastats_app.ui.stats.analysis_runner import render_html_design
+
+N_WORKERS = 4  ## as if ANALYSIS_WORKERS were 4 whatever this machine has
+
+class FakeDesign:
+    """
+    Records how many designs are being rendered at once
+    """
+    n_rendering = 0
+    max_n_rendering = 0
+    lock = threading.Lock()
+
+    def to_html_design(self) -> str:
+        with FakeDesign.lock:
+            FakeDesign.n_rendering += 1
+            FakeDesign.max_n_rendering = max(FakeDesign.max_n_rendering, FakeDesign.n_rendering)
+        time.sleep(0.02)
+        with FakeDesign.lock:
+            FakeDesign.n_rendering -= 1
+        return 'html'
+
+def test_only_one_report_rendered_at_a_time():
+    with ThreadPoolExecutor(max_workers=N_WORKERS) as executor:
+        htmls = list(executor.map(render_html_design, [FakeDesign() for _i in range(N_WORKERS * 2)]))
+    assert htmls == ['html'] * N_WORKERS * 2
+    assert FakeDesign.max_n_rendering == 1
+
+def test_other_work_runs_alongside_rendering():
+    rendering_started = threading.Event()
+    release_rendering = threading.Event()
+
+    class SlowDesign:
+        def to_html_design(self) -> str:
+            rendering_started.set()
+            release_rendering.wait(5)
+            return 'html'
+
+    with ThreadPoolExecutor(max_workers=N_WORKERS) as executor:
+        rendering = executor.submit(render_html_design, SlowDesign())
+        assert rendering_started.wait(5)
+        assert executor.submit(lambda: 'stats').result(timeout=1) == 'stats'  ## doesn't wait for the rendering
+        release_rendering.set()
+        assert rendering.result(timeout=5) == 'html'
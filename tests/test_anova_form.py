@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+
+import pandas as pd
+import panel as pn
+import pytest
+
+from sofastats_app.ui import workspace as workspace_module
+from sofastats_app.ui.conf import SharedKey
+from sofastats_app.ui.profile import DatasetProfile
+from sofastats_app.ui.stats.anova_form import ANOVAForm
+from sofastats_app.ui.stats.group_stats import GroupSummary
+
+pytestmark = pytest.mark.filterwarnings(  ## the form still uses e.g. name and button_type (Panel 2 will rename them)
+    'ignore::PendingDeprecationWarning')
+
+SUMMARIES_BY_MEASURE = {
+    'height': {1: GroupSummary(n=10, mean=1.7, sum_sq_dev=0.5), 2: GroupSummary(n=12, mean=1.8, sum_sq_dev=0.6)},
+    'weight': {1: GroupSummary(n=10, mean=70.0, sum_sq_dev=50.0), 2: GroupSummary(n=12, mean=80.0, sum_sq_dev=60.0)},
+}
+
+@pytest.fixture
+def anova_form(monkeypatch):
+    """
+    Form for a session with data loaded (no server needed - get_workspace falls back to a script workspace)
+    """
+    workspace = workspace_module.get_workspace()
+    df = pd.DataFrame({'sport': [1, 2] * 5, 'height': [1.7, 1.8] * 5, 'weight': [70.0, 80.0] * 5})
+    workspace.shared[SharedKey.DF_CSV] = df
+    workspace.shared[SharedKey.DATASET_HASH] = 'abc'
+    workspace.shared[SharedKey.DATASET_PROFILE] = DatasetProfile.from_df(df)
+    form = ANOVAForm(pn.widgets.Button(label='Close'))
+    form.select_grouping_variable.value = 'sport'
+    yield form
+    workspace.shared.clear()
+
+def test_late_summary_for_older_selection_ignored(anova_form, monkeypatch):
+    release_height = asyncio.Event()
+
+    async def get_group_summaries():
+        measure = anova_form.measure.value
+        if measure == 'height':
+            await release_height.wait()  ## slow - still running when weight is selected
+        return SUMMARIES_BY_MEASURE[measure]
+
+    monkeypatch.setattr(anova_form, 'get_group_summaries', get_group_summaries)
+    anova_form.group_value_selector.options = ['1', '2']
+
+    async def select_height_then_weight():
+        anova_form.measure.value = 'height'
+        anova_form.group_value_selector.param.update(value=['1', '2'])
+        height_update = asyncio.ensure_future(anova_form.update_group_summary(None))
+        await asyncio.sleep(0)
+        anova_form.measure.value = 'weight'
+        await anova_form.update_group_summary(None)
+        release_height.set()
+        await height_update
+
+    asyncio.run(select_height_then_weight())
+    assert '70.000' in anova_form.group_summary.object
+    assert '1.700' not in anova_form.group_summary.object
+    assert not anova_form.group_summary.loading
+
+def test_summary_error_shown_not_left_loading(anova_form, monkeypatch):
+    async def get_group_summaries():
+        raise ValueError("no such column")
+
+    monkeypatch.setattr(anova_form, 'get_group_summaries', get_group_summaries)
+    anova_form.group_value_selector.options = ['1', '2']
+
+    async def select_height():  ## changes trigger async watchers so need a running loop
+        anova_form.measure.value = 'height'
+        anova_form.group_value_selector.param.update(value=['1', '2'])
+        await anova_form.update_group_summary(None)
+
+    asyncio.run(select_height())
+    assert anova_form.group_summary.object.startswith("Unable to work out group statistics")
+    assert not anova_form.group_summary.loading
+
+def test_screening_report_not_opened_while_analysis_running(anova_form, monkeypatch):
+    n_runs = []
+
+    async def run_analysis(_event):
+        n_runs.append(1)
+
+    monkeypatch.setattr(anova_form, 'run_analysis', run_analysis)
+    anova_form.screening_results.value = pd.DataFrame({'Measure': ['height'], 'N': [10], 'F': [1.0], 'p': [0.5]})
+    anova_form.set_analysis_running(True)
+    asyncio.run(anova_form.open_screening_report(SimpleNamespace(row=0)))
+    assert not n_runs
+    assert anova_form.user_msg_var.value.startswith("Please wait")
+    anova_form.set_analysis_running(False)
+    asyncio.run(anova_form.open_screening_report(SimpleNamespace(row=0)))
+    assert len(n_runs) == 1
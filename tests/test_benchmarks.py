@@ -0,0 +1,27 @@
+import json
+from pathlib import Path
+import subprocess
+import sys
+
+RUN_BENCHMARKS_FPATH = Path(__file__).parent.parent / 'benchmarks' / 'run_benchmarks.py'
+
+def test_run_benchmarks_smoke(tmp_path):
+    """
+    Smallest dataset end to end in its own process (the benchmark sets up its own folders before importing the app)
+    """
+    data_dpath = tmp_path / 'data'
+    output_fpath = tmp_path / 'results.json'
+    args = [sys.executable, '-W', 'error::RuntimeWarning', str(RUN_BENCHMARKS_FPATH),
+        '--rows', '200', '--cols', '10', '--data-folder', str(data_dpath), '--output', str(output_fpath)]
+    for _run in range(2):  ## the second run reuses the synthetic CSV from the first
+        completed = subprocess.run(args, capture_output=True, text=True, timeout=300, cwd=tmp_path)
+        assert completed.returncode == 0, completed.stderr
+        assert 'Warning' not in completed.stderr, completed.stderr
+    assert 'Generating' not in completed.stdout
+    assert (data_dpath / 'synthetic_200_10.csv').exists()
+    results = json.loads(output_fpath.read_text(encoding='utf-8'))['results']
+    steps = [result['step'] for result in results]
+    assert steps[0] == 'load_csv'
+    assert steps[-3:] == ['anova_options', 'anova_data_source', 'anova_html']
+    assert results[0]['details']['csv_bytes'] == (data_dpath / 'synthetic_200_10.csv').stat().st_size
+    assert results[-1]['details']['html_chars'] > 0
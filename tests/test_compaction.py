@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sofastats_app.ui.compaction import compact_df, concat_compacted_chunks, get_compaction_key
+from sofastats_app.ui import profile as profile_module
+from sofastats_app.ui.profile import DatasetProfile, DatasetProfileBuilder
+
+COUNTRY_LABELS = {'country': {'value_labels': {1: 'NZ', 2: 'USA'}}}
+
+def compact_in_chunks(df: pd.DataFrame, data_labels: dict, chunk_rows: int) -> tuple[pd.DataFrame, DatasetProfile]:
+    """
+    As when a CSV is read a chunk at a time (see data.Data.load_in_memory)
+    """
+    profile_builder = DatasetProfileBuilder()
+    df_chunks = []
+    for start in range(0, len(df), chunk_rows):
+        df_chunk, _report = compact_df(df.iloc[start: start + chunk_rows].reset_index(drop=True), data_labels)
+        profile_builder.add_chunk(df_chunk)
+        df_chunks.append(df_chunk)
+    compacted_df = concat_compacted_chunks(df_chunks, data_labels)
+    assert not df_chunks  ## emptied as merged
+    dataset_profile = profile_builder.build(get_n_distinct=lambda col: compacted_df[col].nunique(),
+        dtypes=compacted_df.dtypes.to_dict())
+    return compacted_df, dataset_profile
+
+def test_compact_df():
+    df = pd.DataFrame({
+        'country': [1, 2, 1, 2] * 25,
+        'age': list(range(100)),
+        'height': np.linspace(1.5, 2.0, 100),
+        'browser': ['Firefox', 'Chrome'] * 50,
+        'name': [f"Person {i}" for i in range(100)],
+    })
+    compacted_df, report = compact_df(df, COUNTRY_LABELS)
+    assert isinstance(compacted_df['country'].dtype, pd.CategoricalDtype)
+    assert compacted_df['age'].dtype == np.int8
+    assert compacted_df['height'].dtype == np.float64
+    assert isinstance(compacted_df['browser'].dtype, pd.CategoricalDtype)
+    assert not isinstance(compacted_df['name'].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(compacted_df.astype(object), df.astype(object))
+    bytes_by_col = report.set_index('column')
+    assert (bytes_by_col['bytes_after'] <= bytes_by_col['bytes_before']).all()
+    assert bytes_by_col.loc['age', 'bytes_after'] < bytes_by_col.loc['age', 'bytes_before']
+
+def test_compaction_key_only_depends_on_labelled_cols():
+    variable_label_only = {'age': {'variable_label': 'Age'}}
+    relabelled = {'country': {'value_labels': {1: 'New Zealand', 2: 'United States'}}}
+    assert get_compaction_key(None) == get_compaction_key(variable_label_only)
+    assert get_compaction_key(COUNTRY_LABELS) == get_compaction_key(relabelled)
+    assert get_compaction_key(COUNTRY_LABELS) != get_compaction_key(None)
+
+def test_chunks_with_different_categories_stay_categorical():
+    df = pd.DataFrame({'country': [1, 1, 1, 2, 2, 3], 'browser': ['Firefox'] * 3 + ['Chrome'] * 3})
+    compacted_df, dataset_profile = compact_in_chunks(df, COUNTRY_LABELS, chunk_rows=3)
+    for col in ('country', 'browser'):
+        assert isinstance(compacted_df[col].dtype, pd.CategoricalDtype)
+        assert compacted_df[col].tolist() == df[col].tolist()
+    assert dataset_profile.columns['country'].value_type is int
+    assert dataset_profile.columns['country'].distinct_values == [1, 2, 3]
+    assert dataset_profile.columns['country'].counts == [3, 2, 1]
+
+def test_chunks_downcast_to_different_sizes():
+    df = pd.DataFrame({'n': [1, 2, 3, 1_000, 2_000, 3_000]})
+    compacted_df, dataset_profile = compact_in_chunks(df, {}, chunk_rows=3)
+    assert compacted_df['n'].dtype == np.int16
+    assert compacted_df['n'].tolist() == df['n'].tolist()
+    assert dataset_profile.columns['n'].is_numeric
+
+def test_categorical_and_plain_string_chunks_compacted_again():
+    repeated = ['a', 'b', 'a', 'b', 'a', 'b']
+    unique = [f"x{i}" for i in range(6)]
+    df = pd.DataFrame({'code': repeated + unique})
+    compacted_df, dataset_profile = compact_in_chunks(df, {}, chunk_rows=6)
+    assert compacted_df['code'].tolist() == df['code'].tolist()
+    assert dataset_profile.columns['code'].value_type is str
+    assert dataset_profile.n_rows == 12
+
+def test_int_then_float_chunks_still_numeric():
+    df = pd.DataFrame({'country': [1.0, 2.0, 1.0, 1.5, 2.0, np.nan]})
+    chunks = [pd.DataFrame({'country': [1, 2, 1]}), pd.DataFrame({'country': [1.5, 2.0, np.nan]})]
+    profile_builder = DatasetProfileBuilder()
+    compacted_chunks = []
+    for df_chunk in chunks:
+        compacted_chunk, _report = compact_df(df_chunk, COUNTRY_LABELS)
+        profile_builder.add_chunk(compacted_chunk)
+        compacted_chunks.append(compacted_chunk)
+    compacted_df = concat_compacted_chunks(compacted_chunks, COUNTRY_LABELS)
+    pd.testing.assert_series_equal(compacted_df['country'].astype(float), df['country'])
+    dataset_profile = profile_builder.build(get_n_distinct=lambda col: compacted_df[col].nunique(),
+        dtypes=compacted_df.dtypes.to_dict())
+    assert dataset_profile.columns['country'].value_type is float
+    assert dataset_profile.columns['country'].n_null == 1
+
+@pytest.mark.parametrize('categories, expected_value_type', [
+    ([1, 2, 1.5], float),
+    ([1, 2, 3], int),
+    ([1, 'a', 2], str),
+])
+def test_value_type_from_values_of_object_columns(categories, expected_value_type):
+    """
+    e.g. what concat_compacted_chunks falls back to if int and float categories can't be combined
+    """
+    series = pd.Series(pd.Categorical(categories, categories=pd.Index(categories, dtype=object)), name='col')
+    assert series.dtype.categories.dtype == np.dtype(object)
+    assert DatasetProfile.from_df(series.to_frame()).columns['col'].value_type is expected_value_type
+
+def test_label_coverage(monkeypatch):
+    monkeypatch.setattr(profile_module, 'MAX_PROFILED_DISTINCT_VALUES', 3)
+    df = pd.DataFrame({'country': [1, 2, 3, 3], 'name': [f"Person {i}" for i in range(4)]})
+    compacted_df, dataset_profile = compact_in_chunks(df, COUNTRY_LABELS, chunk_rows=2)
+    value_labels = COUNTRY_LABELS['country']['value_labels']
+    assert dataset_profile.columns['country'].get_label_coverage(value_labels) == pytest.approx(2 / 3)
+    assert dataset_profile.columns['country'].get_label_coverage({}) == 0
+    assert dataset_profile.columns['name'].distinct_values is None  ## too many to keep
+    assert dataset_profile.columns['name'].get_label_coverage(value_labels) is None
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from sofastats_app.ui.dataset_cache import DatasetCache, get_content_hash
+
+def get_df(n_rows: int = 1_000) -> pd.DataFrame:
+    return pd.DataFrame({
+        'age': np.arange(n_rows, dtype=np.int64),
+        'height': np.linspace(1.5, 2.0, n_rows),
+        'country': pd.Categorical(['NZ', 'USA'] * (n_rows // 2)),
+        'score': [1.5, np.nan] * (n_rows // 2),
+    })
+
+def set_last_used(cache: DatasetCache, content_hash: str, timestamp: float):
+    os.utime(cache._get_fpath(content_hash), (timestamp, timestamp))
+
+def test_content_hash_depends_only_on_content(tmp_path):
+    fpath_a = tmp_path / 'a.csv'
+    fpath_b = tmp_path / 'b.csv'
+    fpath_a.write_text('x,y\n1,2\n')
+    fpath_b.write_text('x,y\n1,2\n')
+    assert get_content_hash(fpath_a) == get_content_hash(fpath_b)
+    fpath_b.write_text('x,y\n1,3\n')
+    assert get_content_hash(fpath_a) != get_content_hash(fpath_b)
+
+def test_round_trip_and_hit_miss_counts(tmp_path):
+    cache = DatasetCache(tmp_path, max_bytes=10 ** 9)
+    df = get_df()
+    assert cache.get('abc') is None
+    cache.put('abc', df, name='survey.csv', compaction_key='key')
+    cached_df = cache.get('abc')
+    pd.testing.assert_frame_equal(cached_df, df)
+    assert cache.get_compaction_key('abc') == 'key'
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.n_files) == (1, 1, 1)
+    [stored_dataset] = cache.list_datasets()
+    assert (stored_dataset.name, stored_dataset.n_rows, stored_dataset.n_cols) == ('survey.csv', 1_000, 4)
+
+def test_numeric_columns_without_missing_values_not_copied(tmp_path):
+    cache = DatasetCache(tmp_path, max_bytes=10 ** 9)
+    cache.put('abc', get_df())
+    cached_df = cache.get('abc')
+    assert not cached_df['age'].to_numpy().flags.owndata  ## points at the memory-mapped file
+    assert cached_df['score'].isna().sum() == 500
+
+def test_least_recently_used_evicted(tmp_path):
+    df = get_df()
+    cache = DatasetCache(tmp_path, max_bytes=10 ** 9)
+    for i, content_hash in enumerate(['oldest', 'middle', 'newest']):
+        cache.put(content_hash, df)
+        set_last_used(cache, content_hash, 1_000_000 + i)
+    n_bytes = cache._get_fpath('oldest').stat().st_size
+    cache.get('oldest')  ## now the most recently used
+    cache.max_bytes = 2 * n_bytes
+    cache.evict()
+    assert sorted(stored_dataset.content_hash for stored_dataset in cache.list_datasets()) == ['newest', 'oldest']
+    assert not cache._get_metadata_fpath('middle').exists()
+    assert cache.get('middle') is None
+    assert cache.stats.total_bytes <= cache.max_bytes
+
+def test_put_evicts_down_to_limit(tmp_path):
+    df = get_df()
+    cache = DatasetCache(tmp_path, max_bytes=10 ** 9)
+    cache.put('first', df)
+    set_last_used(cache, 'first', 1_000_000)
+    cache.max_bytes = cache._get_fpath('first').stat().st_size
+    cache.put('second', df)
+    assert [stored_dataset.content_hash for stored_dataset in cache.list_datasets()] == ['second']
@@ -0,0 +1,150 @@
+import math
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sofastats.stats_calc.engine import anova, fprob, rankdata
+from sofastats.stats_calc.interfaces import Sample
+from sofastats_app.ui.data_source import TableIngestion, release_data_source
+from sofastats_app.ui.sql_dataset import SqlDataset
+from sofastats_app.ui.stats.group_stats import (GroupStatsCache, get_anova_f_and_p, get_fprobs, get_rank_sums,
+    get_screening_results)
+
+GROUP_VALS = ['a', 'b', 'c']
+
+def get_df(n_rows: int = 300, *, offset: float = 0.0, seed: int = 1) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    groups = np.array(GROUP_VALS * (n_rows // 3))
+    group_effects = np.select([groups == 'a', groups == 'b'], [0.0, 0.3], 0.6)
+    df = pd.DataFrame({
+        'group': groups,
+        'weak': offset + group_effects + rng.normal(size=n_rows),
+        'strong': offset + 5 * group_effects + rng.normal(size=n_rows),
+        'noise': offset + rng.normal(size=n_rows),
+    })
+    df.loc[::7, 'weak'] = np.nan
+    return df
+
+def get_cache(max_sorted_values_bytes: int = 10 ** 9) -> GroupStatsCache:
+    return GroupStatsCache(max_summaries=5, max_sorted_values_bytes=max_sorted_values_bytes)
+
+def get_lib_anova(df: pd.DataFrame, measure_col: str):
+    samples = [Sample(lbl=group_val, vals=df.loc[df['group'] == group_val, measure_col].dropna().tolist())
+        for group_val in GROUP_VALS]
+    return anova('group', measure_col, samples, high=False)
+
+@pytest.mark.parametrize('df_between, df_within, F', [
+    (1, 10, 0.5),
+    (2, 297, 3.2),
+    (4, 50, 12.0),
+    (10, 1_000, 1.01),
+    (3, 5, 150.0),
+])
+def test_fprobs_match_lib_fprob(df_between, df_within, F):
+    [p] = get_fprobs(np.array([df_between]), np.array([df_within]), np.array([F]))
+    assert p == pytest.approx(fprob(df_between, df_within, F), rel=1e-6, abs=1e-12)
+
+def test_fprobs_nan_for_missing_F():
+    ps = get_fprobs(np.array([2, 2]), np.array([20, 20]), np.array([np.nan, 1.5]))
+    assert math.isnan(ps[0])
+    assert ps[1] == pytest.approx(fprob(2, 20, 1.5))
+
+def test_group_summaries_match_pandas():
+    df = get_df()
+    summaries = get_cache().get_summaries(df, dataset_hash='abc', measure_col='weak', grouping_col='group')
+    expected = df.groupby('group')['weak'].agg(['count', 'mean', 'var'])
+    for group_val in GROUP_VALS:
+        assert summaries[group_val].n == expected.loc[group_val, 'count']
+        assert summaries[group_val].mean == pytest.approx(expected.loc[group_val, 'mean'])
+        assert summaries[group_val].variance == pytest.approx(expected.loc[group_val, 'var'])
+
+@pytest.mark.parametrize('measure_col', ['weak', 'strong', 'noise'])
+def test_anova_from_summaries_matches_lib(measure_col):
+    df = get_df()
+    summaries = get_cache().get_summaries(df, dataset_hash='abc',
+        measure_col=measure_col, grouping_col='group')
+    F, p = get_anova_f_and_p([summaries[group_val] for group_val in GROUP_VALS])
+    lib_result = get_lib_anova(df, measure_col)
+    assert F == pytest.approx(lib_result.F, rel=1e-9)
+    assert p == pytest.approx(lib_result.p, rel=1e-9)
+
+def test_anova_needs_two_groups_and_variability():
+    df = pd.DataFrame({'group': ['a', 'a', 'b', 'b'], 'same': [1.0] * 4})
+    summaries = get_cache().get_summaries(df, dataset_hash='abc',
+        measure_col='same', grouping_col='group')
+    assert get_anova_f_and_p(list(summaries.values())) is None
+    assert get_anova_f_and_p([summaries['a']]) is None
+
+@pytest.mark.parametrize('offset', [0.0, 1e9])
+def test_screening_matches_lib(offset):
+    df = get_df(offset=offset)
+    screening_results = get_screening_results(df, measure_cols=['weak', 'strong', 'noise'],
+        grouping_col='group', group_vals=GROUP_VALS).set_index('measure')
+    assert screening_results.index[0] == 'strong'  ## most significant first
+    for measure_col in ('weak', 'strong', 'noise'):
+        lib_result = get_lib_anova(get_df(), measure_col)  ## offset changes neither F nor p
+        assert screening_results.loc[measure_col, 'N'] == df[measure_col].notna().sum()
+        assert screening_results.loc[measure_col, 'F'] == pytest.approx(lib_result.F, rel=1e-6)
+        assert screening_results.loc[measure_col, 'p'] == pytest.approx(lib_result.p, rel=1e-5, abs=1e-12)
+
+def test_screening_only_selected_groups():
+    df = get_df()
+    screening_results = get_screening_results(df, measure_cols=['strong'], grouping_col='group',
+        group_vals=['a', 'c'])
+    two_groups_df = df[df['group'].isin(['a', 'c'])]
+    samples = [Sample(lbl=group_val, vals=two_groups_df.loc[two_groups_df['group'] == group_val, 'strong'].tolist())
+        for group_val in ('a', 'c')]
+    lib_result = anova('group', 'strong', samples, high=False)
+    assert screening_results.loc[0, 'N'] == len(two_groups_df)
+    assert screening_results.loc[0, 'F'] == pytest.approx(lib_result.F, rel=1e-9)
+
+def test_sorted_values_from_df():
+    df = get_df()
+    sorted_values = get_cache().get_sorted_values(df, dataset_hash='abc', measure_col='weak', grouping_col='group')
+    assert list(sorted_values) == GROUP_VALS
+    for group_val in GROUP_VALS:
+        expected = np.sort(df.loc[df['group'] == group_val, 'weak'].dropna().to_numpy())
+        np.testing.assert_array_equal(sorted_values[group_val], expected)
+
+def test_sorted_values_from_sql_match_df():
+    df = get_df(30)
+    dataset_hash = uuid.uuid4().hex
+    table_ingestion = TableIngestion(dataset_hash, user='test')
+    table_ingestion.append(df)
+    table_ingestion.finish()
+    try:
+        sql_dataset = SqlDataset(table_ingestion.table_name, cols=list(df.columns))
+        sql_sorted_values = get_cache().get_sorted_values(sql_dataset, dataset_hash=dataset_hash,
+            measure_col='weak', grouping_col='group')
+    finally:
+        release_data_source(dataset_hash, user='test')
+    df_sorted_values = get_cache().get_sorted_values(df, dataset_hash='abc', measure_col='weak', grouping_col='group')
+    assert list(sql_sorted_values) == list(df_sorted_values)
+    for group_val in GROUP_VALS:
+        np.testing.assert_allclose(sql_sorted_values[group_val], df_sorted_values[group_val])
+
+@pytest.mark.parametrize('group_vals', [GROUP_VALS, ['a', 'c']])
+def test_rank_sums_match_lib_ranks(group_vals):
+    df = get_df(60)
+    df['rounded'] = df['strong'].round()  ## plenty of ties
+    sorted_values = get_cache().get_sorted_values(df, dataset_hash='abc', measure_col='rounded', grouping_col='group')
+    rank_sums = get_rank_sums(sorted_values, group_vals)
+    vals = np.concatenate([sorted_values[group_val] for group_val in group_vals])
+    ranks = np.array(rankdata(vals.tolist()))
+    group_idxs = np.repeat(np.arange(len(group_vals)), [len(sorted_values[group_val]) for group_val in group_vals])
+    for i, group_val in enumerate(group_vals):
+        assert rank_sums[group_val] == pytest.approx(ranks[group_idxs == i].sum())
+    n_vals = len(vals)
+    assert sum(rank_sums.values()) == pytest.approx(n_vals * (n_vals + 1) / 2)
+
+def test_sorted_values_evicted_by_bytes_but_latest_kept():
+    df = get_df()
+    cache = get_cache(max_sorted_values_bytes=1)
+    first = cache.get_sorted_values(df, dataset_hash='abc', measure_col='weak', grouping_col='group')
+    latest = cache.get_sorted_values(df, dataset_hash='abc', measure_col='strong', grouping_col='group')
+    assert cache.get_sorted_values(df, dataset_hash='abc', measure_col='strong', grouping_col='group') is latest
+    assert cache.get_sorted_values(df, dataset_hash='abc', measure_col='weak', grouping_col='group') is not first
+    summaries = cache.get_summaries(df, dataset_hash='abc', measure_col='weak', grouping_col='group')
+    assert cache.get_summaries(df, dataset_hash='abc', measure_col='weak', grouping_col='group') is summaries
@@ -0,0 +1,54 @@
+import gzip
+
+from sofastats_app.ui.report_bundle import (ASSETS_FOLDER_NAME, SCRIPT_ASSET_MIN_CHARS,
+    bundle_report, minify_css, write_report)
+
+STYLE = "<style>\n  .sofastats  td {\n    color : red;\n  }\n</style>"
+BIG_SCRIPT = 'var x = 1;\n' * (SCRIPT_ASSET_MIN_CHARS // 10)
+
+def get_report(body: str) -> str:
+    return f"<html><head>{STYLE}</head><body>{STYLE}{body}</body></html>"
+
+def test_minify_css():
+    assert minify_css("/* comment */ div :hover { color : red ; }") == 'div :hover{color :red}'
+
+def test_duplicate_css_bundled_once_and_linked_in_head():
+    bundled_report = bundle_report(get_report('<p>Result</p>'))
+    assert list(bundled_report.assets.values()) == ['.sofastats td{color :red}']
+    css_name = next(iter(bundled_report.assets))
+    assert '<style' not in bundled_report.html
+    assert bundled_report.html.count(f'href="{ASSETS_FOLDER_NAME}/{css_name}"') == 1
+    assert bundled_report.html.index(css_name) < bundled_report.html.index('</head>')
+
+def test_large_javascript_externalised_in_place():
+    bundled_report = bundle_report(get_report(f'<p>Before</p><script>{BIG_SCRIPT}</script><p>After</p>'))
+    script_name = next(name for name in bundled_report.assets if name.endswith('.js'))
+    assert bundled_report.assets[script_name] == BIG_SCRIPT
+    assert f'<p>Before</p><script src="{ASSETS_FOLDER_NAME}/{script_name}"></script><p>After</p>' in bundled_report.html
+
+def test_small_and_non_javascript_scripts_left_alone():
+    body = (f'<script>var small = 1;</script>'
+        f'<script type="application/json">{{"data": "{BIG_SCRIPT}"}}</script>'
+        f'<script type="module">{BIG_SCRIPT}</script>'
+        f'<script data-type="x" type="text/javascript">{BIG_SCRIPT}</script>')
+    bundled_report = bundle_report(get_report(body))
+    assert len([name for name in bundled_report.assets if name.endswith('.js')]) == 1
+    assert '<script>var small = 1;</script>' in bundled_report.html
+    assert f'<script type="application/json">{{"data": "{BIG_SCRIPT}"}}</script>' in bundled_report.html
+    assert f'<script type="module">{BIG_SCRIPT}</script>' in bundled_report.html
+    assert 'data-type="x" type="text/javascript" src=' in bundled_report.html
+
+def test_whitespace_outside_style_untouched():
+    body = '<pre>a  b\n\n  c</pre><textarea>  x  </textarea><p>one  two</p><!-- note -->'
+    bundled_report = bundle_report(get_report(body))
+    assert body in bundled_report.html
+
+def test_write_report_assets_and_gzip(tmp_path):
+    html = get_report('<p>Result</p>')
+    fpath = write_report(html, tmp_path / 'report.html', bundle_assets=True, gzip_output=True)
+    assert fpath.name == 'report.html.gz'
+    bundled_html = gzip.decompress(fpath.read_bytes()).decode('utf-8')
+    assert bundled_html == bundle_report(html).html
+    assert len(list((tmp_path / ASSETS_FOLDER_NAME).iterdir())) == 1
+    write_report(html, tmp_path / 'report2.html', bundle_assets=True)  ## same CSS so nothing new to write
+    assert len(list((tmp_path / ASSETS_FOLDER_NAME).iterdir())) == 1
@@ -0,0 +1,31 @@
+import uuid
+
+import pandas as pd
+import pytest
+
+from sofastats_app.ui.data_source import TableIngestion, release_data_source
+from sofastats_app.ui.sql_dataset import SqlDataset
+
+@pytest.fixture
+def sql_dataset():
+    """
+    Ingested a chunk at a time as for an out-of-core CSV
+    """
+    dataset_hash = uuid.uuid4().hex
+    table_ingestion = TableIngestion(dataset_hash, user='test')
+    table_ingestion.append(pd.DataFrame({'sport': [2, 1, 2, None], 'height': [1.8, 1.6, 1.7, 1.9]}))
+    table_ingestion.append(pd.DataFrame({'sport': [3, 2], 'height': [None, 2.0]}))
+    table_ingestion.finish()
+    yield SqlDataset(table_ingestion.table_name, cols=['sport', 'height'])
+    release_data_source(dataset_hash, user='test')
+
+def test_value_counts(sql_dataset):
+    value_counts = sql_dataset.get_value_counts('sport')
+    assert value_counts.to_dict() == {1: 1, 2: 3, 3: 1}  ## nulls left out
+    assert value_counts.name == 'sport'
+
+def test_col_values(sql_dataset):
+    sorted_heights = sql_dataset.get_col_values('height', where_sql='WHERE "sport" = ? AND "height" IS NOT NULL',
+        params=[2], sort=True)
+    assert sorted_heights.tolist() == [1.7, 1.8, 2.0]
+    assert len(sql_dataset.get_col_values('height')) == 6
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+from sofastats_app.ui.upload import (claim_upload, is_upload_being_written, release_upload, remove_other_uploads,
+    remove_uploads)
+
+def get_finished_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+def test_only_one_writer_at_a_time(tmp_path):
+    assert claim_upload(tmp_path, 'abc')
+    assert not claim_upload(tmp_path, 'abc')
+    assert claim_upload(tmp_path, 'other')
+    release_upload(tmp_path, 'abc')
+    assert claim_upload(tmp_path, 'abc')
+
+def test_writer_in_another_process_counts(tmp_path):
+    (tmp_path / 'abc.writing').write_text(str(os.getppid()), encoding='utf-8')  ## e.g. another server process
+    assert is_upload_being_written(tmp_path, 'abc')
+    assert not claim_upload(tmp_path, 'abc')
+
+def test_marker_from_stopped_process_taken_over(tmp_path):
+    (tmp_path / 'abc.writing').write_text(str(get_finished_pid()), encoding='utf-8')
+    assert not is_upload_being_written(tmp_path, 'abc')
+    assert claim_upload(tmp_path, 'abc')
+    assert (tmp_path / 'abc.writing').read_text(encoding='utf-8') == str(os.getpid())
+
+def test_upload_being_written_not_removed(tmp_path):
+    for fname in ('arriving.part', 'finished.csv', 'old.part', 'latest.csv'):
+        (tmp_path / fname).write_bytes(b'x,y\n')
+    claim_upload(tmp_path, 'arriving')
+    remove_other_uploads(tmp_path, 'latest')
+    assert sorted(fpath.name for fpath in tmp_path.iterdir()) == ['arriving.part', 'arriving.writing', 'latest.csv']
+    remove_uploads(tmp_path)
+    assert sorted(fpath.name for fpath in tmp_path.iterdir()) == ['arriving.part', 'arriving.writing']
@@ -0,0 +1,65 @@
+import time
+
+from bokeh.document import Document
+import pandas as pd
+import panel as pn
+from panel.io.state import set_curdoc
+import pytest
+
+from sofastats_app.ui import workspace as workspace_module
+from sofastats_app.ui.conf import SharedKey
+
+IDLE_TIMEOUT_SECS = 0.05
+
+@pytest.fixture
+def served_workspace(monkeypatch):
+    """
+    A workspace with its own document (as if served) holding some data, registered for the idle sweep
+    """
+    monkeypatch.setattr(workspace_module, 'SESSION_IDLE_TIMEOUT_SECS', IDLE_TIMEOUT_SECS)
+    doc = Document()
+    with set_curdoc(doc):
+        workspace = workspace_module.Workspace('test-session')
+    workspace.shared[SharedKey.DF_CSV] = pd.DataFrame({'a': [1, 2, 3]})
+    workspace.got_data_param.value = True
+    workspace.update_memory_usage()
+    monkeypatch.setitem(workspace_module._workspaces, workspace.session_id, workspace)
+    yield workspace
+    workspace.close()
+
+def wait_until_idle():
+    time.sleep(IDLE_TIMEOUT_SECS * 2)
+
+def test_workspace_without_data_never_idle(served_workspace):
+    served_workspace.release_data()
+    wait_until_idle()
+    assert not served_workspace.is_idle(time.monotonic())
+
+def test_document_change_counts_as_activity(served_workspace):
+    text_input = pn.widgets.TextInput()
+    served_workspace.doc.add_root(text_input.get_root(served_workspace.doc))
+    wait_until_idle()
+    assert served_workspace.is_idle(time.monotonic())
+    text_input.value = 'changed'
+    assert not served_workspace.is_idle(time.monotonic())
+
+def test_sweep_releases_on_session_document(served_workspace):
+    wait_until_idle()
+    workspace_module.release_idle_workspaces()
+    ## nothing released until the callback runs in the session's own context
+    assert len(served_workspace.shared[SharedKey.DF_CSV]) == 3
+    callbacks = list(served_workspace.doc.session_callbacks)
+    assert len(callbacks) == 1
+    assert callbacks[0].callback() is True
+    assert served_workspace.shared[SharedKey.DF_CSV].empty
+    assert served_workspace.memory_bytes == 0
+    assert served_workspace.got_data_param.value is False
+
+def test_release_skipped_if_active_again_before_callback(served_workspace):
+    wait_until_idle()
+    workspace_module.release_idle_workspaces()
+    served_workspace.touch()
+    callback = list(served_workspace.doc.session_callbacks)[0]
+    assert callback.callback() is False
+    assert len(served_workspace.shared[SharedKey.DF_CSV]) == 3
+    assert served_workspace.got_data_param.value is True